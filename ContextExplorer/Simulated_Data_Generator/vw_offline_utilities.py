@@ -199,44 +199,39 @@ def highlight_optimal(s, is_minimization):
     return ['background-color: lightgreen' if v else '' for v in is_opt]
 
 def transform_dsjson(df, context_cols, reward_col, action_col, actions, is_minimization, other_values=None):
+    # Each line is joined from per-column lists of strings: row-wise apply and summing the string columns of a DataFrame
+    # are slow on large batches
     action_list = [x+1 for x in range(len(actions))]
-    df_json = pd.DataFrame(index=df.index)
-    df_json['left_brace'] = '{'
-    df_json['label_cost'] = '"_label_cost":'
-    df_json['cost'] = df[reward_col] if is_minimization else -1*df[reward_col]
-    df_json['label_probability'] = ',"_label_probability":'
-    df_json['probability'] = 0
-    df_json['label_Action'] = ',"_label_Action":'
-    df_json['action'] = df[action_col].map({a: i+1 for i, a in enumerate(actions)})
-    df_json['labelIndex'] = ',"_labelIndex":'
-    df_json['aindex'] = df[action_col].map({a: i for i, a in enumerate(actions)})
-    eventid = df_json.apply(lambda x : uuid.uuid4().hex, axis=1)
-    df_json['o'] = ',"o":[{"EventId":"EventId_' + eventid + '","v":' + df_json['cost'].astype(str) + '}]'
-    df_json['Timestamp'] = ',"Timestamp":'    
+    cost = (df[reward_col] if is_minimization else -1*df[reward_col]).astype(str).tolist()
+    action = df[action_col].map({a: i+1 for i, a in enumerate(actions)}).astype(str).tolist()
+    aindex = df[action_col].map({a: i for i, a in enumerate(actions)}).tolist()
+    eventid = [uuid.uuid4().hex for _ in range(df.shape[0])]
     try:
         ni = int(df['n_iteration'][0])
     except KeyError:
         ni = 0
-    df_json['time'] = '"' + (datetime.datetime.utcnow() + datetime.timedelta(days=ni)).isoformat() + 'Z"'
-    df_json['VE'] = ',"Version":"1","EventId":"EventId_' + eventid + '",'
-    df_json['a'] = '"a":' + df_json['aindex'].apply(lambda x: swap_selection(x, action_list))
-    add_context(df, df_json, context_cols)
+    time = '"' + (datetime.datetime.utcnow() + datetime.timedelta(days=ni)).isoformat() + 'Z"'
+    df_context = pd.DataFrame(index=df.index)
+    add_context(df, df_context, context_cols)
+    context = df_context['c'].tolist()
     context_multi = [{'id': {str(x): 1}} for x in range(len(action_list))]
-    df_json['multi'] = '"_multi":' + json.dumps(context_multi) + ' },'
+    multi = '"_multi":' + json.dumps(context_multi) + ' },'
     if 'prob_list' not in df.columns:
         p = round(1.0/len(actions), 4)
         df['prob_list'] = [[p]*len(actions)]*df.shape[0]
-    df_json['prob_list'] = df['prob_list']
-    p_swarpped = df_json.apply(lambda x: swap_selection(x['aindex'], x['prob_list']), axis=1)
-    df_json.drop(columns=['prob_list'], inplace=True)
-    df_json['p'] = '"p":' + p_swarpped + ','
-    df_json['probability'] = p_swarpped.apply(lambda x: eval(x)[0])
-    df_json['m'] = '"m": "v1"'
-    if other_values is not None:
-        df_json['other_values'] = ',' + df[other_values]
-    df_json['right_brace'] = '}'
-    df_json['output_json'] = df_json.astype(str).sum(axis=1).str.replace(' ', '')
-    output_json = df_json['output_json'].to_frame()
+    prob_list = df['prob_list'].tolist()
+    other = [''] * df.shape[0] if other_values is None else (',' + df[other_values].astype(str)).tolist()
+    lines = []
+    for k in range(df.shape[0]):
+        x = aindex[k]
+        lines.append(''.join([
+            '{"_label_cost":', cost[k], ',"_label_probability":', str(prob_list[k][x]), ',"_label_Action":', action[k],
+            ',"_labelIndex":', str(x), ',"o":[{"EventId":"EventId_', eventid[k], '","v":', cost[k], '}]',
+            ',"Timestamp":', time, ',"Version":"1","EventId":"EventId_', eventid[k], '",',
+            '"a":', swap_selection(x, action_list), context[k], multi,
+            '"p":', swap_selection(x, prob_list[k]), ',', '"m": "v1"', other[k], '}'
+        ]).replace(' ', ''))
+    output_json = pd.DataFrame({'output_json': lines}, index=df.index)
     return output_json
 
 def add_context(df, df_json, context_cols):
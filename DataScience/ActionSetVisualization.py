@@ -1,41 +1,37 @@
 import numpy as np
 import matplotlib.pyplot as plt
-import ds_parse, json, argparse, collections, gzip, os
+import ds_parse, json, argparse, collections, os
 
 def update(files, dt_str=13):
+    # dt_str: length of the Timestamp prefix used to bin the events (13: hours, 16: minutes, 19: seconds)
+    unit = 'm' if dt_str <= 16 else 's' if dt_str <= 19 else 'us'
     fp_list = ds_parse.input_files_to_fp_list(files)
     l = []
     c_imp = collections.Counter()
     c_clk = collections.Counter()
     c_imp_all = collections.Counter()
     for fp in fp_list:
-        bytes_count = 0
-        tot_bytes = os.path.getsize(fp)
-        for i,x in enumerate(gzip.open(fp, 'rb') if fp.endswith('.gz') else open(fp, 'rb')):
-            bytes_count += len(x)
-            if (i+1) % 1000 == 0:
-                if fp.endswith('.gz'):
-                    ds_parse.update_progress(i+1,prefix=fp+' - ')
-                else:
-                    ds_parse.update_progress(bytes_count,tot_bytes,fp+' - ')
-        
-            if x.startswith(b'{"_label') and x.strip().endswith(b'}'):
-                data = ds_parse.json_cooked(x)
-                if data is None:
-                    continue
-                
-                c_imp_all.update([data['ts'][:dt_str]])
-                if not data['skipLearn']:
-                    c_imp.update([data['ts'][:dt_str]])
-                    l.append((data, x.strip()))
-                    if float(data['cost']) < 0:
-                        c_clk.update([data['ts'][:dt_str]])
-        if fp.endswith('.gz'):
-            ds_parse.update_progress(i+1,prefix=fp+' - ')
-        else:
-            ds_parse.update_progress(bytes_count,tot_bytes,fp+' - ')
+        tot_bytes = ds_parse.get_log_size(fp)
+        i = 0
+        activated_lines = []
+        for cols in ds_parse.iter_columns(fp):
+            i += cols['n_lines']
+            if tot_bytes is None:
+                ds_parse.update_progress(i,prefix=fp+' - ')
+            else:
+                ds_parse.update_progress(cols['bytes_count'],tot_bytes,fp+' - ')
+
+            ts = np.datetime_as_string(cols['ts'], unit=unit).astype('<U{}'.format(dt_str))
+            activated = ~cols['skipLearn']
+
+            c_imp_all.update(dict(zip(*np.unique(ts, return_counts=True))))
+            c_imp.update(dict(zip(*np.unique(ts[activated], return_counts=True))))
+            c_clk.update(dict(zip(*np.unique(ts[activated & (cols['cost'] < 0)], return_counts=True))))
+            activated_lines.append(cols['line'][activated])
         print()
-                    
+        if activated_lines:
+            l.extend(x.strip() for x in ds_parse.read_lines(fp, np.concatenate(activated_lines)))
+
     ctr = []
     ts = []
     print('Timestamp (UTC),Clicks,Activated Imp.,CTR,Total Imp.')
@@ -51,7 +47,7 @@ def create_act_d(l):
     data = []
     ctr_all = {}
     for i,x in enumerate(l):
-        js = json.loads(x[1])
+        js = json.loads(x)
         if i == 0:
             print('These are the actions features from your first event:\n',js['c']['_multi'])
             actions_names_fields = input('\nEnter a (comma separated) list of JSON fields used to extract the action name:').split(',')
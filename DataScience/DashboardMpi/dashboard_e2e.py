@@ -1,11 +1,12 @@
 import argparse
 import datetime
+import itertools
 import os
 import json
 from subprocess import check_output, STDOUT
 from shutil import rmtree
 from azure.storage.blob import BlockBlobService
-from DashboardMpi.helpers import vw, preprocessing, grid, sweep, command, dashboard
+from DashboardMpi.helpers import vw, preprocessing, grid, sweep, command, dashboard, pipeline
 from DashboardMpi.helpers.environment import Environment
 from DashboardMpi.helpers.constant import LOG_CHUNK_SIZE
 from DashboardMpi.helpers.input_provider import AzureLogsProvider
@@ -25,6 +26,7 @@ def dashboard_e2e(args, delta_mod_t=3600, max_connections=50):
     output_path = args.output_path
     enable_sweep = args.enable_sweep
     summary_json = args.summary_json
+    pipeline_depth = args.pipeline_depth
 
     log_type = args.log_type
 
@@ -48,57 +50,87 @@ def dashboard_e2e(args, delta_mod_t=3600, max_connections=50):
 
     base_command = {'#base': base + ' --dsjson --compressed --save_resume --preserve_performance_counters'}
 
-    namespaces = set()
-    marginals_grid = []
-    interactions_grid = []
-
-    for blob_index, blob in enumerate(AzureLogsProvider.iterate_blobs(bbs, app_container, start, end)):
-        blob_properties = bbs.get_blob_properties(app_container, blob.name).properties
-
-        current_time = datetime.datetime.now(datetime.timezone.utc)
-        if current_time - blob_properties.last_modified < datetime.timedelta(0, delta_mod_t):
-            max_connections = 1
-
-        start_range = 0
-        index = 0
-        while (start_range < blob_properties.content_length):
-            local_log_path = env.local_logs_provider.new_path(blob.name, index)
-
-            env.logger.info(blob.name + ': Downloading to ' + local_log_path)
-
-            end_range = start_range + LOG_CHUNK_SIZE
-            AzureLogsProvider.download_blob(
-                bbs,
-                app_container,
-                blob.name,
-                local_log_path,
-                start_range,
-                end_range,
-                max_connections
-            )
-
-            last_line_length = AzureLogsProvider.truncate_log(local_log_path)
-            start_range = end_range + 1 - last_line_length
-
-            env.logger.info(local_log_path + ': Done.')
-
-            if enable_sweep:
-                if (blob_index == 0 and index == 0):
-                    vw.check_vw_installed(env.logger)
-
-                    namespaces = preprocessing.extract_namespaces(open(local_log_path, 'r', encoding='utf-8'), log_type)
-
-                    marginals_grid = preprocessing.get_marginals_grid('#marginals', namespaces[2])
-
-                    interactions_grid = preprocessing.get_interactions_grid('#interactions', namespaces[0], namespaces[1])
+    def download_chunks():
+        # Downloads the logs in chunks of LOG_CHUNK_SIZE bytes truncated at the last complete line
+        for blob_index, blob in enumerate(AzureLogsProvider.iterate_blobs(bbs, app_container, start, end)):
+            blob_properties = bbs.get_blob_properties(app_container, blob.name).properties
+
+            connections = max_connections
+            current_time = datetime.datetime.now(datetime.timezone.utc)
+            if current_time - blob_properties.last_modified < datetime.timedelta(0, delta_mod_t):
+                connections = 1
+
+            start_range = 0
+            index = 0
+            while (start_range < blob_properties.content_length):
+                local_log_path = env.local_logs_provider.new_path(blob.name, index)
+
+                env.logger.info(blob.name + ': Downloading to ' + local_log_path)
+
+                end_range = start_range + LOG_CHUNK_SIZE
+                AzureLogsProvider.download_blob(
+                    bbs,
+                    app_container,
+                    blob.name,
+                    local_log_path,
+                    start_range,
+                    end_range,
+                    connections
+                )
+
+                last_line_length = AzureLogsProvider.truncate_log(local_log_path)
+                start_range = end_range + 1 - last_line_length
+
+                env.logger.info(local_log_path + ': Done.')
+                yield local_log_path, blob_index == 0 and index == 0
+
+                index += 1
+
+    def cache_chunk(chunk):
+        # Creates the VW cache of a chunk (and detects the namespaces in the first one). Returns the chunk with its
+        # cache file and namespaces
+        local_log_path, is_first = chunk
+        namespaces = None
+        if is_first:
+            vw.check_vw_installed(env.logger)
+            with open(local_log_path, 'r', encoding='utf-8') as f:
+                namespaces = preprocessing.extract_namespaces(f, log_type)
+            env.logger.info("namespaces: " + str(namespaces))
+        vw.cache(dict(base_command), env, local_log_path)
+        return local_log_path, env.caches_provider.new_path(local_log_path), namespaces
+
+    def summarize_chunk(chunk):
+        if log_type == 'cb':
+            env.local_logs_provider.get_metadata(chunk[0])
+
+    # Staged pipeline: the chunk k+1 is downloaded while the chunk k is cached and summarized, and the sweep trains on
+    # the caches as they are created. The queues between the stages are bounded by pipeline_depth chunks
+    p = pipeline.pipeline(env.logger)
+    p.source('download', download_chunks())
+    if enable_sweep:
+        p.stage('cache', cache_chunk, 'download', pipeline_depth)
+        p.stage('summary', summarize_chunk, 'cache', pipeline_depth)
+        cached_chunks = p.output('cache')
+    else:
+        p.stage('summary', summarize_chunk, 'download', pipeline_depth)
 
-                    env.logger.info("namespaces: " + str(namespaces))
-                vw.cache(base_command, env, local_log_path)
+    # the job pool workers are started before the pipeline threads: under MPI they are forked from this process
+    env.job_pool.start()
+    p.start()
 
-            index += 1
+    if enable_sweep:
+        first_chunk = next(cached_chunks, None)
+        if first_chunk is not None:
+            namespaces = first_chunk[2]
+            marginals_grid = preprocessing.get_marginals_grid('#marginals', namespaces[2])
+            interactions_grid = preprocessing.get_interactions_grid('#interactions', namespaces[0], namespaces[1])
+            multi_grid = grid.generate(interactions_grid, marginals_grid)
+            cache_files = (chunk[1] for chunk in itertools.chain([first_chunk], cached_chunks) if os.path.isfile(chunk[1]))
+            best = sweep.sweep(multi_grid, env, base_command, cache_files)
+        else:
+            best = {}
 
-            if log_type == 'cb':
-                env.local_logs_provider.get_metadata(local_log_path)
+    p.join()
 
     # Evaluate custom policies
     if summary_json:
@@ -139,9 +171,6 @@ def dashboard_e2e(args, delta_mod_t=3600, max_connections=50):
             env.logger.error(e)
 
     if enable_sweep:
-        multi_grid = grid.generate(interactions_grid, marginals_grid)
-        best = sweep.sweep(multi_grid, env, base_command)
-
         if log_type == 'ccb':
             predict_base = '--ccb_explore_adf'
         else:
@@ -157,6 +186,9 @@ def dashboard_e2e(args, delta_mod_t=3600, max_connections=50):
 
     local_dashboard_path = os.path.join(tmp_folder, 'dashboard.json')
     dashboard.create(local_dashboard_path, env, commands, enable_sweep, log_type)
+    # stops the job pool workers (started by the first training and reused since then)
+    env.close()
+
     if env.runtime.is_master() and output_connection_string:
         bbs = BlockBlobService(connection_string=output_connection_string)
         env.logger.info(output_container + ':' + output_path + ': Uploading from ' + local_dashboard_path)
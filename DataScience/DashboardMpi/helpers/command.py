@@ -35,6 +35,13 @@ def generalize(c):
     c.pop('-d', None)
 
 
+def cost(opts):
+    # Relative runtime of a command: each interaction (e.g., -q ab) adds the product of the features of its namespaces
+    # to every example, which dominates the parsing and learning time
+    args = to_commandline(opts).split()
+    return 1 + sum(args.count(x) for x in ['-q', '--quadratic', '--cubic', '--interactions'])
+
+
 def apply(first, second):
     return dict(first, **second)
 
@@ -1,8 +1,43 @@
+import collections
+import os
 import dashboard_utils
 
+
+def _day(log_path):
+    # local logs are data/<year>/<month>/<day>_<chunk index>.json
+    return os.path.join(os.path.dirname(log_path), os.path.basename(log_path).split('_')[0])
+
+
+def _merge(d1, d2):
+    if d1 is None:
+        return d2
+    if d2 is None:
+        return d1
+    return d1.merge(d2)
+
+
 def create(path, env, commands, enable_sweep, log_type):
-    d = {}
-    for log_path in env.local_logs_provider.list():
-        predictions = env.predictions_provider.list(log_path)
-        d = dashboard_utils.create_stats(log_path, log_type, d, predictions, is_summary=True, report_progress=False)
-    dashboard_utils.output_dashboard_data(d, path, commands)
+    # The days of logs are partitioned across the nodes (balanced by their size), and the aggregates of the nodes are
+    # merged on the master, which writes the dashboard. The days and their sizes are listed by the master and broadcast:
+    # every node must partition the same costs
+    days, costs = None, None
+    if env.runtime.is_master():
+        days = collections.OrderedDict()
+        for log_path in env.local_logs_provider.list():
+            days.setdefault(_day(log_path), []).append(log_path)
+        days = list(days.values())
+        costs = list(map(lambda logs: sum(map(os.path.getsize, logs)), days))
+    days, costs = env.runtime.bcast((days, costs))
+
+    d = None
+    for i in env.runtime.partition(costs):
+        for log_path in days[i]:
+            predictions = env.predictions_provider.list(log_path)
+            d = dashboard_utils.create_stats(log_path, log_type, d, predictions, is_summary=True, report_progress=False)
+
+    d = env.runtime.reduce_master(d, _merge)
+    if env.runtime.is_master():
+        # no events on any node: empty dashboard
+        if d is None:
+            d = dashboard_utils.BinAggregates()
+        dashboard_utils.output_dashboard_data(d, path, commands)
@@ -1,14 +1,16 @@
 import os
-from DashboardMpi.helpers import logger, runtime, pool
+from DashboardMpi.helpers import logger, pool
 from DashboardMpi.helpers.input_provider import CachesProvider, LocalLogsProvider, ModelsProvider, PredictionsProvider
 
 
 class Environment:
     def __init__(self, runtime_mode, procs, log_level, tmp_folder):
+        # runtime is imported here, not by this module: the job pool workers import this module to unpickle their
+        # task_environment, and must not import mpi4py (MPI_Init in processes not launched by mpirun)
+        from DashboardMpi.helpers import runtime
         rt = runtime.mpi() if runtime_mode == 'mpi' else runtime.local()
 
         self.runtime = rt
-        self.job_pool = pool.multiproc_pool(procs) if procs > 1 else pool.seq_pool()
         self.logger = logger.console_logger(rt.get_node_id(), log_level)
 
         self.local_logs_provider = LocalLogsProvider(
@@ -23,3 +25,28 @@ class Environment:
         self.predictions_provider = PredictionsProvider(
             os.path.join(tmp_folder, 'predictions')
         )
+
+        # under MPI the workers are forked, as before: a forkserver or spawned worker would import the main module,
+        # and so mpi4py, again
+        shared = task_environment(self)
+        if procs > 1:
+            self.job_pool = pool.multiproc_pool(procs, shared, start_method='fork' if runtime_mode == 'mpi' else None)
+        else:
+            self.job_pool = pool.seq_pool(shared)
+
+    def close(self):
+        self.job_pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class task_environment:
+    # What the job pool tasks use (vw._train and vw._predict), sent once to each worker: no runtime or job pool
+    def __init__(self, env):
+        self.logger = env.logger
+        self.models_provider = env.models_provider
+        self.predictions_provider = env.predictions_provider
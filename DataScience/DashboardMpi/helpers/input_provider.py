@@ -2,8 +2,10 @@ import datetime
 import glob
 import os
 import copy
+import shutil
 import ds_parse
 import json
+import vw_cache
 from DashboardMpi.helpers import command
 
 
@@ -23,6 +25,7 @@ class InputProvider:
 class CachesProvider(InputProvider):
     def __init__(self, folder, create=True):
         super().__init__(folder, create)
+        self.registry = vw_cache.CacheRegistry(os.environ.get('DS_VW_CACHE_DIR', os.path.join(folder, 'registry')))
 
     def list(self):
         pattern = os.path.join(self.folder, '*.cache')
@@ -34,6 +37,18 @@ class CachesProvider(InputProvider):
         cache_file_name = year + month + log_file_name
         return super().new_path(cache_file_name, 'cache')
 
+    def add(self, input_path, vw_args, build=vw_cache.run_vw):
+        # Links the registry cache of vw_args (built by build if missing) as the cache of input_path
+        cache_path = self.new_path(input_path)
+        registry_path = self.registry.get(vw_args, build)
+        if os.path.isfile(cache_path):
+            os.remove(cache_path)
+        try:
+            os.link(registry_path, cache_path)
+        except OSError:
+            shutil.copyfile(registry_path, cache_path)
+        return cache_path
+
 
 class LocalLogsProvider(InputProvider):
     def __init__(self, folder, create=True):
@@ -56,10 +71,11 @@ class LocalLogsProvider(InputProvider):
     def get_metadata(self, local_log_path):
         summary_path = local_log_path + '.summary'
 
-        for x in open(local_log_path, 'rb'):
-            if x.startswith(b'{"_label_cost":') and x.strip().endswith(b'}'):
-                data = ds_parse.json_cooked(x, do_decode=True)
-                with open(summary_path, 'a') as f:
+        with open(summary_path, 'a') as f:
+            for _, _, kind, data in ds_parse.iter_log_events(local_log_path):
+                if kind == ds_parse.LINE_COOKED:
+                    if data is not None:
+                        ds_parse.decode_cooked(data)
                     f.write(json.dumps(data)+'\n')
         os.remove(local_log_path)
         os.rename(summary_path, local_log_path)
@@ -0,0 +1,109 @@
+import queue
+import threading
+
+_END = object()
+
+
+class pipeline:
+    # Stages running in their own threads and connected by bounded queues, so that a stage works on item k+1 while the
+    # next stage works on item k, and a fast stage can't run more than maxsize items ahead of a slow one.
+    #   source(name, items): first stage, iterating items (e.g., a generator downloading the log chunks)
+    #   stage(name, func, input): calls func on the items of the stage input; its results (if not None) are the items of
+    #                             this stage
+    #   output(input): iterator over the items of the stage input, for the calling thread
+    # The stages start with start(). If a stage fails, the other stages stop and join() (or the output iterator) raises
+    # its exception
+    def __init__(self, logger):
+        self.logger = logger
+        self.stages = []
+        self.outputs = {}
+        self.errors = []
+        self.failed = threading.Event()
+        self.threads = []
+
+    def source(self, name, items):
+        self._add(name, lambda put: [put(x) for x in items])
+
+    def stage(self, name, func, input, maxsize=1):
+        q = self._connect(input, maxsize)
+
+        def body(put):
+            while True:
+                item = self._get(q)
+                if item is _END:
+                    return
+                result = func(item)
+                if result is not None:
+                    put(result)
+
+        self._add(name, body)
+
+    def output(self, input, maxsize=0):
+        return self._iterate(self._connect(input, maxsize))
+
+    def start(self):
+        for name, body in self.stages:
+            t = threading.Thread(target=self._run, args=(name, body), name=name, daemon=True)
+            t.start()
+            self.threads.append(t)
+
+    def join(self):
+        for t in self.threads:
+            t.join()
+        if self.errors:
+            raise self.errors[0]
+
+    def _iterate(self, q):
+        while True:
+            item = self._get(q)
+            if item is _END:
+                break
+            yield item
+        self.join()
+
+    def _add(self, name, body):
+        self.outputs[name] = []
+        self.stages.append((name, body))
+
+    def _connect(self, input, maxsize):
+        q = queue.Queue(maxsize)
+        self.outputs[input].append(q)
+        return q
+
+    def _run(self, name, body):
+        try:
+            body(lambda item: self._put_all(name, item))
+        except _Cancelled:
+            pass
+        except BaseException as e:
+            self.logger.error('[' + name + '] Failed: ' + repr(e))
+            self.errors.append(e)
+            self.failed.set()
+        finally:
+            try:
+                self._put_all(name, _END)
+            except _Cancelled:
+                pass
+
+    def _put_all(self, name, item):
+        for q in self.outputs[name]:
+            while True:
+                if self.failed.is_set():
+                    raise _Cancelled()
+                try:
+                    q.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+
+    def _get(self, q):
+        while True:
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                if self.failed.is_set():
+                    return _END
+
+
+class _Cancelled(Exception):
+    pass
@@ -1,21 +1,100 @@
 import multiprocessing
 
+# Read-only state shared by the tasks of a pool (e.g., the Environment), set once per worker instead of being pickled
+# with every task
+_shared = None
+
+
+def shared():
+    return _shared
+
+
+def _set_shared(value):
+    global _shared
+    _shared = value
+
 
 class seq_pool:
+    def __init__(self, shared=None):
+        self.shared = shared
+
     def map(self, task, inputs):
+        return self.map_async(task, inputs).get()
+
+    def map_async(self, task, inputs):
+        _set_shared(self.shared)
         result = []
         for i in inputs:
             result.append(task(i))
-        return result
+        return _done(result)
+
+    def start(self):
+        pass
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
 
 class multiproc_pool:
-    def __init__(self, procs):
+    # Worker processes started on the first map and reused until close(): each worker receives shared once, and the
+    # inputs are sent in batches of chunksize tasks (default: about 4 batches per worker). start_method: see _context
+    def __init__(self, procs, shared=None, chunksize=None, start_method=None):
         self.procs = procs
+        self.shared = shared
+        self.chunksize = chunksize
+        self.start_method = start_method
+        self.pool = None
 
     def map(self, task, inputs):
-        p = multiprocessing.Pool(self.procs)
-        result = p.imap_unordered(task, inputs)
-        p.close()
-        p.join()
-        return result
+        return self.map_async(task, inputs).get()
+
+    def map_async(self, task, inputs):
+        # returns immediately: the result (list, in any order) is returned by get()
+        inputs = list(inputs)
+        chunksize = self.chunksize or max(1, -(-len(inputs) // (4 * self.procs)))
+        return self._get_pool().map_async(task, inputs, chunksize)
+
+    def start(self):
+        # starts the workers now instead of on the first map, e.g., before this process starts other threads
+        self._get_pool()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _get_pool(self):
+        if self.pool is None:
+            self.pool = _context(self.start_method).Pool(self.procs, _set_shared, (self.shared,))
+        return self.pool
+
+
+class _done:
+    def __init__(self, result):
+        self.result = result
+
+    def get(self):
+        return self.result
+
+
+def _context(start_method=None):
+    # By default, the workers are not forked from this process, which may be running other threads (e.g., the
+    # dashboard_e2e pipeline): a child forked while another thread holds a lock (e.g., of stdout) could deadlock
+    if start_method in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context(start_method)
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
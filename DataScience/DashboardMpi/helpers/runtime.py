@@ -1,3 +1,5 @@
+import numpy as np
+
 try:
     from mpi4py import MPI
 except Exception as e:
@@ -5,13 +7,43 @@ except Exception as e:
     print('MPI mode is not supported')
 
 
+def _balance(costs, nodes):
+    # Longest processing time first: the most expensive elements are assigned first, each to the node with the lowest
+    # total cost so far (ties to the lowest node id). With equal costs this is the round robin by index
+    loads = [0] * nodes
+    assignment = [[] for _ in range(nodes)]
+    for i in sorted(range(len(costs)), key=lambda i: -costs[i]):
+        node = loads.index(min(loads))
+        loads[node] += costs[i]
+        assignment[node].append(i)
+    return [sorted(a) for a in assignment]
+
+
+def _top(ids, losses, k):
+    # (id, loss) of the k lowest losses
+    order = np.argsort(losses, kind='stable')[:k]
+    return [(int(ids[i]), float(losses[i])) for i in order]
+
+
 class local:
-    def map(self, elements):
+    def map(self, elements, cost=None):
         return elements
 
+    def partition(self, costs):
+        return list(range(len(costs)))
+
     def reduce(self, elements):
         return elements
 
+    def reduce_top(self, ids, losses, k):
+        return _top(np.asarray(ids, dtype=np.int64), np.asarray(losses, dtype=np.float64), k)
+
+    def reduce_master(self, element, merge):
+        return element
+
+    def bcast(self, element):
+        return element
+
     def is_master(self):
         return True
 
@@ -20,18 +52,55 @@ class local:
 
 
 class mpi:
-    def map(self, elements):
-        result = []
-        i = self.get_node_id()
-        step = MPI.COMM_WORLD.Get_size()
-        while i < len(elements):
-            result.append(elements[i])
-            i = i + step
-        return result
+    def map(self, elements, cost=None):
+        costs = [1] * len(elements) if cost is None else list(map(cost, elements))
+        return [elements[i] for i in self.partition(costs)]
+
+    def partition(self, costs):
+        # Indices of the elements of this node, balancing the total cost (e.g., predicted runtime) of the nodes. Every
+        # node must call it with the same costs
+        return _balance(costs, MPI.COMM_WORLD.Get_size())[self.get_node_id()]
 
     def reduce(self, elements):
         return MPI.COMM_WORLD.allreduce(elements, MPI.SUM)
 
+    def reduce_top(self, ids, losses, k):
+        # (id, loss) of the k lowest losses of all the nodes, on every node: only the (id, loss) arrays are gathered
+        # to the master, which broadcasts the top k
+        comm = MPI.COMM_WORLD
+        local_results = np.array([ids, losses], dtype=np.float64).T.ravel()
+        counts = comm.gather(local_results.size, root=0)
+        recv = None
+        if self.is_master():
+            displs = np.concatenate(([0], np.cumsum(counts)[:-1])).tolist()
+            buf = np.empty(sum(counts), dtype=np.float64)
+            recv = [buf, counts, displs, MPI.DOUBLE]
+        comm.Gatherv([local_results, MPI.DOUBLE], recv, root=0)
+        top = None
+        if self.is_master():
+            results = buf.reshape(-1, 2)
+            top = _top(results[:, 0].astype(np.int64), results[:, 1], k)
+        return comm.bcast(top, root=0)
+
+    def reduce_master(self, element, merge):
+        # element of each node merged by merge(element, element) in a binary tree: the master returns the result, the
+        # other nodes None
+        comm = MPI.COMM_WORLD
+        rank, size = comm.Get_rank(), comm.Get_size()
+        step = 1
+        while step < size:
+            if rank % (2 * step):
+                comm.send(element, dest=rank - step)
+                return None
+            if rank + step < size:
+                element = merge(element, comm.recv(source=rank + step))
+            step *= 2
+        return element
+
+    def bcast(self, element):
+        # element of the master, on every node
+        return MPI.COMM_WORLD.bcast(element, root=0)
+
     def is_master(self):
         return MPI.COMM_WORLD.Get_rank() == 0
 
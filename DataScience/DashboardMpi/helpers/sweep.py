@@ -28,27 +28,36 @@ def _output(candidates, grid_config, env):
     return result
 
 
-def _iteration(grid, env, promoted):
-    candidates = vw.train(grid.points, env)
+def _iteration(grid, env, promoted, cache_files=None):
+    # grid.points are the points of all the nodes: each node trains the points of its partition (balanced by their
+    # predicted cost), and only the ids and losses of the best candidates are reduced
+    ids = env.runtime.partition(list(map(command.cost, grid.points)))
+    candidates = vw.train([grid.points[i] for i in ids], env, cache_files)
     step_name = '[' + grid.config.name + '] '
-    env.logger.info(step_name + 'Local job is finished. Reducing...')
-    candidates = env.runtime.reduce(candidates)
     for c in candidates:
         env.logger.info(step_name + str(command.to_commandline(c[0])) +
                         ': ' + str(c[1]))
-    env.logger.info(step_name + 'All candidates are reduced.')
+    env.logger.info(step_name + 'Local job is finished. Reducing...')
+    results = list(zip(ids, map(lambda c: c[1], candidates)))
+    top = env.runtime.reduce_top([r[0] for r in results], [r[1] for r in results],
+                                 max(grid.config.promote, grid.config.output))
+    candidates = [(grid.points[i], loss) for i, loss in top]
+    env.logger.info(step_name + 'Best candidates are reduced.')
     return _promote(candidates, grid.config, env, promoted), _output(candidates, grid.config, env)
 
 
-def sweep(multi_grid, env, base_command={}):
+def sweep(multi_grid, env, base_command={}, cache_files=None):
+    # cache_files: iterable of the caches for the first grid, e.g., yielding them while they are created (the
+    # next grids use all the caches)
     base = [base_command]
     result = {}
     promoted = []
     for grid in multi_grid:
         step_name = '[' + grid.config.name + '] '
         env.logger.info(step_name + 'Started...')
-        grid.points = env.runtime.map(command.product(base, grid.points))
-        promoted, output = _iteration(grid, env, promoted)
+        grid.points = command.product(base, grid.points)
+        promoted, output = _iteration(grid, env, promoted, cache_files)
+        cache_files = None
         base = map(lambda p: p[0], promoted)
         result = dict(result, **output)
     return result
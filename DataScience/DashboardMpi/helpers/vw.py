@@ -1,7 +1,7 @@
 import sys
 import subprocess
 from subprocess import check_output
-from DashboardMpi.helpers import command
+from DashboardMpi.helpers import command, pool
 
 
 def _safe_to_float(str, default):
@@ -13,18 +13,11 @@ def _safe_to_float(str, default):
 
 def _cache(log_path, opts, env):
     opts['-d'] = log_path
-    opts['--cache_file'] = env.caches_provider.new_path(log_path)
-    return (opts, run(build_command(opts), env.logger))
-
-
-def _cache_func(input):
-    return _cache(input[0], input[1], input[2])
-
-
-def _cache_multi(opts, env, file_path):
-    input_files = [file_path]
-    inputs = list(map(lambda i: (i, opts, env), input_files))
-    return env.job_pool.map(_cache_func, inputs)
+    try:
+        opts['--cache_file'] = env.caches_provider.add(log_path, build_command(opts), lambda c: run(c, env.logger))
+    except RuntimeError as e:
+        env.logger.error(e)
+    return opts
 
 
 def _train(cache_path, opts, env):
@@ -35,7 +28,7 @@ def _train(cache_path, opts, env):
 
 
 def _train_func(input):
-    return _train(input[0], input[1], input[2])
+    return _train(input[0], input[1], pool.shared())
 
 
 def _update_opts(r):
@@ -48,16 +41,25 @@ def _process_result(r):
     return (r[0], r[1]["average loss"])
 
 
-def _train_multi(opts, env):
-    cache_files = env.caches_provider.list()
-    for index, cache in enumerate(cache_files):
-        inputs = list(map(lambda o: (cache, o, env), opts))
-        result = env.job_pool.map(_train_func, inputs)
-
-        if index == len(cache_files) - 1:
-            return list(map(_process_result, result))
-        else:
+def _train_multi(opts, env, cache_files=None):
+    # cache_files: iterable of the cache files in training order (default: all the caches), e.g., yielding the caches
+    # as they are created
+    if cache_files is None:
+        cache_files = env.caches_provider.list()
+    # the training on a cache is submitted before waiting for the next cache file (cache_files may be creating it)
+    result = None
+    pending = None
+    for cache in cache_files:
+        if pending is not None:
+            result = pending.get()
             opts = list(map(_update_opts, result))
+        inputs = list(map(lambda o: (cache, o), opts))
+        pending = env.job_pool.map_async(_train_func, inputs)
+
+    if pending is None:
+        return []
+    result = pending.get()
+    return list(map(_process_result, result))
 
 
 def _predict(cache_path, command_name, command, env):
@@ -67,14 +69,14 @@ def _predict(cache_path, command_name, command, env):
 
 
 def _predict_func(input):
-    return _predict(input[0], input[1], input[2], input[3])
+    return _predict(input[0], input[1], input[2], pool.shared())
 
 
 def _predict_multi(labeled_opts, env):
     cache_files = env.caches_provider.list()
     for c in cache_files:
         inputs = list(map(
-            lambda lo: (c, lo[0], lo[1], env), labeled_opts.items()))
+            lambda lo: (c, lo[0], lo[1]), labeled_opts.items()))
         labeled_opts = dict(env.job_pool.map(_predict_func, inputs))
         for k, v in labeled_opts.items():
             labeled_opts[k]['-i'] = v['-f']
@@ -110,14 +112,15 @@ def build_command(opts):
 
 
 def cache(opts, env, file_path):
-    _cache_multi(opts, env, file_path)
+    # runs in the calling thread (vw runs in a subprocess): dashboard_e2e caches a chunk while the next one downloads
+    _cache(file_path, opts, env)
     command.generalize(opts)
 
 
-def train(opts, env):
+def train(opts, env, cache_files=None):
     if not isinstance(opts, list):
         opts = [opts]
-    return _train_multi(opts, env)
+    return _train_multi(opts, env, cache_files)
 
 
 def predict(labeled_commands, env):
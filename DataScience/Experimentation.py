@@ -9,12 +9,15 @@ import itertools
 from enum import Enum
 import numpy as np
 import collections
+import time
+import vw_cache
 
 
 class Command:
     def __init__(self, base, cb_type=None, marginal_list=None, ignore_list=None, interaction_list=None, regularization=None, learning_rate=None, power_t=None, clone_from=None, name=None):
         self.base = base
         self.loss = np.inf
+        self.discarded = False
         self.name = 'N/A' if name is None else name
 
         if clone_from is not None:
@@ -66,6 +69,10 @@ class Command:
             self.full_command += " --l1 {:g}".format(self.regularization)
         self.full_command += " --power_t {:g}".format(self.power_t)
 
+    def get_data_file(self):
+        temp = self.base.split()
+        return temp[temp.index('-d')+1] if '-d' in temp else None
+
     def prints(self):
         print("cb type: {0}".format(self.cb_type))
         print("marginals: {0}".format(self.marginal_list))
@@ -86,9 +93,12 @@ def result_writer(command_list):
         experiment_file.write(line + "\n")
     experiment_file.flush()
 
+# VW caches of the commands that use one (-c): built once and shared with the other tools and the parallel workers
+vw_cache_registry = vw_cache.CacheRegistry()
+
 def run_experiment(command):
     try:
-        results = check_output(command.full_command.split(' '), stderr=STDOUT, universal_newlines=True)
+        results = vw_cache_registry.run(command.full_command, lambda x: check_output(x.split(' '), stderr=STDOUT, universal_newlines=True))
         loss_lines = [x for x in str(results).splitlines() if x.startswith('average loss = ')]
         if len(loss_lines) == 1:
             command.loss = float(loss_lines[0].split()[3])
@@ -99,18 +109,184 @@ def run_experiment(command):
         print("Error for command {}: {}".format(command.full_command, e))
     return command
 
-def run_experiment_set(command_list, n_proc, do_sort=True):
+def run_experiment_set(command_list, n_proc, do_sort=True, results_cache=None, prefix_files=None, halving_eta=3, budget=None, scheduler=None, on_idle=None):
     # Run the experiments in parallel using n_proc processes
-    p = multiprocessing.Pool(n_proc)
-    results = p.map(run_experiment, command_list)
+    # results_cache: ResultsCache with the losses of commands already run (they are not run again)
+    # budget: SearchBudget limiting the number of VW runs and the time of the sweep (commands beyond it are not run)
+    # scheduler: JobScheduler running the experiments in its workers instead of a new pool of n_proc processes
+    # on_idle: function called with the results available while some scheduler workers are idle before the end of the set
+    # prefix_files: files with growing prefixes of the data file of the commands. If set, the commands are first run on
+    #               each prefix and only the best 1/halving_eta of them are kept for the next prefix (successive halving).
+    #               The discarded commands are returned with loss = inf
+    if prefix_files:
+        command_list = successive_halving(command_list, n_proc, results_cache, prefix_files, halving_eta, budget, scheduler)
+
+    to_run = [x for x in command_list if x.loss == np.inf and not x.discarded and not (results_cache and results_cache.lookup(x))]
+    if budget:
+        # commands already submitted to the scheduler (speculatively) were already charged to the budget
+        submitted = [x for x in to_run if scheduler and scheduler.has_job(x)]
+        to_run = submitted + budget.take([x for x in to_run if not (scheduler and scheduler.has_job(x))])
+    if to_run:
+        if scheduler:
+            run_results = scheduler.run(to_run, on_idle)
+        else:
+            p = multiprocessing.Pool(n_proc)
+            run_results = p.map(run_experiment, to_run)
+            p.close()
+            p.join()
+            del p
+        run_results = {id(x): y for x,y in zip(to_run, run_results)}
+        results = [run_results.get(id(x), x) for x in command_list]
+        if results_cache:
+            results_cache.add([x for x in results if x not in command_list])
+    else:
+        results = list(command_list)
     if do_sort:
         results.sort(key=lambda result: result.loss)
-    p.close()
-    p.join()
-    del p
-    result_writer(results)
+    result_writer([x for x in results if not x.discarded])
     return results
 
+def successive_halving(command_list, n_proc, results_cache, prefix_files, halving_eta, budget=None, scheduler=None):
+    # Returns command_list where the commands discarded on the prefixes of the data are marked as discarded
+    candidates = list(range(len(command_list)))
+    for prefix_fp in prefix_files:
+        n_keep = max(1, int(np.ceil(len(candidates)/halving_eta)))
+        if n_keep == len(candidates):
+            break
+        prefix_commands = [Command(command_list[k].base.replace('-d '+command_list[k].get_data_file(), '-d '+prefix_fp), clone_from=command_list[k], name=command_list[k].name) for k in candidates]
+        print('Successive halving: testing {} commands on {}...'.format(len(prefix_commands), prefix_fp))
+        results = run_experiment_set(prefix_commands, n_proc, do_sort=False, results_cache=results_cache, budget=budget, scheduler=scheduler)
+        candidates = [candidates[k] for k in np.argsort([x.loss for x in results], kind='stable')[:n_keep]]
+    for k,command in enumerate(command_list):
+        command.discarded = k not in candidates
+    print('Successive halving: {} of {} commands kept'.format(len(candidates), len(command_list)))
+    return command_list
+
+def estimate_command_cost(command):
+    # Relative running time of command: size of its data file times the number of features groups it learns
+    data_fp = command.get_data_file()
+    size = os.path.getsize(data_fp) if data_fp and os.path.isfile(data_fp) else 1
+    return size*(1 + len(command.interaction_list) + 0.5*len(command.marginal_list))
+
+class JobScheduler:
+    # Pool of n_proc worker processes kept alive for the whole sweep. The commands of each set are queued longest first
+    # (see estimate_command_cost), so that the heaviest ones don't end last, and commands can be submitted speculatively
+    # (e.g., the next phase of the sweep) to use the workers that become idle at the end of a set
+    def __init__(self, n_proc):
+        self.n_proc = n_proc
+        self.pool = multiprocessing.Pool(n_proc)
+        self.jobs = {}
+
+    def has_job(self, command):
+        return command.full_command in self.jobs
+
+    def submit(self, command_list):
+        # Queues the commands (only once for each command line) and returns their jobs
+        for command in sorted(command_list, key=estimate_command_cost, reverse=True):
+            if command.full_command not in self.jobs:
+                self.jobs[command.full_command] = self.pool.apply_async(run_experiment, (command,))
+        return [self.jobs[x.full_command] for x in command_list]
+
+    def get_n_idle(self):
+        return max(0, self.n_proc - sum(1 for x in self.jobs.values() if not x.ready()))
+
+    def run(self, command_list, on_idle=None):
+        # Returns the results of command_list, calling on_idle(results available) while workers are idle before the end
+        jobs = self.submit(command_list)
+        for job in jobs:
+            while not job.ready():
+                job.wait(0.05)
+                if on_idle and self.get_n_idle() > 0:
+                    on_idle([x.get() for x in jobs if x.ready()])
+        return [x.get() for x in jobs]
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+class ResultsCache:
+    # Losses of the commands already run, persisted in fp (one json per line) and keyed on the normalized command line,
+    # where the data file is replaced by its fingerprint (size and hash of its first and last MB)
+    def __init__(self, fp):
+        self.fp = fp
+        self.losses = {}
+        self.fingerprints = {}
+        if os.path.isfile(fp):
+            with open(fp) as f:
+                for x in f:
+                    js = json.loads(x)
+                    self.losses[js['key']] = js['loss']
+        print('Loaded {} cached results from {}'.format(len(self.losses), fp))
+
+    def get_fingerprint(self, data_fp):
+        if data_fp not in self.fingerprints:
+            self.fingerprints[data_fp] = vw_cache.get_data_fingerprint(data_fp)
+        return self.fingerprints[data_fp]
+
+    def get_key(self, command):
+        # option groups (an option followed by its values) are sorted, so that the iteration order of the sets of command doesn't matter
+        groups = []
+        for x in command.full_command.split():
+            if x.startswith('-') or not groups:
+                groups.append([x])
+            else:
+                groups[-1].append(x)
+        for g in groups:
+            if g[0] in {'-d', '--data'} and len(g) == 2 and os.path.isfile(g[1]):
+                g[1] = self.get_fingerprint(g[1])
+            elif g[0] == '--marginal':
+                g[1:] = [''.join(sorted(y)) for y in g[1:]]
+        return ' '.join(sorted(' '.join(g) for g in groups))
+
+    def contains(self, command):
+        return self.get_key(command) in self.losses
+
+    def lookup(self, command):
+        # Sets the loss of command if it is cached
+        loss = self.losses.get(self.get_key(command))
+        if loss is None:
+            return False
+        command.loss = loss
+        print("Ave. Loss: {:12}Policy: {} (cached)".format(str(command.loss),command.full_command))
+        return True
+
+    def add(self, command_list):
+        with open(self.fp, 'a') as f:
+            for command in command_list:
+                if command.loss < np.inf:
+                    key = self.get_key(command)
+                    self.losses[key] = command.loss
+                    f.write(json.dumps({'key': key, 'loss': command.loss})+'\n')
+
+def create_prefix_files(log_fp, fractions):
+    # Creates (if missing or older than log_fp) the files with the first fraction of the lines of log_fp for each fraction
+    prefix_files = [log_fp+'.prefix{:g}.json'.format(x) for x in fractions]
+    to_create = [(x,fp) for x,fp in zip(fractions, prefix_files) if not os.path.isfile(fp) or os.path.getmtime(fp) < os.path.getmtime(log_fp)]
+    if not to_create:
+        return prefix_files
+    if log_fp.endswith('.gz'):
+        with gzip.open(log_fp, 'rb') as f:
+            tot_bytes = sum(len(x) for x in f)
+    else:
+        tot_bytes = os.path.getsize(log_fp)
+    print('Creating prefix files: {}'.format([fp for _,fp in to_create]))
+    outputs = [(x*tot_bytes, open(fp, 'wb')) for x,fp in to_create]
+    bytes_count = 0
+    with gzip.open(log_fp, 'rb') if log_fp.endswith('.gz') else open(log_fp, 'rb') as f:
+        for x in f:
+            for max_bytes,out in outputs:
+                if bytes_count >= max_bytes:
+                    out.close()
+            outputs = [y for y in outputs if not y[1].closed]
+            if not outputs:
+                break
+            for _,out in outputs:
+                out.write(x)
+            bytes_count += len(x)
+    for _,out in outputs:
+        out.close()
+    return prefix_files
+
 # Expects j_obj to have type 'dict' and ns_set to be a set (unique elements).
 # Returns a PropType object (defined below) to indicate whether basic properties
 # were found or marginal properties.
@@ -199,20 +375,141 @@ def identify_namespaces(log_fp, auto_lines, shared_features, action_features, ma
     return shared_features, action_features, marginal_features
 
 
+def get_greedy_command_list(base_command, best_command, interaction_list, shared_features, action_features):
+    # Commands adding one more interaction to interaction_list (starting from best_command)
+    command_list = []
+    for shared_feature in shared_features:
+        for action_feature in action_features:
+            interaction = '{0}{1}'.format(shared_feature, action_feature)
+            if interaction in interaction_list:
+                continue
+            command = Command(base_command, clone_from=best_command, interaction_list=set(interaction_list).union({interaction}))
+            command_list.append(command)
+    return command_list
+
 def get_hp_command_list(base_command, best_command, cb_types, marginal_features, learning_rates, regularizations, power_t_rates):
+    space = get_hp_space(cb_types, marginal_features, learning_rates, regularizations, power_t_rates)
+    return [get_hp_command(base_command, best_command, space, point) for point in itertools.product(*(range(len(x)) for x in space))]
+
+# Hyper-parameters space: list of the values of each dimension (marginal list, cb_type, learning rate, regularization,
+# power_t). A point of the space is a tuple with the index of the value in each dimension
+hp_space_ordinal = [False, False, True, True, True]     # numeric dimensions, with values sorted
+
+def get_hp_space(cb_types, marginal_features, learning_rates, regularizations, power_t_rates):
     marginal_lists = [set()]
     for marginal_feature in marginal_features:
         marginal_lists.append({marginal_feature})
+    return [marginal_lists, cb_types, learning_rates, regularizations, power_t_rates]
+
+def get_hp_command(base_command, best_command, space, point):
+    marginal_list, cb_type, learning_rate, regularization, power_t = (x[k] for x,k in zip(space, point))
+    return Command(base_command, clone_from=best_command, regularization=regularization, learning_rate=learning_rate, power_t=power_t, cb_type=cb_type, marginal_list=marginal_list)
+
+class GridSearch:
+    # Search strategies propose the next points of the hyper-parameters space to test (an empty list when the search is over)
+    # from the losses of the previous points. The grid search proposes all the points at once
+    def __init__(self, space):
+        self.points = list(itertools.product(*(range(len(x)) for x in space)))
+
+    def propose(self, n):
+        points, self.points = self.points[:n], self.points[n:]
+        return points
+
+    def update(self, points, losses):
+        pass
+
+class TpeSearch:
+    # Tree-structured Parzen Estimator: after n_startup random points, proposes the untested points that maximize l(x)/g(x),
+    # where l and g are the (per-dimension) Parzen densities of the best gamma fraction of the tested points and of the others
+    def __init__(self, space, ordinal=hp_space_ordinal, n_startup=10, gamma=0.25, seed=None):
+        self.shape = [len(x) for x in space]
+        self.ordinal = ordinal
+        self.n_startup = n_startup
+        self.gamma = gamma
+        self.rng = np.random.RandomState(seed)
+        self.tested = collections.OrderedDict()
+        self.pending = set()
+
+    def get_density(self, values, size, ordinal):
+        # Parzen density over the indexes of a dimension, with a uniform prior (weight of one point)
+        if ordinal:
+            bandwidth = max(1., size/(len(values)+1))
+            kernels = np.exp(-0.5*((np.arange(size)[:,None]-values[None,:])/bandwidth)**2)
+            weights = (kernels/kernels.sum(axis=0)).sum(axis=1)
+        else:
+            weights = np.bincount(values, minlength=size)
+        return (weights + 1/size)/(len(values) + 1)
+
+    def propose(self, n):
+        untested = [x for x in itertools.product(*(range(x) for x in self.shape)) if x not in self.tested and x not in self.pending]
+        if not untested:
+            return []
+        n = min(n, len(untested))
+        if len(self.tested) < self.n_startup:
+            selected = self.rng.choice(len(untested), n, replace=False)
+        else:
+            points = np.array(list(self.tested.keys()))
+            order = np.argsort(list(self.tested.values()), kind='stable')
+            n_good = max(1, int(np.ceil(self.gamma*len(order))))
+            good, bad = points[order[:n_good]], points[order[n_good:]]
+            candidates = np.array(untested)
+            score = self.rng.uniform(0, 1e-6, len(untested))   # random tie-breaking
+            for j,size in enumerate(self.shape):
+                score += np.log(self.get_density(good[:,j], size, self.ordinal[j])[candidates[:,j]])
+                score -= np.log(self.get_density(bad[:,j], size, self.ordinal[j])[candidates[:,j]])
+            selected = np.argsort(-score)[:n]
+        points = [untested[k] for k in selected]
+        self.pending.update(points)
+        return points
+
+    def update(self, points, losses):
+        for x,loss in zip(points, losses):
+            self.pending.discard(x)
+            self.tested[x] = loss
+
+hp_search_strategies = {'grid': GridSearch, 'tpe': TpeSearch}
+
+def run_hp_search(strategy, base_command, best_command, space, n_proc, max_runs, **sweep_args):
+    # Tests the points of space proposed by strategy (in sets of up to n_proc points, all at once for the grid search)
+    # until max_runs points are tested, the search is over, or the budget of the sweep is exhausted. Returns the results
+    # sorted by loss ([best_command] if no point was tested)
+    results = []
+    while len(results) < max_runs and not (sweep_args.get('budget') and sweep_args['budget'].is_over()):
+        points = strategy.propose(max_runs-len(results) if isinstance(strategy, GridSearch) else min(n_proc, max_runs-len(results)))
+        if not points:
+            break
+        command_list = run_experiment_set([get_hp_command(base_command, best_command, space, x) for x in points], n_proc, do_sort=False, **sweep_args)
+        strategy.update(points, [x.loss for x in command_list])
+        results += command_list
+    if not results:
+        # e.g., the budget was already exhausted: best_command is returned, so that the callers keep it
+        print('No hyperparameters tested (e.g., sweep budget exhausted): phase skipped.')
+        return [best_command]
+    results.sort(key=lambda result: result.loss)
+    return results
 
-    command_list = []
-    for marginal_list in marginal_lists:
-        for cb_type in cb_types:
-            for learning_rate in learning_rates:
-                for regularization in regularizations:
-                    for power_t in power_t_rates:
-                        command = Command(base_command, clone_from=best_command, regularization=regularization, learning_rate=learning_rate, power_t=power_t, cb_type=cb_type, marginal_list=marginal_list)
-                        command_list.append(command)
-    return command_list
+class SearchBudget:
+    # Total number of VW runs (max_runs) and time in seconds (max_time) of a sweep (0: no limit). The time is checked
+    # before each set of runs
+    def __init__(self, max_runs=0, max_time=0):
+        self.max_runs = max_runs
+        self.max_time = max_time
+        self.runs = 0
+        self.t0 = time.time()
+
+    def is_over(self):
+        return (self.max_runs > 0 and self.runs >= self.max_runs) or (self.max_time > 0 and time.time()-self.t0 >= self.max_time)
+
+    def take(self, command_list):
+        # Returns the commands of command_list that can be run within the budget
+        if self.is_over():
+            return []
+        if self.max_runs > 0:
+            command_list = command_list[:self.max_runs-self.runs]
+        self.runs += len(command_list)
+        if self.is_over():
+            print('Sweep budget exhausted: {} VW runs in {:.0f} sec.'.format(self.runs, time.time()-self.t0))
+        return command_list
 
 # Ensures validity and parse min_max_steps input
 def parse_min_max_steps(val):
@@ -284,6 +581,15 @@ def add_parser_args(parser):
     parser.add_argument('--q_bruteforce_terms', type=int, help="number of quadratic pairs to test in brute-force phase (default: 2)", default=2)
     parser.add_argument('--q_greedy_stop', type=int, help="rounds without improvements after which quadratic greedy search phase is halted (default: 3)", default=3)
     parser.add_argument('--generate_predictions', help="generate prediction files for best policies", action='store_true')
+    parser.add_argument('--results_cache', help="file where the losses of the commands are stored and reused by later sweeps on the same data (default: file_path+'.results_cache')", default='')
+    parser.add_argument('--no_results_cache', help="don't use the results cache", action='store_true')
+    parser.add_argument('--halving_min_fraction', type=float, help="enable successive halving: commands are first tested on data prefixes starting with this fraction of the data file (e.g., 0.1) and growing by halving_eta (default: 0 - disabled)", default=0)
+    parser.add_argument('--halving_eta', type=int, help="successive halving: the best 1/halving_eta of the commands are kept at each prefix (default: 3)", default=3)
+    parser.add_argument('--hp_search', choices=sorted(hp_search_strategies), help="search strategy over the hyper-parameters grid: grid (test all the points) or tpe (adaptive Tree-structured Parzen Estimator) (default: grid)", default='grid')
+    parser.add_argument('--hp_search_runs', type=int, help="number of points tested by the tpe search in each hyper-parameters phase (default: 50)", default=50)
+    parser.add_argument('--max_runs', type=int, help="total budget of VW runs of the sweep (default: 0 - no limit)", default=0)
+    parser.add_argument('--vw_cache_dir', help="folder of the VW caches shared by the tools (default: DS_VW_CACHE_DIR environment variable, or the folder of the data file)", default='')
+    parser.add_argument('--max_time', type=float, help="total budget of time of the sweep in minutes, checked before each set of runs (default: 0 - no limit)", default=0)
 
 def main(args):
     try:
@@ -293,6 +599,9 @@ def main(args):
         sys.exit()
 
     # Additional processing of inputs not covered by above
+    if args.vw_cache_dir:
+        # set in the environment, so that the workers use the same folder
+        os.environ['DS_VW_CACHE_DIR'] = args.vw_cache_dir
     base_command = args.base_command + ('-d ' if args.base_command[-1] == ' ' else ' -d ') + args.file_path
     
     # Shared and Action Features
@@ -318,7 +627,12 @@ def main(args):
     print('power_t rates: ['+', '.join(map(str,args.power_t_rates))+']')
     print()
     print('Hyper-parameters grid size: ',(len(marginal_features)+1)*len(args.cb_types)*len(args.learning_rates)*len(args.regularizations)*len(args.power_t_rates))
+    print('Hyper-parameters search: {}'.format(args.hp_search) + (' ({} runs per phase)'.format(args.hp_search_runs) if args.hp_search != 'grid' else ''))
+    if args.max_runs > 0 or args.max_time > 0:
+        print('Sweep budget: {} VW runs - {} minutes (0: no limit)'.format(args.max_runs, args.max_time))
     print('Parallel processes: {}'.format(args.n_proc))
+    if args.halving_min_fraction > 0:
+        print('Successive halving: min fraction {} - eta {}'.format(args.halving_min_fraction, args.halving_eta))
     print("***************************************")
     if __name__ == '__main__' and input('Press ENTER to start (any other key to exit)...' ) != '':
         sys.exit()
@@ -331,18 +645,36 @@ def main(args):
     t0 = datetime.now()
     best_commands = []
 
+    sweep_args = {'results_cache': None if args.no_results_cache else ResultsCache(args.results_cache or args.file_path+'.results_cache'),
+                  'scheduler': JobScheduler(args.n_proc)}
+    if args.max_runs > 0 or args.max_time > 0:
+        sweep_args['budget'] = SearchBudget(args.max_runs, args.max_time*60)
+    if args.halving_min_fraction > 0:
+        fractions = []
+        while args.halving_min_fraction*args.halving_eta**len(fractions) < 1:
+            fractions.append(args.halving_min_fraction*args.halving_eta**len(fractions))
+        sweep_args['prefix_files'] = create_prefix_files(args.file_path, fractions)
+        sweep_args['halving_eta'] = args.halving_eta
+
     print('\nRunning the base command...')
-    if ' -c ' not in base_command and os.path.exists(args.file_path+'.cache'):
+    if not vw_cache.uses_cache(base_command) and vw_cache_registry.lookup(base_command):
         input('Warning: Cache file found, but not used (-c not in CLI): this is unnesessarily slow. Press to continue anyway...')
-    best_command = run_experiment(Command(base_command))
+    best_command = Command(base_command)
+    if not (sweep_args['results_cache'] and sweep_args['results_cache'].lookup(best_command)):
+        if 'budget' in sweep_args:
+            sweep_args['budget'].take([best_command])
+        best_command = run_experiment(best_command)
+        if sweep_args['results_cache']:
+            sweep_args['results_cache'].add([best_command])
     best_commands.append(best_command)
     best_commands[-1].name = 'Base'
 
-    # cb_types, marginal, regularization, learning rates, and power_t rates grid search
-    command_list = get_hp_command_list(base_command, best_command, args.cb_types, marginal_features, args.learning_rates, args.regularizations, args.power_t_rates)
+    # cb_types, marginal, regularization, learning rates, and power_t rates search
+    space = get_hp_space(args.cb_types, marginal_features, args.learning_rates, args.regularizations, args.power_t_rates)
+    max_runs = np.prod([len(x) for x in space]) if args.hp_search == 'grid' else args.hp_search_runs
 
-    print('\nTesting {} different hyperparameters...'.format(len(command_list)))
-    results = run_experiment_set(command_list, args.n_proc)
+    print('\nTesting {} different hyperparameters...'.format(max_runs))
+    results = run_hp_search(hp_search_strategies[args.hp_search](space), base_command, best_command, space, args.n_proc, max_runs, **sweep_args)
     if results[0].loss < best_command.loss:
         best_command = results[0]
         best_commands.append(results[0])
@@ -365,7 +697,7 @@ def main(args):
                 command_list.append(command)
         
         print('\nTesting {} different interactions (brute-force phase)...'.format(len(command_list)))
-        results = run_experiment_set(command_list, args.n_proc)
+        results = run_experiment_set(command_list, args.n_proc, **sweep_args)
         if results[0].loss < best_command.loss:
             best_command = results[0]
             best_commands.append(results[0])
@@ -376,20 +708,24 @@ def main(args):
         print('\nTesting interactions (greedy phase)...')
         temp_interaction_list = set(best_command.interaction_list)
         rounds_without_improvements = 0
-        while rounds_without_improvements < args.q_greedy_stop:
-            command_list = []
-            for shared_feature in shared_features:
-                for action_feature in action_features:
-                    interaction = '{0}{1}'.format(shared_feature, action_feature)
-                    if interaction in temp_interaction_list:
-                        continue
-                    command = Command(base_command, clone_from=best_command, interaction_list=temp_interaction_list.union({interaction}))   # union() keeps temp_interaction_list unchanged
-                    command_list.append(command)
-            
+
+        def speculate_next_round(partial_results):
+            # Start the next round from the best result available, using the workers that are idle at the end of the round
+            scheduler = sweep_args['scheduler']
+            partial_best = min(partial_results+[best_command], key=lambda result: result.loss)
+            command_list = get_greedy_command_list(base_command, partial_best, partial_best.interaction_list, shared_features, action_features)
+            command_list = [x for x in command_list if not scheduler.has_job(x) and not (sweep_args['results_cache'] and sweep_args['results_cache'].contains(x))]
+            command_list = sorted(command_list, key=estimate_command_cost, reverse=True)[:scheduler.get_n_idle()]
+            if 'budget' in sweep_args:
+                command_list = sweep_args['budget'].take(command_list)
+            scheduler.submit(command_list)
+
+        while rounds_without_improvements < args.q_greedy_stop and not (sweep_args.get('budget') and sweep_args['budget'].is_over()):
+            command_list = get_greedy_command_list(base_command, best_command, temp_interaction_list, shared_features, action_features)
             if len(command_list) == 0:
                 break
 
-            results = run_experiment_set(command_list, args.n_proc)
+            results = run_experiment_set(command_list, args.n_proc, on_idle=speculate_next_round, **sweep_args)
             if results[0].loss < best_command.loss:
                 best_command = results[0]
                 best_commands.append(results[0])
@@ -399,11 +735,9 @@ def main(args):
                 rounds_without_improvements += 1
             temp_interaction_list = set(results[0].interaction_list)
 
-        # cb_types, marginal, regularization, learning rates, and power_t rates grid search
-        command_list = get_hp_command_list(base_command, best_command, args.cb_types, marginal_features, args.learning_rates, args.regularizations, args.power_t_rates)
-
-        print('\nTesting {} different hyperparameters...'.format(len(command_list)))
-        results = run_experiment_set(command_list, args.n_proc)
+        # cb_types, marginal, regularization, learning rates, and power_t rates search
+        print('\nTesting {} different hyperparameters...'.format(max_runs))
+        results = run_hp_search(hp_search_strategies[args.hp_search](space), base_command, best_command, space, args.n_proc, max_runs, **sweep_args)
         if results[0].loss < best_command.loss:
             best_command = results[0]
             best_commands.append(results[0])
@@ -411,6 +745,8 @@ def main(args):
 
         # TODO: Repeat above process of tuning parameters and interactions until convergence / no more improvements.
 
+    sweep_args['scheduler'].close()
+
     t1 = datetime.now()
     print("\n\n*************************")
     print("Best parameters found after {}:".format((t1-t0)-timedelta(microseconds=(t1-t0).microseconds)))
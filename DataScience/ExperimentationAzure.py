@@ -53,6 +53,7 @@ if __name__ == '__main__':
 
     parser.add_argument('--enable_sweep', help="run Experimentation.py", action='store_true')
     parser.add_argument("--procs", type=int, help="procs")
+    parser.add_argument("--pipeline_depth", type=int, help="log chunks queued between the download, cache, and summary stages (default: 2)", default=2)
 
     parser.add_argument("--output_connection_string", type=str, help="output connection_string")
     parser.add_argument("--output_container", type=str, help="output_container")
@@ -34,7 +34,7 @@ Emotion2^sadness:157471:-1.35735
 =====================================
 '''
 
-import os, argparse, sys
+import os, argparse, sys, vw_cache
 from subprocess import check_output, DEVNULL
 
 def get_pretty_feature(feature):
@@ -117,6 +117,10 @@ def get_feature_importance(log_file, ml_args, warmstart_model=None, min_num_feat
     os.system(vw_inv_hash_cmd)
     inv_hash = get_feature_inv_hash(invHash_fp)
 
+    # the readable models are trained on the shared VW cache of the log (built once, it doesn't have the feature names
+    # needed for the invert hash file)
+    cache_fp = vw_cache.CacheRegistry().get(vw_base)
+
     print('\n=====================================')
     print('Testing a range of L1 regularization')
     all_features_funnel = []
@@ -125,7 +129,7 @@ def get_feature_importance(log_file, ml_args, warmstart_model=None, min_num_feat
     while True:
         readModel_fp = log_file+'.readModel.{0}.txt'.format(index)
         vw_readable_model_cmd_base = vw_base + ' --readable_model {0}'.format(readModel_fp)
-        vw_readable_model_cmd = vw_readable_model_cmd_base + ' -c --l1 {0}'.format(l1)
+        vw_readable_model_cmd = vw_readable_model_cmd_base + ' --cache_file {0} --l1 {1}'.format(cache_fp, l1)
         index += 1
         os.system(vw_readable_model_cmd)
         features = extract_features(readModel_fp, inv_hash)
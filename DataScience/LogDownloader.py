@@ -3,17 +3,22 @@ if sys.maxsize < 2**32:     # check for 32-bit python version
     if input("32-bit python interpreter detected. There may be problems downloading large files. Do you want to continue anyway [Y/n]? ") not in {'Y', 'y'}:
         sys.exit()
 
-import os, time, datetime, argparse, gzip, shutil, ds_parse
+import os, time, datetime, argparse, shutil, ds_parse, blob_downloader, log_merge, gzip_utils
 try:
     from azure.storage.blob import BlockBlobService
 except ImportError as e:
-    print('ImportError: {}'.format(e))
-    if input("azure.storage.blob is required. Do you want to install it [Y/n]? ") in {'Y', 'y'}:
-        import pip
-        pip.main(['install', 'azure.storage.blob'])
-        print('Please re-run script.')
-    sys.exit()
-    
+    BlockBlobService = None     # only required when not using --local_blob_dir
+    azure_import_error = e
+
+def check_azure_import():
+    if BlockBlobService is None:
+        print('ImportError: {}'.format(azure_import_error))
+        if input("azure.storage.blob is required. Do you want to install it [Y/n]? ") in {'Y', 'y'}:
+            import pip
+            pip.main(['install', 'azure.storage.blob'])
+            print('Please re-run script.')
+        sys.exit()
+
 
 def valid_date(s):
     try:
@@ -21,28 +26,9 @@ def valid_date(s):
     except ValueError:
         raise argparse.ArgumentTypeError("Not a valid date: '{0}'. Expected format: YYYY-MM-DD".format(s))
         
-def cmp_files(f1, f2, start_range_f1=0, start_range_f2=0, erase_checkpoint_line=True):
-    with open(f1, 'rb+' if erase_checkpoint_line else 'rb') as fp1, open(f2, 'rb') as fp2:
-        if start_range_f1 != 0:
-            fp1.seek(start_range_f1, os.SEEK_SET if start_range_f1 > 0 else os.SEEK_END)
-        if start_range_f2 != 0:
-            fp2.seek(start_range_f2, os.SEEK_SET if start_range_f2 > 0 else os.SEEK_END)
-            
-        prev_b1 = b''
-        while True:
-            b1 = fp1.read(1)
-            if b1 != fp2.read(1):
-                # if erase_checkpoint_line=True and b1 != b2 only due to checkpoint info line, then data is still valid. Checkpoint info line is removed
-                if erase_checkpoint_line and prev_b1+b1 == b'\n[':
-                    fp1.seek(-2, os.SEEK_CUR)
-                    fp1.truncate()
-                    return True
-                return False
-            if not b1:
-                return True
-            prev_b1 = b1
-
 def erase_invalid_end_line(fp):
+    if os.path.getsize(fp) == 0:
+        return
     with open(fp,'rb+') as f:
         f.seek(-1, os.SEEK_END)
         pos = f.tell()
@@ -75,8 +61,12 @@ def add_parser_args(parser):
     0: create one gzip file for each LastConfigurationEditDate prefix
     1: create a unique gzip file by merging over file dates
     2: create a unique gzip file by uniquing over EventId and sorting by Timestamp''', default=-1)
+    parser.add_argument('--max_merge_memory', type=int, default=4096, help='memory in MB used to merge files in --create_gzip_mode 2; larger inputs are sorted on disk (default=4096)')
+    parser.add_argument('--temp_dir', help="dir for temporary files of --create_gzip_mode 2 (default: output dir)")
     parser.add_argument('--delta_mod_t', type=int, default=3600, help='time window in sec to detect if a file is currently in use (default=3600 - 1 hour)')
-    parser.add_argument('--max_connections', type=int, default=4, help='number of max_connections (default=4)')
+    parser.add_argument('--max_connections', type=int, default=8, help='number of concurrent byte range downloads, across all blobs (default=8)')
+    parser.add_argument('--chunk_size', type=int, default=32, help='size in MB of the byte ranges downloaded concurrently (default=32)')
+    parser.add_argument('--local_blob_dir', help="use a local directory as stand-in for the blob service (blobs are the files in local_blob_dir/container)")
     parser.add_argument('--verbose', help="print more details", action='store_true')
     parser.add_argument('--confirm', help="confirm before downloading", action='store_true')
     parser.add_argument('--report_progress', help="report progress while downloading", action='store_false')
@@ -96,7 +86,7 @@ def update_progress(current, total):
     sys.stdout.write(text)
     sys.stdout.flush()
 
-def download_container(app_id, log_dir, container=None, conn_string=None, account_name=None, sas_token=None, start_date=None, end_date=None, overwrite_mode=0, dry_run=False, version=2, verbose=False, create_gzip_mode=-1, delta_mod_t=3600, max_connections=4, confirm=False, report_progress=True, if_match=None, keep_invalid_eof=False, max_download_size=None):
+def download_container(app_id, log_dir, container=None, conn_string=None, account_name=None, sas_token=None, start_date=None, end_date=None, overwrite_mode=0, dry_run=False, version=2, verbose=False, create_gzip_mode=-1, delta_mod_t=3600, max_connections=8, confirm=False, report_progress=True, if_match=None, keep_invalid_eof=False, max_download_size=None, chunk_size=32, local_blob_dir=None, max_merge_memory=4096, temp_dir=None):
     t_start = time.time()
     if not container:
         container=app_id
@@ -150,14 +140,19 @@ def download_container(app_id, log_dir, container=None, conn_string=None, accoun
         
     else: # using BlockBlobService python api for cooked logs
         try:
-            print('Establishing Azure Storage BlockBlobService connection using ',end='')
-            if sas_token and account_name:
-                print('sas token...')
-                bbs = BlockBlobService(account_name=account_name, sas_token=sas_token)
+            if local_blob_dir:
+                print('Using local blob directory as blob service: {}'.format(local_blob_dir))
+                bbs = blob_downloader.LocalBlobService(local_blob_dir)
             else:
-                print('connection string...')
-                bbs = BlockBlobService(connection_string=conn_string)
-            # List all blobs and download them one by one
+                check_azure_import()
+                print('Establishing Azure Storage BlockBlobService connection using ',end='')
+                if sas_token and account_name:
+                    print('sas token...')
+                    bbs = BlockBlobService(account_name=account_name, sas_token=sas_token)
+                else:
+                    print('connection string...')
+                    bbs = BlockBlobService(connection_string=conn_string)
+            # List all blobs (blob properties are included in the listing) and download them concurrently
             print('Getting blobs list...')
             blobs = bbs.list_blobs(container)
         except Exception as e:
@@ -168,6 +163,7 @@ def download_container(app_id, log_dir, container=None, conn_string=None, accoun
             sys.exit()
 
         print('Iterating through blobs...\n')
+        downloader = blob_downloader.BlobDownloader(bbs, container, n_workers=max_connections, chunk_size=chunk_size*1024**2, if_match=if_match)
         selected_fps = []
         for blob in blobs:
             if '/data/' not in blob.name:
@@ -182,7 +178,7 @@ def download_container(app_id, log_dir, container=None, conn_string=None, accoun
                 continue
 
             try:
-                bp = bbs.get_blob_properties(container, blob.name)
+                bp = blob
 
                 if confirm:
                     if input("{} - Do you want to download [Y/n]? ".format(blob.name)) not in {'Y', 'y'}:
@@ -191,14 +187,17 @@ def download_container(app_id, log_dir, container=None, conn_string=None, accoun
 
                 fp = os.path.join(log_dir, app_id, blob.name.replace('/','_'))
                 selected_fps.append(fp)
-                if os.path.isfile(fp):
+                file_size = None
+                if blob_downloader.is_manifest_partial(fp):
+                    print('Partial download found: {}'.format(fp))
+                elif os.path.isfile(fp):
                     file_size = os.path.getsize(fp)
                     if overwrite_mode == 0:
                         if verbose:
                             print('{} - Skip: Output file already exits\n'.format(blob.name))
                         continue
                     elif overwrite_mode in {1, 3, 4}:
-                        if file_size == bp.properties.content_length: # file size is the same, skip!
+                        if file_size == bp.properties.content_length or blob_downloader.is_manifest_complete(fp, bp.properties.etag): # file size or ETag is the same, skip!
                             if verbose:
                                 print('{} - Skip: Output file already exits with same size\n'.format(blob.name))
                             continue
@@ -209,8 +208,6 @@ def download_container(app_id, log_dir, container=None, conn_string=None, accoun
                         if overwrite_mode == 1 and input("Do you want to overwrite [Y/n]? ") not in {'Y', 'y'}:
                             print()
                             continue
-                else:
-                    file_size = None
 
                 print('Processing: {} (size: {:.3f}MB - Last modified: {})'.format(blob.name, bp.properties.content_length/(1024**2), bp.properties.last_modified))
                 # check if blob was modified in the last delta_mod_t sec
@@ -222,48 +219,25 @@ def download_container(app_id, log_dir, container=None, conn_string=None, accoun
                     elif overwrite_mode == 4:
                         print('Azure blob currently in use (modified in the last delta_mod_t={} sec). Skipping!\n'.format(delta_mod_t))
                         continue
-                    if if_match != '*':     # when if_match is not '*', reset max_connections to 1 to prevent crash if azure blob is modified during download
-                        max_connections = 1
 
                 if dry_run:
                     print('--dry_run - Not downloading!')
+                elif overwrite_mode in {3, 4} and file_size:
+                    if max_download_size is None or file_size < max_download_size:
+                        if not downloader.add(bp, fp, end=max_download_size, append=True):
+                            continue
                 else:
-                    t0 = time.time()
-                    process_checker = update_progress if report_progress == True else None
-                    if overwrite_mode in {3, 4} and file_size:
-                        if max_download_size is None or file_size < max_download_size:
-                            print('Check validity of remote file... ', end='')
-                            temp_fp = fp + '.temp'
-                            cmpsize = min(file_size,8*1024**2)
-                            bbs.get_blob_to_path(container, blob.name, temp_fp, max_connections=max_connections, start_range=file_size-cmpsize, end_range=file_size-1, if_match=if_match)
-                            if cmp_files(fp, temp_fp, -cmpsize):
-                                print('Valid!')
-                                print('Resume downloading to temp file with max_connections = {}...'.format(max_connections))
-                                bbs.get_blob_to_path(container, blob.name, temp_fp, progress_callback=process_checker, max_connections=max_connections, start_range=os.path.getsize(fp), if_match=if_match, end_range=max_download_size)
-                                download_time = time.time()-t0
-                                download_size_MB = os.path.getsize(temp_fp)/(1024**2) # file size in MB
-                                print('\nAppending to local file...')
-                                with open(fp, 'ab') as f1, open(temp_fp, 'rb') as f2:
-                                    shutil.copyfileobj(f2, f1, length=100*1024**2)   # writing chunks of 100MB to avoid consuming memory
-                                print('Appending completed. Deleting temp file...')
-                                os.remove(temp_fp)
-                            else:
-                                os.remove(temp_fp)
-                                print('Invalid! - Skip\n')
-                                continue
-                            print('Downloaded {:.3f} MB in {:.1f} sec. ({:.3f} MB/sec) - Total elapsed time: {:.1f} sec.'.format(download_size_MB, download_time, download_size_MB/download_time, time.time()-t0))
-                    else:
-                        print('Downloading with max_connections = {}...'.format(max_connections))
-                        bbs.get_blob_to_path(container, blob.name, fp, progress_callback=process_checker, max_connections=max_connections, if_match=if_match, start_range=0, end_range=max_download_size)
-                        download_time = time.time()-t0
-                        download_size_MB = os.path.getsize(fp)/(1024**2) # file size in MB
-                        print('\nDownloaded {:.3f} MB in {:.1f} sec. ({:.3f} MB/sec)'.format(download_size_MB, download_time, download_size_MB/download_time))
-                    if not keep_invalid_eof:
-                        erase_invalid_end_line(fp)
-                    print()
+                    downloader.add(bp, fp, end=max_download_size)
+                print()
             except Exception as e:
                 print('Error: {}'.format(e))
 
+        if not dry_run:
+            print('Downloading with max_connections = {}...'.format(max_connections))
+            failed_fps = downloader.run(report_progress, on_complete=None if keep_invalid_eof else erase_invalid_end_line)
+            selected_fps = [x for x in selected_fps if x not in failed_fps]
+            print()
+
         if create_gzip_mode > -1:
             if selected_fps:
                 selected_fps = [x for x in selected_fps if os.path.isfile(x)]
@@ -282,7 +256,7 @@ def download_container(app_id, log_dir, container=None, conn_string=None, accoun
                         if dry_run:
                             print('--dry_run - Not downloading!')
                         else:
-                            with gzip.open(output_fp, 'wb') as f_out:
+                            with gzip_utils.ParallelGzipWriter(output_fp) as f_out:
                                 for fp in models[model]:
                                     print('Adding: {}'.format(fp))
                                     with open(fp, 'rb') as f_in:
@@ -307,7 +281,7 @@ def download_container(app_id, log_dir, container=None, conn_string=None, accoun
                                 print('Adding: {}'.format(fp))
                             print('--dry_run - Not downloading!')
                         else:
-                            with gzip.open(output_fp, 'wb') as f_out:
+                            with gzip_utils.ParallelGzipWriter(output_fp) as f_out:
                                 for fp in selected_fps_merged:
                                     print('Adding: {}'.format(fp))
                                     with open(fp, 'rb') as f_in:
@@ -319,30 +293,7 @@ def download_container(app_id, log_dir, container=None, conn_string=None, accoun
                     output_fp = os.path.join(log_dir, app_id, app_id+'_deepmerged_data_'+start_date+'_'+end_date+'.json.gz')
                     print('Merge, unique, sort, and zip files of all LastConfigurationEditDate to: {}'.format(output_fp))
                     if not os.path.isfile(output_fp) or __name__ == '__main__' and input('Output file already exits. Do you want to overwrite [Y/n]? '.format(output_fp)) in {'Y', 'y'}:
-                        d = {}
-                        for fn in selected_fps:
-                            print('Parsing: {}'.format(fn), end='', flush=True)
-                            if not dry_run:
-                                for x in open(fn, 'rb'):
-                                    if x.startswith(b'{"_label_cost') and x.strip().endswith(b'}'):     # reading only cooked lined
-                                        data = ds_parse.json_cooked(x)
-                                        if data is not None and (data['ei'] not in d or float(data['cost']) < d[data['ei']][1]): # taking line with best reward
-                                            d[data['ei']] = (data['ts'], float(data['cost']), x)
-                            print(' - len(d): {}'.format(len(d)))
-
-                        print('Writing to output .gz file...')
-                        if dry_run:
-                            print('--dry_run - Not downloading!')
-                        else:
-                            with gzip.open(output_fp, 'wb') as f:
-                                i = 0
-                                for x in sorted(d.values(), key=lambda x : x[0]):                       # events are sorted by timestamp
-                                    f.write(x[2])
-                                    i += 1
-                                    if i % 5000 == 0:
-                                        update_progress(i, len(d))
-                                update_progress(i, len(d))
-                                print()
+                        log_merge.deep_merge(selected_fps, output_fp, max_memory=max_merge_memory*1024**2, temp_dir=temp_dir, dry_run=dry_run)
                 else:
                     print('Unrecognized --create_gzip_mode: {}, skipping creating gzip files.'.format(create_gzip_mode))
             else:
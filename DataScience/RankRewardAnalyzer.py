@@ -1,5 +1,6 @@
-import requests, time, json, os, argparse, sys, collections, ds_parse, gzip
+import requests, time, json, os, argparse, sys, collections, ds_parse
 import matplotlib.pyplot as plt
+import numpy as np
 
 
 def scantree(path):
@@ -65,6 +66,10 @@ def send_rank_and_rewards(base_url, app, local_fp, feed=None, iter_num=1000, tim
             
     return eventIds
 
+def format_ts(ts):
+    # Timestamp as in the columnar cache (microseconds, no timezone), so that the output doesn't depend on the cache
+    return np.datetime_as_string(np.datetime64(bytes(ts).decode().rstrip('Z')[:26], 'us'), unit='us')
+
 def print_stats(local_fp, azure_path, verbose=False, plot_hist=False, hist_bin=100):
 
     t = time.time()
@@ -109,31 +114,42 @@ def print_stats(local_fp, azure_path, verbose=False, plot_hist=False, hist_bin=1
 
     ei_miss_local = 0
     azure_data = []
+    def add_azure_event(ei, c, ts):
+        nonlocal ei_miss_local
+        azure_data.append((ei, c))
+        if ei not in gt:
+            ei_miss_local += 1
+            if verbose:
+                verbose_output.append('Idx: {} - EventId: {} - Ranking missing from Local'.format(len(azure_data),ei))
+        else:
+            gt[ei].setdefault('azure_data',[]).append((c, ts))
+
     for ii,azure_fp in enumerate(files):
         bytes_count = 0
-        tot_bytes = os.path.getsize(azure_fp)
-        for i,x in enumerate(gzip.open(azure_fp, 'rb') if azure_fp.endswith('.gz') else open(azure_fp, 'rb')):
-            bytes_count += len(x)
-            if (i+1) % 10000 == 0:
-                if azure_fp.endswith('.gz'):
-                    ds_parse.update_progress(i+1,prefix='File {}/{}: {} - '.format(ii+1,len(files),azure_fp))
-                else:
-                    ds_parse.update_progress(bytes_count,tot_bytes,'File {}/{}: {} - '.format(ii+1,len(files),azure_fp))
+        tot_bytes = ds_parse.get_log_size(azure_fp)
 
-            if x.startswith(b'{"_label_cost":'):
-                data = ds_parse.json_cooked(x)
-                if data is None:
-                    continue
-                ei = str(data['ei'], 'utf-8')
-                c = str(data['cost'], 'utf-8')
-                azure_data.append((ei, c))
-                if ei not in gt:
-                    ei_miss_local += 1
-                    if verbose:
-                        verbose_output.append('Idx: {} - EventId: {} - Ranking missing from Local'.format(len(azure_data),ei))
-                else:
-                    gt[ei].setdefault('azure_data',[]).append((c, data['ts']))
-        if azure_fp.endswith('.gz'):
+        # use the columnar cache of the file (see ds_parse.create_columnar_cache) when it is fresh
+        cols = ds_parse.load_columnar_cache(azure_fp, fields=['ei','cost','ts'])
+        if cols is not None:
+            for ei,c,ts in zip(cols['ei'].astype(str), cols['cost'], np.datetime_as_string(cols['ts'], unit='us')):
+                add_azure_event(ei, repr(float(c)), ts)
+            i = cols['n_lines']-1
+            bytes_count = cols['bytes_count']
+        else:
+            for i,x in enumerate(ds_parse.open_log(azure_fp)):
+                bytes_count += len(x)
+                if (i+1) % 10000 == 0:
+                    if tot_bytes is None:
+                        ds_parse.update_progress(i+1,prefix='File {}/{}: {} - '.format(ii+1,len(files),azure_fp))
+                    else:
+                        ds_parse.update_progress(bytes_count,tot_bytes,'File {}/{}: {} - '.format(ii+1,len(files),azure_fp))
+
+                if x.startswith(b'{"_label_cost":'):
+                    data = ds_parse.json_cooked(x)
+                    if data is None:
+                        continue
+                    add_azure_event(str(data['ei'], 'utf-8'), str(data['cost'], 'utf-8'), format_ts(data['ts']))
+        if tot_bytes is None:
             ds_parse.update_progress(i+1,prefix='File {}/{}: {} - '.format(ii+1,len(files),azure_fp))
         else:
             ds_parse.update_progress(bytes_count,tot_bytes,'File {}/{}: {} - '.format(ii+1,len(files),azure_fp))
@@ -1,104 +1,191 @@
 import sys
 import configparser
 import json
-import re 
+import re
 import os
 import os.path
+import mmap
+import hashlib
+import argparse
+import shlex
 import common
+import numpy as np
+from subprocess import run, DEVNULL, PIPE
+from multiprocessing.dummy import Pool
 from azure.storage.blob import BlockBlobService
 
-if __name__ == '__main__':
-    if len(sys.argv) < 4:
-        print("Start and end dates are expected. Example: python {0} <joined_data> <start_model> <num_models>".format(sys.argv[0]))
+# Replay of model checkpoints: each model of the day is retrained from the previous one on the events of its trackback
+# and compared with the online model. The training files of all models are built after a single pass over the joined
+# data, then the models are reproduced and compared independently on a pool of n_proc workers (vw runs in a subprocess)
+
+def read_trackback(trackback_filename):
+    model_id = None
+    ids = []
+    with open(trackback_filename, 'r', encoding='utf8') as trackback:
+        for id in trackback:
+            m = re.search('^modelid: (.+)$', id)
+            if m is not None:
+                model_id = m.group(1)
+                continue
+            ids.append(id.rstrip('\n'))
+    return model_id, ids
+
+def index_joined_data(joined_data, ids):
+    # byte offset of the events in ids (one pass over the joined data)
+    joined_data_index = {}
+    with open(joined_data, 'rb') as f:
+        pos = 0
+        for line in f:
+            evt = json.loads(line)
+            if evt.get('_eventid') in ids:
+                joined_data_index[evt['_eventid']] = pos
+            pos += len(line)
+    return joined_data_index
+
+def build_model_files(joined_data, models):
+    # Write the training file (model.json) of every model but the first. Returns the model id of each trackback
+    trackbacks = [read_trackback(os.path.join(m_dir, 'model.trackback')) for m_dir in models[1:]]
+    joined_data_index = index_joined_data(joined_data, {id for _, ids in trackbacks for id in ids})
+
+    model_ids = []
+    with open(joined_data, 'rb') as input:
+        for m_dir, (model_id, ids) in zip(models[1:], trackbacks):
+            for id in ids:
+                if id not in joined_data_index:
+                    raise ValueError('Unable to find "{0}" id in joined data'.format(id))
+            # read lines in file order (forward seeks only) and write them in trackback order
+            offsets = np.array([joined_data_index[id] for id in ids], dtype=np.int64)
+            lines = [None]*len(ids)
+            for i in np.argsort(offsets, kind='stable'):
+                input.seek(offsets[i])
+                lines[i] = input.readline()
+            with open(os.path.join(m_dir, 'model.json'), 'wb') as output:
+                output.writelines(lines)
+            model_ids.append(model_id)
+    return model_ids
+
+def run_vw(args):
+    # args: argument list (file paths are single arguments, even with spaces). Raises an exception with the vw error
+    # output if vw fails
+    res = run(args, stdout=DEVNULL, stderr=PIPE, universal_newlines=True)
+    if res.returncode != 0:
+        raise RuntimeError('{0} returned {1}: {2}'.format(' '.join(args), res.returncode, res.stderr.strip()))
+
+def strip_model(model, empty_file):
+    stripped = model + '.stripped'
+    run_vw(['vw', '--quiet', '--save_resume', '-i', model, '-f', stripped, '--readable_model', stripped + '.txt', '-d', empty_file])
+    return stripped
+
+def file_md5(fp):
+    with open(fp, 'rb') as f:
+        if os.path.getsize(fp) == 0:
+            return hashlib.md5().hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            return hashlib.md5(m).hexdigest()
+
+def first_mismatch(fp1, fp2):
+    # byte offset of the first difference between two files (None if they are equal), comparing memory-mapped views
+    size1, size2 = os.path.getsize(fp1), os.path.getsize(fp2)
+    n = min(size1, size2)
+    if n > 0:
+        x1 = np.memmap(fp1, dtype=np.uint8, mode='r', shape=(n,))
+        x2 = np.memmap(fp2, dtype=np.uint8, mode='r', shape=(n,))
+        chunksize = 16*1024**2
+        for pos in range(0, n, chunksize):
+            idx = np.flatnonzero(x1[pos:pos+chunksize] != x2[pos:pos+chunksize])
+            if len(idx) > 0:
+                return pos + int(idx[0])
+    return None if size1 == size2 else n
 
-    joined_data = sys.argv[1]
-    start_model = sys.argv[2]
-    num_models = int(sys.argv[3])
+def get_line_at(fp, offset):
+    with open(fp, 'rb') as f:
+        f.seek(offset)
+        start = offset
+        while start > 0:
+            f.seek(start-1)
+            if f.read(1) == b'\n':
+                break
+            start -= 1
+        f.seek(start)
+        return f.readline().decode('utf8', errors='replace').rstrip('\n')
+
+def compare_models(m1_stripped, m2_stripped):
+    # Returns None if the stripped models are equal, otherwise a description of the first mismatching weight (line of
+    # the readable models)
+    if os.path.getsize(m1_stripped) == os.path.getsize(m2_stripped) and file_md5(m1_stripped) == file_md5(m2_stripped):
+        return None
+    m1_txt, m2_txt = m1_stripped + '.txt', m2_stripped + '.txt'
+    pos = first_mismatch(m1_txt, m2_txt)
+    if pos is None:
+        return 'binary models differ, readable models are equal'
+    return "first mismatch at byte {0}: '{1}' vs '{2}'".format(pos, get_line_at(m1_txt, pos) if pos < os.path.getsize(m1_txt) else '<EOF>',
+                                                               get_line_at(m2_txt, pos) if pos < os.path.getsize(m2_txt) else '<EOF>')
+
+def validate_model(m1_dir, m2_dir, model_id, online_args, empty_file):
+    # produce next model
+    m1_model = os.path.join(m1_dir, 'model')
+    m2_model = os.path.join(m2_dir, 'model')
+    m2_model_repro = os.path.join(m2_dir, 'model.repro')
+    joined_data_per_model = os.path.join(m2_dir, 'model.json')
+    try:
+        # online_args (TrainArguments of the online settings) is split as a shell would, so quoted values are kept
+        run_vw(['vw', '--quiet', '--json', '--save_resume', '--preserve_performance_counters', '--id', str(model_id)] + shlex.split(online_args) +
+               ['-d', joined_data_per_model, '-i', m1_model, '-f', m2_model_repro])
+
+        # produce comparable models
+        m2_model_stripped = strip_model(m2_model, empty_file)
+        m2_model_repro_stripped = strip_model(m2_model_repro, empty_file)
+    except Exception as e:
+        return m2_dir, 'vw failed for {0}: {1}'.format(m2_dir, e)
+
+    # run diff on model and model.repro
+    mismatch = compare_models(m2_model_stripped, m2_model_repro_stripped)
+    if mismatch is not None:
+        mismatch = 'Model mismatch {0} vs {1} - {2}. Compare {0}.txt and {1}.txt'.format(m2_model_stripped, m2_model_repro_stripped, mismatch)
+    return m2_dir, mismatch
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('joined_data', help="joined data file")
+    parser.add_argument('start_model', help="first model file (its directory is the first model directory)")
+    parser.add_argument('num_models', type=int, help="number of models to validate")
+    parser.add_argument('-n','--n_proc', type=int, help="number of models reproduced and compared in parallel (default: 1)", default=1)
+    args = parser.parse_args()
 
     config = configparser.ConfigParser()
     config.read('ds.config')
     ds = config['DecisionService']
     cache_folder = ds['CacheFolder']
-    block_blob_service = BlockBlobService(connection_string=self.config['AzureStorageAuthentication']['$Default'])
-    
-    joined_data_index = {}
+    block_blob_service = BlockBlobService(connection_string=config['AzureStorageAuthentication']['$Default'])
 
-    # index joined data
-    with open(joined_data, 'r', encoding='utf8') as f:
-        pos = f.tell()
-        line = f.readline()
-        while len(line) != 0:
-            evt = json.loads(line)
-            if '_eventid' in evt:
-                joined_data_index[evt['_eventid']] = pos
-            pos = f.tell()
-            line = f.readline()
-             
     # find model dirs
     models = []
-    start_model_dir = os.path.dirname(start_model)
+    start_model_dir = os.path.dirname(args.start_model)
     day_dir= os.path.abspath(os.path.join(start_model_dir,".."))
     model_dirs = os.listdir(day_dir)
     model_dirs.sort()
     for i in range(len(model_dirs)):
        model_dir = os.path.join(day_dir, model_dirs[i])
        if model_dir == start_model_dir:
-           for j in range(i, min(i + num_models, len(model_dirs))):
+           for j in range(i, min(i + args.num_models, len(model_dirs))):
                model_dir = os.path.join(day_dir, model_dirs[j])
                models.append(model_dir)
            break
 
     online_args = common.get_online_settings(block_blob_service, cache_folder)['TrainArguments']
 
-    with open('empty.txt', 'w'):
+    empty_file = os.path.abspath('empty.txt')
+    with open(empty_file, 'w'):
         print('Creating empty data file')
 
-    for i in range(len(models) - 1):
-        m1_dir = models[i]
-        m2_dir = models[i+1]
-
-        trackback_filename = os.path.join(m2_dir, 'model.trackback')
-        joined_data_per_model  = os.path.join(m2_dir, 'model.json')
-
-        with open(joined_data, 'r', encoding='utf8') as input:
-            with open(joined_data_per_model, 'w', encoding='utf8') as output:
-                with open(trackback_filename, 'r', encoding='utf8') as trackback:
-                    for id in trackback:
-                        m = re.search('^modelid: (.+)$', id)
-                        if m is not None:
-                            model_id = m.group(1)
-                            continue
-                        id = id.rstrip('\n')
-                        if id not in joined_data_index:
-                            raise ValueError('Unable to find "{0}" id in joined data'.format(id))
-                        input.seek(joined_data_index[id])
-                        line = input.readline()
-                        _ = output.write(line)
-
-        # produce next model    
-        m1_model = os.path.join(m1_dir, 'model')
-        m2_model = os.path.join(m2_dir, 'model')
-        m2_model_repro = os.path.join(m2_dir, 'model.repro')
-        os.system('vw --quiet --json --save_resume --preserve_performance_counters --id {0} {1} -d {2} -i {3} -f {4}'.format(model_id, online_args, joined_data_per_model, m1_model, m2_model_repro))
+    print('Creating training files of {0} models'.format(max(len(models)-1, 0)))
+    model_ids = build_model_files(args.joined_data, models)
 
-        # produce comparable models
-        m2_model_stripped = m2_model + '.stripped'
-        m2_model_repro_stripped = m2_model_repro + '.stripped'
-        os.system('vw --quiet --save_resume -i {0} -f {1} --readable_model {1}.txt -d empty.txt'.format(m2_model, m2_model_stripped))
-        os.system('vw --quiet --save_resume -i {0} -f {1} --readable_model {1}.txt -d empty.txt'.format(m2_model_repro, m2_model_repro_stripped))
-
-        # run diff on model.txt and model.repro.txt 
-        chunksize = 16*1024
-        pos = 0
-        with open(m2_model_stripped, "rb") as f1:
-            with open(m2_model_repro_stripped, "rb") as f2:
-                while True:
-                    chunk1 = f1.read(chunksize)
-                    chunk2 = f2.read(chunksize)
-                    if chunk1 != chunk2:
-                        print('Model mismatch {0} vs {1}. Compare {0}.txt and {1}.txt'.format(m2_model_stripped, m2_model_repro_stripped))
-                        break
-                    
-                    pos += chunksize
-                    if not (chunk1 or chunk2):
-                        break   
\ No newline at end of file
+    jobs = [(models[i], models[i+1], model_ids[i], online_args, empty_file) for i in range(len(models) - 1)]
+    n_mismatch = 0
+    with Pool(args.n_proc) as p:
+        for m2_dir, mismatch in p.imap(lambda x : validate_model(*x), jobs):
+            if mismatch is not None:
+                print(mismatch)
+                n_mismatch += 1
+    print('Validated {0} models: {1} mismatches'.format(len(jobs), n_mismatch))
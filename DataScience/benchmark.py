@@ -0,0 +1,191 @@
+import os, sys, io, time, json, shutil, argparse, tempfile, platform, contextlib, multiprocessing
+import ds_parse, dashboard_utils, dsjson_generator
+from DashboardMpi.helpers import preprocessing
+
+#########################################################################  BENCHMARKS OF THE HOT PATHS #########################################################################
+#
+# Throughput of the dsjson parsing and aggregation hot paths on synthetic cb and ccb corpora (see dsjson_generator):
+#   python benchmark.py --n_events 200000 --num_actions 10 --reward_rate 0.05 --save_baseline baseline.json
+#   python benchmark.py --baseline baseline.json        (exit code 1 if a benchmark is slower than the baseline)
+#
+# Each benchmark runs in a new process, so its peak RSS is not affected by the other ones. The reported time is the best
+# of --repeat runs and doesn't include the preparation of the inputs (e.g., parsing the lines for the aggregation paths).
+#
+#########################################################################################################################################################################
+
+def get_peak_rss_mb():
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak/1024**2 if sys.platform == 'darwin' else peak/1024      # bytes on macOS, KB on Linux
+    except ImportError:
+        import psutil
+        return psutil.Process().memory_info().peak_wset/1024**2
+
+def read_lines(fp, prefix):
+    return [x for x in open(fp, 'rb') if x.startswith(prefix)]
+
+def get_cb_summary(cfg):
+    # activated cb events as in the summary files of LocalLogsProvider.get_metadata (input of aggregates_cb_data)
+    data = [ds_parse.json_cooked(x, do_decode=True) for x in read_lines(cfg['cb_fp'], b'{"_label_cost":')]
+    return [json.loads(json.dumps(x)) for x in data if x is not None and not x['skipLearn']]
+
+def get_cb_aggregates(cfg):
+    d = dashboard_utils.BinAggregates()
+    for evts, data in enumerate(get_cb_summary(cfg)):
+        dashboard_utils.aggregates_cb_data(data, {}, d, evts)
+    return d
+
+def get_cb_contexts(cfg):
+    # (shared context, action set) of each cb event, as in preprocessing.extract_namespaces
+    res = []
+    for x in read_lines(cfg['cb_fp'], b'{"_label_cost":'):
+        context = json.loads(x)['c']
+        res.append((context, context.pop('_multi')))
+    return res
+
+def run_aggregates_cb(events):
+    d = dashboard_utils.BinAggregates()
+    for evts, data in enumerate(events):
+        dashboard_utils.aggregates_cb_data(data, {}, d, evts)
+    d.flush()
+
+def run_aggregates_ccb(events):
+    d = dashboard_utils.BinAggregates()
+    for evts, data in enumerate(events):
+        dashboard_utils.aggregates_ccb_data(data, {}, d, evts)
+    d.flush()
+
+def run_detect_namespaces(contexts):
+    shared, action, marginal = set(), set(), set()
+    for context, action_set in contexts:
+        preprocessing.detect_namespaces(context, shared, marginal)
+        for x in action_set:
+            preprocessing.detect_namespaces(x, action, marginal)
+
+def run_output_dashboard_data(d):
+    fd, fp = tempfile.mkstemp(suffix='.dash')
+    os.close(fd)
+    try:
+        dashboard_utils.output_dashboard_data(d, fp)
+    finally:
+        os.remove(fp)
+
+# name: (prepare(cfg) -> inputs, run(inputs), corpus: events and MB/sec are relative to the events and bytes of this corpus
+#        file, or to the input lines if None)
+benchmarks = {
+    'json_cooked':          (lambda cfg : read_lines(cfg['cb_fp'], b'{"_label_cost":'), lambda lines : [ds_parse.json_cooked(x) for x in lines], None),
+    'json_cooked_py':       (lambda cfg : read_lines(cfg['cb_fp'], b'{"_label_cost":'), lambda lines : [ds_parse.json_cooked_py(x) for x in lines], None),
+    'json_loads_cb':        (lambda cfg : read_lines(cfg['cb_fp'], b'{"_label_cost":'), lambda lines : [json.loads(x) for x in lines], None),
+    'json_dangling':        (lambda cfg : read_lines(cfg['cb_fp'], b'{"RewardValue"'), lambda lines : [ds_parse.json_dangling(x) for x in lines], None),
+    'json_dangling_py':     (lambda cfg : read_lines(cfg['cb_fp'], b'{"RewardValue"'), lambda lines : [ds_parse.json_dangling_py(x) for x in lines], None),
+    'ccb_json_cooked':      (lambda cfg : read_lines(cfg['ccb_fp'], b'{"Timestamp"'), lambda lines : [ds_parse.ccb_json_cooked(x) for x in lines], None),
+    'aggregates_cb_data':   (get_cb_summary, run_aggregates_cb, 'cb'),
+    'aggregates_ccb_data':  (lambda cfg : [ds_parse.ccb_json_cooked(x) for x in read_lines(cfg['ccb_fp'], b'{"Timestamp"')], run_aggregates_ccb, 'ccb'),
+    'output_dashboard_data':(get_cb_aggregates, run_output_dashboard_data, 'cb'),
+    'detect_namespaces':    (get_cb_contexts, run_detect_namespaces, 'cb'),
+    'process_dsjson_file':  (lambda cfg : cfg['cb_fp'], lambda fp : ds_parse.process_dsjson_file(fp, report_progress=False), 'cb'),
+    'process_dsjson_file_batch': (lambda cfg : cfg['cb_fp'], lambda fp : ds_parse.process_dsjson_file_batch(fp, report_progress=False), 'cb'),
+}
+
+def get_corpus_stats(fp):
+    # number of events (cooked lines) and size of a corpus file
+    prefix = b'{"Timestamp"' if fp.endswith('ccb.json') else b'{"_label_cost":'
+    return sum(1 for x in open(fp, 'rb') if x.startswith(prefix)), os.path.getsize(fp)
+
+def run_benchmark(name, cfg):
+    # Runs in a new process: returns the best time of cfg['repeat'] runs, throughput and peak RSS
+    prepare, run, corpus = benchmarks[name]
+    inputs = prepare(cfg)
+    if corpus is None:
+        n_events, n_bytes = len(inputs), sum(len(x) for x in inputs)
+    else:
+        n_events, n_bytes = cfg['corpus_stats'][corpus]
+    best = None
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(cfg['repeat']):
+            t0 = time.perf_counter()
+            run(inputs)
+            elapsed = time.perf_counter()-t0
+            best = elapsed if best is None else min(best, elapsed)
+    best = max(best, 1e-9)
+    return {'sec': best, 'events_per_sec': n_events/best, 'mb_per_sec': n_bytes/1024**2/best, 'peak_rss_mb': get_peak_rss_mb()}
+
+def run_benchmarks(cfg, names):
+    results = {}
+    ctx = multiprocessing.get_context('spawn')
+    for name in names:
+        with ctx.Pool(1) as p:
+            results[name] = p.apply(run_benchmark, (name, cfg))
+        print_result(name, results[name])
+    return results
+
+def print_result(name, res, base=None):
+    text = '{:<28}{:>14,.0f} ev/s{:>10.2f} MB/s{:>10.1f} MB RSS'.format(name, res['events_per_sec'], res['mb_per_sec'], res['peak_rss_mb'])
+    if base is not None:
+        text += '{:>10.2f}x'.format(res['events_per_sec']/base['events_per_sec'])
+    print(text)
+
+def compare_with_baseline(results, baseline, tolerance):
+    # Returns the names of the benchmarks slower than the baseline by more than tolerance
+    regressions = []
+    print('\nComparison with baseline (events/sec ratio):')
+    for name in results:
+        if name not in baseline['results']:
+            print('{:<28} not in baseline'.format(name))
+            continue
+        print_result(name, results[name], baseline['results'][name])
+        if results[name]['events_per_sec'] < (1-tolerance)*baseline['results'][name]['events_per_sec']:
+            regressions.append(name)
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n','--n_events', type=int, help="number of events of each corpus (default: 100000)", default=100000)
+    parser.add_argument('--num_actions', type=int, help="number of actions of each event (default: 4)", default=4)
+    parser.add_argument('--num_slots', type=int, help="number of slots of ccb events (default: 2)", default=2)
+    parser.add_argument('--reward_rate', type=float, help="fraction of rewarded events (default: 0.1)", default=0.1)
+    parser.add_argument('--seed', type=int, help="seed of the corpora (default: 0)", default=0)
+    parser.add_argument('--repeat', type=int, help="runs of each benchmark - the best time is reported (default: 3)", default=3)
+    parser.add_argument('-b','--benchmarks', nargs='+', help="benchmarks to run (default: all)", choices=list(benchmarks), default=list(benchmarks))
+    parser.add_argument('--save_baseline', help="save the results to this json file")
+    parser.add_argument('--baseline', help="compare the results with this json file (saved with --save_baseline)")
+    parser.add_argument('--tolerance', type=float, help="max slowdown vs. baseline before reporting a regression (default: 0.1)", default=0.1)
+    parser.add_argument('--temp_dir', help="folder of the synthetic corpora (default: system temp folder)")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    corpus = {'n_events': args.n_events, 'num_actions': args.num_actions, 'num_slots': args.num_slots, 'reward_rate': args.reward_rate, 'seed': args.seed}
+    if baseline is not None and baseline['corpus'] != corpus:
+        print('Warning: baseline corpus is different: {}'.format(baseline['corpus']))
+
+    temp_dir = tempfile.mkdtemp(prefix='dsjson_bench_', dir=args.temp_dir)
+    try:
+        cfg = {'cb_fp': os.path.join(temp_dir, 'cb.json'), 'ccb_fp': os.path.join(temp_dir, 'ccb.json'), 'repeat': args.repeat}
+        print('Generating corpora: {} events...'.format(args.n_events))
+        with open(cfg['cb_fp'], 'wb') as f:
+            f.writelines(dsjson_generator.generate_cb_lines(args.n_events, args.num_actions, args.reward_rate, args.seed))
+        with open(cfg['ccb_fp'], 'wb') as f:
+            f.writelines(dsjson_generator.generate_ccb_lines(args.n_events, args.num_actions, args.num_slots, args.reward_rate, args.seed))
+        cfg['corpus_stats'] = {'cb': get_corpus_stats(cfg['cb_fp']), 'ccb': get_corpus_stats(cfg['ccb_fp'])}
+
+        print('Parser backend: {} - Python {} - {}\n'.format(ds_parse.parser_backend, platform.python_version(), platform.platform()))
+        results = run_benchmarks(cfg, args.benchmarks)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump({'corpus': corpus, 'parser_backend': ds_parse.parser_backend, 'python': platform.python_version(), 'platform': platform.platform(), 'results': results}, f, indent=1)
+        print('\nBaseline saved: {}'.format(args.save_baseline))
+
+    if baseline is not None:
+        regressions = compare_with_baseline(results, baseline, args.tolerance)
+        if regressions:
+            print('\nRegressions (> {:.0%} slower): {}'.format(args.tolerance, ', '.join(regressions)))
+            sys.exit(1)
+        print('\nNo regressions')
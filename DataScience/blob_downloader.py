@@ -0,0 +1,239 @@
+import os, time, json, hashlib, datetime, types, concurrent.futures, ds_parse
+import numpy as np
+
+#########################################################################  CONCURRENT BLOB DOWNLOADS #########################################################################
+#
+# Blobs are split in byte ranges of chunk_size bytes that are fetched by a pool of threads, so several blobs and several
+# ranges of the same blob are in flight at once. Each output file fp has a json manifest (fp + '.manifest') storing:
+#   etag:     ETag of the blob when the download started
+#   start:    bytes of fp before start are already verified (e.g., appending to a file downloaded in a previous run)
+#   end:      target size of the download (blob size or max_download_size)
+#   done:     {range offset: md5} of the completed ranges in [start, end)
+#   complete: true when all ranges are done; done is then replaced by the final local file size
+# An interrupted download resumes exactly at the missing ranges, and the bytes already on disk are validated with the
+# manifest checksums. Appending to an existing file validates its tail by comparing md5 checksums of the local and
+# remote byte ranges (instead of comparing the files byte by byte).
+#
+# Any object with list_blobs(container) and get_blob_to_bytes(container, blob_name, start_range, end_range, if_match)
+# (as azure.storage.blob.BlockBlobService) can be used as blob service. LocalBlobService is a stand-in that serves the
+# files of a local directory, to test the downloader without a storage account.
+
+def get_manifest_fp(fp):
+    return fp + '.manifest'
+
+def load_manifest(fp):
+    try:
+        with open(get_manifest_fp(fp)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def save_manifest(fp, manifest):
+    # write to a temp file and rename it, so that an interrupted write never leaves a corrupted manifest
+    temp_fp = get_manifest_fp(fp) + '.temp'
+    with open(temp_fp, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(temp_fp, get_manifest_fp(fp))
+
+def get_file_md5(fp, start, end, block_size=8*1024**2):
+    md5 = hashlib.md5()
+    with open(fp, 'rb') as f:
+        f.seek(start)
+        while start < end:
+            b = f.read(min(block_size, end-start))
+            if not b:
+                break
+            md5.update(b)
+            start += len(b)
+    return md5.hexdigest()
+
+def find_first_mismatch(b1, b2):
+    x1 = np.frombuffer(b1, dtype=np.uint8)
+    x2 = np.frombuffer(b2, dtype=np.uint8)
+    n = min(len(x1), len(x2))
+    idx = np.flatnonzero(x1[:n] != x2[:n])
+    return int(idx[0]) if len(idx) > 0 else n
+
+def is_manifest_complete(fp, etag):
+    manifest = load_manifest(fp)
+    return manifest is not None and manifest['complete'] and manifest['etag'] == etag and os.path.isfile(fp) and os.path.getsize(fp) == manifest['file_size']
+
+def is_manifest_partial(fp):
+    manifest = load_manifest(fp)
+    return manifest is not None and not manifest['complete'] and os.path.isfile(fp)
+
+class LocalBlobService:
+    # Stand-in for BlockBlobService serving the files of root_dir/container: the blob name is the file path relative to
+    # the container directory and the ETag changes whenever the file is modified
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+
+    def get_path(self, container, blob_name):
+        return os.path.join(self.root_dir, container, *blob_name.split('/'))
+
+    def get_properties(self, fp):
+        st = os.stat(fp)
+        return types.SimpleNamespace(content_length=st.st_size, etag='"{}-{}"'.format(st.st_mtime_ns, st.st_size),
+                                     last_modified=datetime.datetime.fromtimestamp(st.st_mtime, datetime.timezone.utc))
+
+    def list_blobs(self, container):
+        container_dir = os.path.join(self.root_dir, container)
+        if not os.path.isdir(container_dir):
+            raise Exception('The specified container does not exist.')
+        for root, _, files in sorted(os.walk(container_dir)):
+            for fn in sorted(files):
+                fp = os.path.join(root, fn)
+                yield types.SimpleNamespace(name=os.path.relpath(fp, container_dir).replace(os.sep, '/'), properties=self.get_properties(fp))
+
+    def get_blob_properties(self, container, blob_name):
+        fp = self.get_path(container, blob_name)
+        return types.SimpleNamespace(name=blob_name, properties=self.get_properties(fp))
+
+    def get_blob_to_bytes(self, container, blob_name, start_range=None, end_range=None, if_match=None, **kwargs):
+        fp = self.get_path(container, blob_name)
+        if if_match not in {None, '*'} and if_match != self.get_properties(fp).etag:
+            raise Exception('The condition specified using HTTP conditional header(s) is not met.')
+        with open(fp, 'rb') as f:
+            start = start_range or 0
+            f.seek(start)
+            content = f.read() if end_range is None else f.read(end_range-start+1)
+        return types.SimpleNamespace(name=blob_name, content=content)
+
+class BlobDownloader:
+    def __init__(self, bbs, container, n_workers=8, chunk_size=32*1024**2, n_retries=3, if_match=None):
+        self.bbs = bbs
+        self.container = container
+        self.n_workers = n_workers
+        self.chunk_size = chunk_size
+        self.n_retries = n_retries
+        self.if_match = if_match
+        self.jobs = []
+
+    def get_range(self, blob_name, start, end):
+        # end is excluded
+        for i in range(self.n_retries):
+            try:
+                return self.bbs.get_blob_to_bytes(self.container, blob_name, start_range=start, end_range=end-1, if_match=self.if_match).content
+            except Exception as e:
+                if i == self.n_retries-1:
+                    raise
+                time.sleep(2**i)
+
+    def verify_tail(self, blob_name, fp, cmpsize=8*1024**2):
+        # Compare md5 of the last cmpsize bytes of fp with the same range of the blob. Return the size of the valid prefix
+        # of fp (None if the file is invalid). If fp differs only because its last line is a checkpoint info line, the
+        # valid prefix ends before that line
+        file_size = os.path.getsize(fp)
+        start = max(file_size-cmpsize, 0)
+        remote = self.get_range(blob_name, start, file_size)
+        if hashlib.md5(remote).hexdigest() == get_file_md5(fp, start, file_size):
+            return file_size
+        with open(fp, 'rb') as f:
+            f.seek(start)
+            local = f.read()
+        i = find_first_mismatch(local, remote)
+        if i > 0 and local[i-1:i+1] == b'\n[':
+            return start+i
+        return None
+
+    def add(self, blob, fp, end=None, append=False):
+        # Plan the download of blob to fp. Ranges already completed according to the manifest are not downloaded again.
+        # When append=True and fp exists without a manifest, its tail is verified and only the new bytes are downloaded.
+        # Returns False if fp can't be resumed or appended
+        etag = blob.properties.etag
+        end = blob.properties.content_length if end is None else min(end, blob.properties.content_length)
+        manifest = load_manifest(fp)
+        chunk_size = self.chunk_size
+        done = {}
+        if manifest is not None and not manifest['complete'] and os.path.isfile(fp):
+            start = manifest['start']
+            chunk_size = manifest['chunk_size']
+            # keep completed ranges that are unchanged by the new target size
+            done = {int(k): v for k,v in manifest['done'].items() if min(int(k)+chunk_size, manifest['end']) == min(int(k)+chunk_size, end)}
+            if done and manifest['etag'] != etag:
+                # the blob changed since the download started: keep completed ranges only if the last one is unchanged
+                last = max(done)
+                if hashlib.md5(self.get_range(blob.name, last, min(last+chunk_size, end))).hexdigest() != done[last]:
+                    print('Blob changed since last download - Restarting')
+                    start, done = 0, {}
+            # local ranges that don't match the manifest checksums are downloaded again
+            done = {k: v for k,v in done.items() if get_file_md5(fp, k, min(k+chunk_size, end)) == v}
+            print('Resuming download: {} of {} ranges already downloaded'.format(len(done), len(range(start, end, chunk_size))))
+        elif append and os.path.isfile(fp):
+            print('Check validity of remote file... ', end='')
+            start = self.verify_tail(blob.name, fp)
+            if start is None:
+                print('Invalid! - Skip\n')
+                return False
+            print('Valid!')
+        else:
+            start = 0
+
+        end = max(start, end)
+        if not done:
+            with open(fp, 'ab') as f:
+                f.truncate(start)
+        manifest = {'blob': blob.name, 'etag': etag, 'start': start, 'end': end, 'chunk_size': chunk_size, 'done': done, 'complete': False}
+        save_manifest(fp, manifest)
+        ranges = [x for x in range(start, end, chunk_size) if x not in done]
+        self.jobs.append((blob, fp, manifest, ranges))
+        return True
+
+    def download_range(self, blob_name, fp, start, end):
+        b = self.get_range(blob_name, start, end)
+        if len(b) != end-start:
+            raise Exception('Expected {} bytes at offset {}, got {}'.format(end-start, start, len(b)))
+        with open(fp, 'r+b') as f:
+            f.seek(start)
+            f.write(b)
+        return hashlib.md5(b).hexdigest(), len(b)
+
+    def run(self, report_progress=True, on_complete=None):
+        # Download all planned ranges. on_complete(fp) is called (in the main thread) when all ranges of fp are done,
+        # before marking its manifest complete. Returns the list of files whose download failed
+        t0 = time.time()
+        tot_bytes = sum(min(x+manifest['chunk_size'], manifest['end'])-x for _, _, manifest, ranges in self.jobs for x in ranges)
+        downloaded_bytes = 0
+        failed = []
+        pending = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.n_workers) as executor:
+            futures = {}
+            for blob, fp, manifest, ranges in self.jobs:
+                # extend the file to its final size, so that ranges can be written in any order
+                with open(fp, 'r+b') as f:
+                    f.truncate(manifest['end'])
+                pending[fp] = len(ranges)
+                for x in ranges:
+                    futures[executor.submit(self.download_range, blob.name, fp, x, min(x+manifest['chunk_size'], manifest['end']))] = (blob, fp, manifest, x)
+            for blob, fp, manifest, ranges in self.jobs:
+                if not ranges:
+                    self.complete(fp, manifest, on_complete)
+            for future in concurrent.futures.as_completed(futures):
+                blob, fp, manifest, x = futures[future]
+                try:
+                    md5, size = future.result()
+                    manifest['done'][x] = md5
+                    save_manifest(fp, manifest)
+                    downloaded_bytes += size
+                except Exception as e:
+                    if fp not in failed:
+                        print('\nError: {} - {}'.format(blob.name, e))
+                        failed.append(fp)
+                pending[fp] -= 1
+                if pending[fp] == 0 and fp not in failed:
+                    self.complete(fp, manifest, on_complete)
+                if report_progress and tot_bytes > 0:
+                    ds_parse.update_progress(downloaded_bytes, tot_bytes)
+        download_time = max(time.time()-t0, 1e-6)
+        if report_progress and tot_bytes > 0:
+            print()
+        print('Downloaded {:.3f} MB in {:.1f} sec. ({:.3f} MB/sec) using {} workers'.format(downloaded_bytes/(1024**2), download_time, downloaded_bytes/(1024**2)/download_time, self.n_workers))
+        self.jobs = []
+        return failed
+
+    def complete(self, fp, manifest, on_complete):
+        if on_complete:
+            on_complete(fp)
+        manifest.update({'complete': True, 'file_size': os.path.getsize(fp)})
+        del manifest['done']
+        save_manifest(fp, manifest)
@@ -9,6 +9,8 @@ import os.path
 import sys
 from multiprocessing.dummy import Pool
 from shutil import rmtree
+import collections
+import numpy as np
 
 def dates_in_range(start_date, end_date):
     num_days = (end_date - start_date).days
@@ -51,34 +53,46 @@ class CachedBlob:
                     os.remove(self.filename)
                     block_blob_service.get_blob_to_path(container, name, self.filename)
 
+class FileHandleCache:
+    # LRU cache of open (binary) file handles, to bound the number of open files when reading from many joined data files
+    def __init__(self, max_open=64):
+        self.max_open = max_open
+        self.handles = collections.OrderedDict()
+
+    def get(self, filename):
+        f = self.handles.pop(filename, None)
+        if f is None:
+            if len(self.handles) >= self.max_open:
+                self.handles.popitem(last=False)[1].close()
+            f = open(filename, 'rb')
+        self.handles[filename] = f
+        return f
+
+    def close(self):
+        for f in self.handles.values():
+            f.close()
+        self.handles.clear()
+
+open_files = FileHandleCache()
+
 class JoinedDataReader:
-    def __init__(self, joined_data):
-        self.file = None
+    # Reads events of a joined data file by seeking to their byte offset (see JoinedData.index)
+    def __init__(self, joined_data, handles=None):
         self.joined_data = joined_data
-        self.read_ahead = {}
+        self.handles = handles if handles is not None else open_files
+        self.offsets = None
 
     def read(self, eventid):
-        data = self.read_ahead.pop(eventid, None)
-        if data:
-            return data
-
-        if not self.file:
-            self.file = open(self.joined_data.filename, 'r', encoding='utf8')
-            
-        # read all events in file
-        ret = None
-        for line in self.file:
-            js = json.loads(line)
-            js_event_id = js['_eventid']
-            if (js_event_id == eventid):
-                ret = line
-            else:
-                self.read_ahead[js_event_id] = line
-
-        self.file.close()
-        self.file = None
+        if self.offsets is None:
+            # for duplicated event ids, the last line is returned
+            self.offsets = dict(zip((evt.evt_id for evt in self.joined_data.ids), self.joined_data.offsets.tolist()))
+        offset = self.offsets.get(eventid)
+        if offset is None:
+            return None
 
-        return ret
+        f = self.handles.get(self.joined_data.filename)
+        f.seek(offset)
+        return f.readline().decode('utf8')
 
 class Event:
     def __init__(self, ids):
@@ -95,19 +109,39 @@ class JoinedData(CachedBlob):
         self.blob = blob
         self.ts = ts
         self.ids = []
+        self.offsets = None
         self.data = []
 
     def index(self):
+        # .ids: event id (and model id) of each line; .offsets.npy: byte offset of each line
+        offsets_filename = self.filename + '.offsets.npy'
         if os.path.exists(self.filename + '.ids'):
             f = open(self.filename + '.ids', 'r', encoding='utf8')
             for line in f:
                 event_and_model_id = line.rstrip('\n').split(' ')
                 self.ids.append(Event(event_and_model_id))
             f.close()
+
+            if os.path.exists(offsets_filename):
+                self.offsets = np.load(offsets_filename)
+            if self.offsets is None or len(self.offsets) != len(self.ids):
+                # offsets of an existing .ids index: only line lengths are needed
+                offsets = []
+                pos = 0
+                with open(self.filename, 'rb') as f:
+                    for line in f:
+                        offsets.append(pos)
+                        pos += len(line)
+                self.offsets = np.array(offsets, dtype=np.int64)
+                np.save(offsets_filename, self.offsets)
         else:
+            offsets = []
+            pos = 0
             with open(self.filename + '.ids', 'w', encoding='utf8') as f_id:
-                with open(self.filename, 'r', encoding='utf8') as f:
+                with open(self.filename, 'rb') as f:
                     for line in f:
+                        offsets.append(pos)
+                        pos += len(line)
                         js = json.loads(line)
 
                         evt_id = js['_eventid']
@@ -123,6 +157,8 @@ class JoinedData(CachedBlob):
                         _ = f_id.write('\n')
 
                         self.ids.append(Event([evt_id, model_id]))
+            self.offsets = np.array(offsets, dtype=np.int64)
+            np.save(offsets_filename, self.offsets)
 
     def ips(self, policies):
         f = open(self.filename, 'r')
@@ -155,8 +191,8 @@ class JoinedData(CachedBlob):
             yield json.loads(line)
         f.close()
 
-    def reader(self):
-        return JoinedDataReader(self)
+    def reader(self, handles=None):
+        return JoinedDataReader(self, handles)
 
         
 def line_prepender(filename, line):
@@ -218,6 +254,9 @@ class DataSet:
         self.scoring_dir = os.path.join(self.cache_folder, 'scoring')
         os.makedirs(self.scoring_dir, exist_ok=True)
 
+        # open joined data files (see JoinedDataReader)
+        self.handles = FileHandleCache()
+
     def download_events(self):
         temp = []
 
@@ -240,7 +279,7 @@ class DataSet:
         with Pool(processes = 8) as p:
             self.data = p.map(lambda x:load_data(x[0], x[1]), self.joined)
             for jd in self.data:
-                reader = jd.reader()
+                reader = jd.reader(self.handles)
                 for evt in jd.ids:
                     # print("'{0}' <- {1}" .format(evt.evt_id, reader))
                     self.global_idx[evt.evt_id] = reader
@@ -263,6 +302,18 @@ class DataSet:
         online_settings_blob = CachedBlob(self.block_blob_service, self.cache_folder, 'mwt-settings', 'client')
         return json.load(open(online_settings_blob.filename, 'r', encoding='utf8'))
 
+    def iter_trackback_events(self, m):
+        # Yields the joined data lines of the events in m.trackback_ids, in trackback order: each line is read by seeking
+        # to its byte offset in its joined data file (open files are bounded by the LRU cache self.handles)
+        for event_id in m.trackback_ids:
+            reader = self.global_idx.get(event_id)
+            if reader is None:
+                self.missing_events_counter += 1
+                continue
+            line = reader.read(event_id)
+            if line:
+                yield line.strip() + ('\n')
+
     def create_files(self):
         for local_date in dates_in_range(self.start_date, self.end_date):
             scoring_dir_date = os.path.join(self.scoring_dir, local_date.strftime('%Y/%m/%d'))
@@ -272,7 +323,7 @@ class DataSet:
 
         ordered_joined_events = open(self.ordered_joined_events_filename, 'w', encoding='utf8')
         num_events_counter = 0
-        missing_events_counter = 0
+        self.missing_events_counter = 0
 
         model_history_withindaterange = filter(lambda x : x.ts.date() >= self.start_date, self.model_history)
         print('Creating {0} scoring models...'.format(len(list(model_history_withindaterange))))
@@ -287,51 +338,35 @@ class DataSet:
 
             if m.model_id is None:
                 # no modelid available, skipping scoring event creation
-                for event_id in m.trackback_ids:
-                    # print("'{0}'" .format(event_id))
-                    if event_id in self.global_idx:
-                        # print("found '{0}'" .format(event_id))    
-                        line = self.global_idx[event_id].read(event_id)
-                        if line:
-                            line = line.strip() + ('\n')
-                            _ = ordered_joined_events.write(line)
-                            num_events_counter += 1
-                            num_valid_events += 1
-                    else:
-                        missing_events_counter += 1
+                for line in self.iter_trackback_events(m):
+                    _ = ordered_joined_events.write(line)
+                    num_events_counter += 1
+                    num_valid_events += 1
             else:
-                for event_id in m.trackback_ids:
-                    if event_id in self.global_idx:
-                        line = self.global_idx[event_id].read(event_id)
-                        if line:
-                            line = line.strip() + ('\n')
-
-                            _ = ordered_joined_events.write(line)
-                            num_events_counter += 1
-                            num_valid_events += 1
-                        
-                            scoring_model_id = json.loads(line)['_model_id']
-                            if scoring_model_id is None:
-                                continue # this can happen at the very beginning if no model was available
-                        
-                            if scoring_model_id not in self.global_model_idx:
-                                continue # this can happen if the event was scored using a model that lies outside our model history
-                                                                        
-                            scoring_model = self.global_model_idx[scoring_model_id]
-                            if scoring_model.ts.date() >= self.start_date:
-    #                           the event was scored using a model which was generated prior to start_date
-    #                           so we can exclude it from scoring
-                                scoring_filename = os.path.join(self.scoring_dir, 
-                                                            scoring_model.ts.strftime('%Y'), 
-                                                            scoring_model.ts.strftime('%m'), 
-                                                            scoring_model.ts.strftime('%d'),
-                                                            scoring_model_id + '.json')
-                                                        
-                                # with open(scoring_filename, 'a', encoding='utf8') as scoring_file:
-                                #     _ = scoring_file.write(line)
-
-                    else:
-                        missing_events_counter += 1
+                for line in self.iter_trackback_events(m):
+                    _ = ordered_joined_events.write(line)
+                    num_events_counter += 1
+                    num_valid_events += 1
+
+                    scoring_model_id = json.loads(line)['_model_id']
+                    if scoring_model_id is None:
+                        continue # this can happen at the very beginning if no model was available
+
+                    if scoring_model_id not in self.global_model_idx:
+                        continue # this can happen if the event was scored using a model that lies outside our model history
+
+                    scoring_model = self.global_model_idx[scoring_model_id]
+                    if scoring_model.ts.date() >= self.start_date:
+#                       the event was scored using a model which was generated prior to start_date
+#                       so we can exclude it from scoring
+                        scoring_filename = os.path.join(self.scoring_dir, 
+                                                    scoring_model.ts.strftime('%Y'), 
+                                                    scoring_model.ts.strftime('%m'), 
+                                                    scoring_model.ts.strftime('%d'),
+                                                    scoring_model_id + '.json')
+
+                        # with open(scoring_filename, 'a', encoding='utf8') as scoring_file:
+                        #     _ = scoring_file.write(line)
 
                 if num_valid_events > 0:
                     scoring_model_filename = os.path.join(self.scoring_dir, 
@@ -343,6 +378,7 @@ class DataSet:
                     _ = ordered_joined_events.write(json.dumps({'_tag':'save_{0}'.format(scoring_model_filename)}) + ('\n'))
 
         ordered_joined_events.close()
+        self.handles.close()
 
     def train_models(self):
         model_history_prestart = list(filter(lambda x: x.ts.date() < self.start_date, self.model_history))
@@ -1,4 +1,4 @@
-import pandas,ds_parse,json,collections,os,gzip,sys
+import pandas,ds_parse,json,collections,os,sys,itertools
 import numpy as np
 import argparse
 import time
@@ -35,14 +35,99 @@ def get_prediction_prob(a0, pred_line):
     return pred_prob
 
 
-def output_dashboard_data(d, dashboard_file, commands={}, sep=':'):
+def parse_prediction_probs(text, a0):
+    # Vectorized get_prediction_prob for a block of prediction lines (bytes with one line for each action in a0)
+    # and an array of 0-index actions a0
+
+    buf = np.frombuffer(text, dtype=np.uint8)
+    line_ends = np.flatnonzero(buf == ord('\n'))
+    n_pairs = np.bincount(np.searchsorted(line_ends, np.flatnonzero(buf == ord(':'))), minlength=len(a0))
+    tokens = np.fromstring(text.replace(b':', b',').replace(b'\n', b','), dtype=np.float64, sep=',')
+    n_tokens = np.where(n_pairs > 0, 2*n_pairs, 1)
+    if len(line_ends) != len(a0) or n_tokens.sum() != len(tokens):
+        print('Error: Wrongly formatted predictions (expected {} lines): {}'.format(len(a0), text[:200]))
+        sys.exit()
+    token_line = np.repeat(np.arange(len(a0)), n_tokens)
+    pred_prob = np.zeros(len(a0))
+
+    # prediction file has only one action (as in --cb_adf -p)
+    single = n_pairs == 0
+    pred_prob[single] = tokens[(np.cumsum(n_tokens)-n_tokens)[single]] == a0[single]
+
+    # prediction file has pdf of all actions (as in --cb_explore_adf -p)
+    pairs = tokens[~single[token_line]].reshape(-1, 2)
+    rows = token_line[~single[token_line]][::2]
+    match = pairs[:,0] == a0[rows]
+    pred_prob[rows[match]] = pairs[match,1]
+
+    # pdf with a single action has probability 1
+    one = n_pairs == 1
+    if np.any(one):
+        if not np.all(match[one[rows]]):
+            k = rows[one[rows] & ~match][0]
+            print('Error: Prediction action does not match log file action ({}) - pred line: {}'.format(a0[k], k))
+            sys.exit()
+        pred_prob[one] = 1
+
+    return pred_prob
+
+
+class PredictionsReader:
+    # Reads the predictions files of policies (one non-empty line per event) in blocks aligned with the events of the log
+    def __init__(self, predictions_files):
+        self.files = [open(fp, 'rb') for fp in predictions_files]
+        self.n_read = [0]*len(self.files)
+
+    def read_lines(self, j, n):
+        lines = []
+        while len(lines) < n:
+            chunk = list(itertools.islice(self.files[j], n-len(lines)))
+            if not chunk:
+                break
+            text = b''.join(chunk)
+            if text.startswith((b'\n', b'\r\n')) or b'\n\n' in text or b'\n\r\n' in text:
+                chunk = [x for x in chunk if x.strip()]
+            lines += chunk
+        if lines and not lines[-1].endswith(b'\n'):
+            lines[-1] += b'\n'
+        self.n_read[j] += len(lines)
+        return lines
+
+    def skip(self, n):
+        for j in range(len(self.files)):
+            self.read_lines(j, n)
+
+    def get_probs(self, a0):
+        # Returns the (event, policy) matrix of the probabilities of the 0-index logged actions a0 for the next len(a0) events
+        pred_prob = np.empty((len(a0), len(self.files)))
+        for j in range(len(self.files)):
+            lines = self.read_lines(j, len(a0))
+            if len(lines) < len(a0):
+                self.check_length(self.n_read[j]-len(lines)+len(a0))
+            pred_prob[:,j] = parse_prediction_probs(b''.join(lines), a0)
+        return pred_prob
+
+    def check_length(self, evts):
+        lengths = [n + sum(1 for x in f if x.strip()) for n,f in zip(self.n_read, self.files)]
+        if any(x != evts for x in lengths):
+            print('Error: Prediction file length ({}) is different from number of events in log file ({})'.format(lengths, evts))
+            sys.exit()
+
+    def close(self):
+        for f in self.files:
+            f.close()
+
+
+def output_dashboard_data(d, dashboard_file, commands={}, sep=':', start_ts=None):
+    # d: BinAggregates
+    d.flush()
+    # start_ts: if set, only the windows that include bins from start_ts onward are written (the total is always written)
     data_dict = collections.OrderedDict()
-    for x in d:
-        for type in d[x]:
-            for field in d[x][type]:
-                data_dict.setdefault(type+sep+field, []).append(d[x][type][field])
+    for j,type in enumerate(d.policies):
+        for field in (online_fields if type == 'online' else aggregates_fields):
+            data_dict[type+sep+field] = d.data[:len(d), j, aggregates_fields.index(field)]
 
-    df = pandas.DataFrame(data_dict, index=pandas.to_datetime([x for x in d]), dtype=float)
+    df = pandas.DataFrame(data_dict, index=pandas.to_datetime(d.get_bins()), dtype=float).sort_index()
 
     df_col = collections.OrderedDict()
     for x in df.columns:
@@ -52,7 +137,8 @@ def output_dashboard_data(d, dashboard_file, commands={}, sep=':'):
     agg_windows = [('5T',5),('H',60),('6H',360),('D',1440)]
     with open(dashboard_file, 'a') as f:
         for ag in agg_windows:
-            for index, row in df.resample(ag[0]).agg({type+sep+field : max if field == 'c' else sum for type in df_col for field in df_col[type]}).replace(np.nan, 0.0).iterrows():
+            df_ag = df if start_ts is None else df[df.index >= pandas.Timestamp(start_ts).floor(ag[0])]
+            for index, row in df_ag.resample(ag[0]).agg({type+sep+field : max if field == 'c' else sum for type in df_col for field in df_col[type]}).replace(np.nan, 0.0).iterrows():
                 d = []
                 for type in df_col:
                     temp = collections.OrderedDict({field : row[type+sep+field] for field in df_col[type]})
@@ -95,14 +181,31 @@ def merge_and_unique_stats(stats_files, dashboard_file):
             if js['ts'] not in d or d[js['ts']]['online']['d'] < den or (d[js['ts']]['online']['d'] == den and d[js['ts']]['online']['n'] < num):
                 d[js['ts']] = {y['t'] : {field : y[field] for field in y if field not in {'w','t'}} for y in js['d']}
 
+    agg = BinAggregates()
+    for ts in d:
+        agg.update(np.array([ts[:16]], dtype='datetime64[m]'), list(d[ts]), np.array([[[d[ts][type].get(field, 0) for field in aggregates_fields] for type in d[ts]]]))
+
     print('Output dashboard data...')
-    output_dashboard_data(d, dashboard_file)
+    output_dashboard_data(agg, dashboard_file)
 
-def create_stats(log_fp, log_type='cb', d=None, predictions_files=None, is_summary=False, report_progress=True):
+def create_stats(log_fp, log_type='cb', d=None, predictions_files=None, is_summary=False, report_progress=True, checkpoint=None):
+    # checkpoint: if set, only the lines of log_fp after checkpoint['bytes_count'] are processed (the first checkpoint['evts']
+    #             predictions are skipped). checkpoint is then updated to the end of the last complete line of log_fp
 
     t0 = time.time()
     if d is None:
-        d = {}
+        d = BinAggregates()
+
+    start_byte = 0
+    end_byte = None
+    evts = 0
+    if checkpoint is not None:
+        start_byte = checkpoint.get('bytes_count', 0)
+        evts = checkpoint.get('evts', 0)
+        if not log_fp.endswith('.gz'):
+            end_byte = ds_parse.get_complete_lines_size(log_fp)
+            if end_byte == os.path.getsize(log_fp):
+                end_byte = None
 
     if predictions_files is None:
         print('Searching prediction files for log file: {}'.format(log_fp))
@@ -111,8 +214,9 @@ def create_stats(log_fp, log_type='cb', d=None, predictions_files=None, is_summa
             if fn.path.startswith(log_fp+'.') and fn.name.endswith('.pred'):
                 predictions_files.append(fn.path)
 
-    # load predictions from predictions_files
+    # load predictions from predictions_files (for cb logs, they are read in batches together with the log)
     pred = {}
+    pred_files = collections.OrderedDict()
     for pred_fp in predictions_files:
         if os.path.isfile(pred_fp):
             if is_summary:
@@ -120,7 +224,11 @@ def create_stats(log_fp, log_type='cb', d=None, predictions_files=None, is_summa
             else:
                 name = pred_fp.split('.')[-2] # check that policy name is encoded in file_name
             if name:
-                if log_type == 'cb':
+                if log_type == 'cb' and not is_summary:
+                    pred_files[name] = pred_fp
+                    print('Reading predictions from {}'.format(pred_fp))
+                    continue
+                elif log_type == 'cb':
                     pred[name] = [x.strip() for x in open(pred_fp) if x.strip()]
                 elif log_type == 'ccb':
                     with open(pred_fp) as f:
@@ -144,196 +252,305 @@ def create_stats(log_fp, log_type='cb', d=None, predictions_files=None, is_summa
         print('Error: Prediction file length ({}) must be equal for all files'.format([len(pred[name]) for name in pred]))
         sys.exit()
 
-    print('Processing: {}'.format(log_fp))
-    bytes_count = 0
-    tot_bytes = os.path.getsize(log_fp)
-    evts = 0
-    for i,x in enumerate(gzip.open(log_fp, 'rb') if log_fp.endswith('.gz') else open(log_fp, 'rb')):
-        if report_progress:
-            # display progress
-            bytes_count += len(x)
-            if (i+1) % 1000 == 0:
-                if log_fp.endswith('.gz'):
-                    ds_parse.update_progress(i+1)
+    print('Processing: {}'.format(log_fp) + (' from byte {}'.format(start_byte) if start_byte else ''))
+    bytes_count = start_byte
+    tot_bytes = ds_parse.get_log_size(log_fp)
+    evts0 = evts
+    i = -1
+    len_text = 0
+    if log_type == 'cb' and not is_summary:
+        # vectorized aggregation over the columns of batches of lines (or of the columnar cache of log_fp, when it is fresh)
+        pred_reader = PredictionsReader(pred_files.values())
+        pred_reader.skip(evts)
+        for cols in ds_parse.iter_columns(log_fp, start_byte=start_byte, end_byte=end_byte):
+            i += cols['n_lines']
+            bytes_count = cols['bytes_count']
+            if report_progress:
+                if tot_bytes is None:
+                    len_text = ds_parse.update_progress(i+1)
                 else:
-                    ds_parse.update_progress(bytes_count,tot_bytes)
+                    len_text = ds_parse.update_progress(bytes_count,tot_bytes)
 
-        data = None
+            # Skip not activated lines (wrongly formated lines are not in cols)
+            cols = ds_parse.batch_filter(cols, ~cols['skipLearn'])
 
-        if log_type == 'ccb':
-            if x.startswith(b'{"Timestamp"') and x.strip().endswith(b'}'):
-                data = ds_parse.ccb_json_cooked(x)
-                aggregates_ccb_data(data, pred, d, evts)
-
-        elif log_type == 'cb':
-            if is_summary:
+            # a-1: 0-index action
+            aggregates_cb_batch(cols, list(pred_files), pred_reader.get_probs(cols['a']-1), d)
+            evts += len(cols['a'])
+        pred_reader.check_length(evts)
+        pred_reader.close()
+    else:
+        file_input = ds_parse.open_log(log_fp, start_byte)
+        for x in file_input:
+            if end_byte is not None and bytes_count >= end_byte:
+                break
+            i += 1
+            bytes_count += len(x)
+            if report_progress:
+                # display progress
+                if (i+1) % 1000 == 0:
+                    if tot_bytes is None:
+                        len_text = ds_parse.update_progress(i+1)
+                    else:
+                        len_text = ds_parse.update_progress(bytes_count,tot_bytes)
+
+            data = None
+
+            if log_type == 'ccb':
+                if x.startswith(b'{"Timestamp"') and x.strip().endswith(b'}'):
+                    data = ds_parse.ccb_json_cooked(x)
+                    aggregates_ccb_data(data, pred, d, evts)
+
+            elif log_type == 'cb':
                 data = json.loads(x.decode("utf-8"))
-            elif x.startswith(b'{"_label_cost":') and x.strip().endswith(b'}'):
-                data = ds_parse.json_cooked(x, do_decode=True)
 
-            # Skip wrongly formated lines or not activated lines
-            if data is None or data['skipLearn']:
-                continue
+                # Skip not activated lines
+                if data['skipLearn']:
+                    continue
 
-            aggregates_cb_data(data, pred, d, evts)
-        evts += 1
+                aggregates_cb_data(data, pred, d, evts)
+            evts += 1
+        file_input.close()
 
     if report_progress:
-        if log_fp.endswith('.gz'):
-            len_text = ds_parse.update_progress(i+1)
-        else:
-            len_text = ds_parse.update_progress(bytes_count,tot_bytes)
         sys.stdout.write("\r" + " "*len_text + "\r")
         sys.stdout.flush()
 
-    print('Read {} lines - Processed {} events'.format(i+1, evts))
+    print('Read {} lines - Processed {} events'.format(i+1, evts-evts0))
 
     if any(len(pred[name]) != evts for name in pred):
         print('Error: Prediction file length ({}) is different from number of events in log file ({})'.format([len(pred[name]) for name in pred], evts))
         sys.exit()
+    d.flush()
+    if checkpoint is not None:
+        checkpoint['bytes_count'] = bytes_count
+        checkpoint['evts'] = evts
     print('Total Elapsed Time: {:.1f} sec.'.format(time.time()-t0))
     return d
 
 
-def aggregates_cb_data(data, pred, d, evts):
-    if data['cost'] == b'0':
-        r = 0
-        abs_r = 0
+def update_dashboard(log_fp, dashboard_file, log_type='cb', predictions_files=None, is_summary=False, state_fp=None):
+    # Incremental version of create_stats + output_dashboard_data for logs that are growing.
+    # The per-bin aggregates and the byte offset reached in log_fp are saved in state_fp (default: dashboard_file+'.state'):
+    # at each run only the lines appended to log_fp since the previous run are processed, and only the windows that
+    # include the updated bins are appended to dashboard_file (they supersede the previous lines of the same windows)
+    if state_fp is None:
+        state_fp = dashboard_file+'.state'
+
+    state = None
+    if os.path.isfile(state_fp):
+        state, d = load_dashboard_state(state_fp)
+        log_size = ds_parse.get_log_size(log_fp)
+        if state['log_fp'] != os.path.abspath(log_fp) or state['log_type'] != log_type:
+            print('State file {} is for a different log - Rebuilding'.format(state_fp))
+            state = None
+        elif log_size is not None and log_size < state['checkpoint']['bytes_count']:
+            print('Log file is smaller than its checkpoint ({} bytes) - Rebuilding'.format(state['checkpoint']['bytes_count']))
+            state = None
+    if state is None:
+        state = {'log_fp': os.path.abspath(log_fp), 'log_type': log_type, 'checkpoint': {}}
+        d = BinAggregates()
+
+    d_new = create_stats(log_fp, log_type, None, predictions_files, is_summary, checkpoint=state['checkpoint'])
+    if len(d_new) == 0:
+        print('No new events in {}'.format(log_fp))
+        return d
+
+    if len(d) > 0 and set(d.policies) != set(d_new.policies):
+        print('Policies differ from the ones in the state file - Rebuilding')
+        state['checkpoint'] = {}
+        d = create_stats(log_fp, log_type, None, predictions_files, is_summary, checkpoint=state['checkpoint'])
+        output_dashboard_data(d, dashboard_file)
     else:
-        r = -float(data['cost'])
-        abs_r = abs(r)
-
-    ############################### Aggregates for each bin ######################################
-    #
-    # 'n':   IPS of numerator
-    # 'N':   total number of samples in bin from log (IPS = n/N)
-    # 'd':   IPS of denominator (SNIPS = n/d)
-    # 'Ne':  number of samples in bin when off-policy agrees with log policy
-    # 'c':   max abs. value of numerator's items (needed for Clopper-Pearson confidence intervals)
-    # 'SoS': sum of squares of numerator's items (needed for Gaussian confidence intervals)
-    #
-    #################################################################################################
-
-    # binning timestamp every 5 min
-    ts_bin = get_ts_5min_bin(data['ts'])
-
-    # initialize aggregates for ts_bin
-    if ts_bin not in d:
-        d[ts_bin] = collections.OrderedDict([
-            ('online', {'n': 0, 'N': 0, 'd': 0}),
-            ('baseline1', {'n': 0., 'N': 0, 'd': 0., 'Ne': 0, 'c': 0., 'SoS': 0}),
-            ('baselineRand', {'n': 0., 'N': 0, 'd': 0., 'Ne': 0, 'c': 0., 'SoS': 0})
-        ])
-        for name in pred:
-            d[ts_bin][name] = {'n': 0., 'N': 0, 'd': 0., 'Ne': 0, 'c': 0., 'SoS': 0}
-
-    # update aggregates for online and baseline policies
-    d[ts_bin]['online']['d'] += 1
-    d[ts_bin]['online']['N'] += 1
-    d[ts_bin]['baselineRand']['N'] += 1
-    d[ts_bin]['baseline1']['N'] += 1
-
-    d[ts_bin]['baselineRand']['Ne'] += 1
-    d[ts_bin]['baselineRand']['d'] += 1/data['p']/data['num_a']
-    if data['a'] == 1:
-        d[ts_bin]['baseline1']['Ne'] += 1
-        d[ts_bin]['baseline1']['d'] += 1/data['p']
-
-    if r != 0:
-        d[ts_bin]['online']['n'] += r
-        d[ts_bin]['baselineRand']['n'] += r/data['p']/data['num_a']
-        d[ts_bin]['baselineRand']['c'] = max(d[ts_bin]['baselineRand']['c'], abs_r/data['p']/data['num_a'])
-        d[ts_bin]['baselineRand']['SoS'] += (r/data['p']/data['num_a'])**2
-        if data['a'] == 1:
-            d[ts_bin]['baseline1']['n'] += r/data['p']
-            d[ts_bin]['baseline1']['c'] = max(d[ts_bin]['baseline1']['c'], abs_r/data['p'])
-            d[ts_bin]['baseline1']['SoS'] += (r/data['p'])**2
-
-    # update aggregates for additional policies from predictions
-    for name in pred:
-        # a-1: 0-index action
-        pred_prob = get_prediction_prob(data['a'] - 1, pred[name][evts])
-        d[ts_bin][name]['N'] += 1
-        if pred_prob > 0:
-            p_over_p = pred_prob/data['p']
-            d[ts_bin][name]['d'] += p_over_p
-            d[ts_bin][name]['Ne'] += 1
-            if r != 0:
-                d[ts_bin][name]['n'] += r*p_over_p
-                d[ts_bin][name]['c'] = max(d[ts_bin][name]['c'], abs_r * p_over_p)
-                d[ts_bin][name]['SoS'] += (r*p_over_p)**2
+        d.merge(d_new)
+        output_dashboard_data(d, dashboard_file, start_ts=d_new.get_bins().min())
+
+    # state is saved after the dashboard lines: if interrupted, the next run re-emits the same windows
+    save_dashboard_state(state_fp, state, d)
+    return d
+
+
+def save_dashboard_state(state_fp, state, d):
+    with open(state_fp+'.tmp', 'wb') as f:
+        np.savez(f, state=json.dumps(state), policies=np.array(d.policies), bins=d.get_bins(), data=d.data[:len(d)])
+    os.replace(state_fp+'.tmp', state_fp)
+
+
+def load_dashboard_state(state_fp):
+    with np.load(state_fp) as f:
+        d = BinAggregates()
+        d.update(f['bins'], list(f['policies']), f['data'])
+        return json.loads(str(f['state'])), d
+
+
+############################### Aggregates for each bin ######################################
+#
+# 'n':   IPS of numerator
+# 'N':   total number of samples in bin from log (IPS = n/N)
+# 'd':   IPS of denominator (SNIPS = n/d)
+# 'Ne':  number of samples in bin when off-policy agrees with log policy
+# 'c':   max abs. value of numerator's items (needed for Clopper-Pearson confidence intervals)
+# 'SoS': sum of squares of numerator's items (needed for Gaussian confidence intervals)
+#
+# The 'online' policy only reports 'n', 'N' and 'd'
+#
+#################################################################################################
+
+aggregates_fields = ['n', 'N', 'd', 'Ne', 'c', 'SoS']
+online_fields = ['n', 'N', 'd']
+base_policies = ['online', 'baseline1', 'baselineRand']
+
+class BinAggregates:
+    # Aggregates of each policy in 5 min bins, stored in a (bin, policy, field) array that grows as new bins and policies appear
+    def __init__(self, capacity=288):
+        self.bins = np.zeros(capacity, dtype='datetime64[m]')
+        self.data = np.zeros((capacity, len(base_policies), len(aggregates_fields)))
+        self.policies = list(base_policies)
+        self.bin_rows = {}
+        self.pending = {}
+        self.n_pending = 0
+
+    def __len__(self):
+        return len(self.bin_rows)
+
+    def get_bins(self):
+        self.flush()
+        return self.bins[:len(self)]
+
+    def get_policy_cols(self, policies):
+        new_policies = [x for x in policies if x not in self.policies]
+        if new_policies:
+            self.policies += new_policies
+            self.data = np.concatenate((self.data, np.zeros((self.data.shape[0], len(new_policies), self.data.shape[2]))), axis=1)
+        return np.array([self.policies.index(x) for x in policies])
+
+    def get_bin_rows(self, bins):
+        rows = np.empty(len(bins), dtype=np.int64)
+        for k,ts_bin in enumerate(bins.astype(np.int64)):
+            row = self.bin_rows.get(ts_bin)
+            if row is None:
+                row = len(self)
+                if row == len(self.bins):
+                    self.bins = np.concatenate((self.bins, np.zeros_like(self.bins)))
+                    self.data = np.concatenate((self.data, np.zeros_like(self.data)))
+                self.bins[row] = ts_bin
+                self.bin_rows[ts_bin] = row
+            rows[k] = row
+        return rows
+
+    def update(self, bins, policies, values):
+        # Adds values, an array of shape (len(bins), len(policies), len(aggregates_fields)), to the aggregates of
+        # the (unique) 5 min bins in bins (datetime64[m] array) and of policies. 'c' is a max, all other fields are sums
+        rows = self.get_bin_rows(np.asarray(bins, dtype='datetime64[m]'))
+        cols = self.get_policy_cols(policies)
+        idx = np.ix_(rows, cols)
+        agg = self.data[idx]
+        c = aggregates_fields.index('c')
+        res = agg + values
+        res[..., c] = np.maximum(agg[..., c], values[..., c])
+        self.data[idx] = res
+
+    def update_events(self, bins, policies, values):
+        # Same as update, with one row of values for each event: bins (5 min bin of each event) can have repeated values
+        bins, inv = np.unique(bins, return_inverse=True)
+        order = np.argsort(inv, kind='stable')
+        starts = np.searchsorted(inv[order], np.arange(len(bins)))
+        values = values[order]
+        c = aggregates_fields.index('c')
+        agg = np.add.reduceat(values, starts, axis=0)
+        agg[..., c] = np.maximum.reduceat(values[..., c], starts, axis=0)
+        self.update(bins, policies, agg)
+
+    def add_event(self, ts_bin, policies, r, w, ne_scale=1):
+        # Buffers one item (event or slot) with reward r and importance weights w of policies (tuple) in the 5 min bin ts_bin
+        # ('YYYY-MM-DDTHH:MM'). The items are added by flush() in a single update_events for each tuple of policies
+        # ('Ne' of baseline1 is multiplied by ne_scale, see aggregates_ccb_data)
+        items = self.pending.get(policies)
+        if items is None:
+            items = self.pending[policies] = ([], [], [], [])
+        items[0].append(ts_bin)
+        items[1].append(r)
+        items[2].append(w)
+        items[3].append(ne_scale)
+        self.n_pending += 1
+        if self.n_pending >= 100000:
+            self.flush()
+
+    def flush(self):
+        # Adds the items buffered by add_event
+        pending, self.pending, self.n_pending = self.pending, {}, 0
+        for policies, (bins, r, w, ne_scale) in pending.items():
+            values = policy_aggregates(np.array(r)[:,None], np.array(w, dtype=np.float64))
+            values[:, 1, aggregates_fields.index('Ne')] *= ne_scale
+            self.update_events(np.array(bins, dtype='datetime64[m]'), list(policies), values)
+
+    def merge(self, other):
+        self.flush()
+        self.update(other.get_bins(), other.policies, other.data[:len(other)])
+        return self
+
+    def __getstate__(self):
+        # pickled (e.g., sent to another MPI node) without the unused capacity
+        self.flush()
+        state = dict(self.__dict__)
+        n = max(len(self), 1)
+        state['bins'] = self.bins[:n]
+        state['data'] = self.data[:n]
+        return state
+
+
+def policy_aggregates(r, w):
+    # Aggregates fields of each item for rewards r and importance weights w (p_policy/p_log) of a policy
+    # (w=0 when the policy doesn't agree with the log policy)
+    r_w = r*w
+    return np.stack((r_w, np.ones_like(w), w, w > 0, np.abs(r_w), r_w**2), axis=-1)
+
+
+def aggregates_cb_data(data, pred, d, evts):
+    r = -float(data['cost'])
+
+    # importance weights for baseline and additional policies from predictions (a-1: 0-index action)
+    w = [1, 1/data['p'] if data['a'] == 1 else 0, 1/data['p']/data['num_a']] + [get_prediction_prob(data['a'] - 1, pred[name][evts])/data['p'] for name in pred]
+
+    # binning timestamp every 5 min (the event is buffered in d, see BinAggregates.add_event)
+    d.add_event(get_ts_5min_bin(data['ts'])[:16], tuple(base_policies) + tuple(pred), r, w)
+    return d
+
+
+def aggregates_cb_batch(batch, pred_names, pred_prob, d):
+    # Vectorized version of aggregates_cb_data for the columns of ds_parse.iter_columns (only activated events)
+    # pred_prob: (event, policy) matrix of the probabilities of the logged actions for the policies in pred_names
+    if len(batch['a']) == 0:
+        return d
+
+    w = np.column_stack([np.ones(len(batch['a'])), (batch['a'] == 1)/batch['p'], 1/batch['p']/batch['num_a'], pred_prob/batch['p'][:,None]])
+    d.update_events(ds_parse.get_5min_bins(batch['ts']), base_policies + list(pred_names), policy_aggregates(-batch['cost'][:,None], w))
     return d
 
 
 def aggregates_ccb_data(data, pred, d, evts):
-    # binning timestamp every 5 min
-    ts_bin = get_ts_5min_bin(data['ts'])
-
-    # initialize aggregates for ts_bin
-    if ts_bin not in d:
-        d[ts_bin] = collections.OrderedDict([
-            ('online', {'n': 0, 'N': 0, 'd': 0}),
-            ('baseline1', {'n': 0., 'N': 0, 'd': 0., 'Ne': 0, 'c': 0., 'SoS': 0}),
-            ('baselineRand', {'n': 0., 'N': 0, 'd': 0., 'Ne': 0, 'c': 0., 'SoS': 0})
-        ])
-
-        for name in pred:
-            d[ts_bin][name] = {'n':0.,'N':0,'d':0.,'Ne':0,'c':0.,'SoS':0}
-
-    # update aggregates for online and baseline policies
-    d[ts_bin]['online']['d'] += len(data["_outcomes"])
-    d[ts_bin]['online']['N'] += len(data["_outcomes"])
-    d[ts_bin]['baseline1']['N'] += len(data["_outcomes"])
-
-    d[ts_bin]['baselineRand']['N'] += len(data["_outcomes"])
-    d[ts_bin]['baselineRand']['Ne'] += len(data["_outcomes"])
-
-    for name in pred:
-        d[ts_bin][name]['N'] += len(data["_outcomes"])
-
-    for index, item in enumerate(data['_outcomes']):
-        reward = -float(item["_label_cost"])
-        abs_reward = abs(reward)
-
-        d[ts_bin]['online']['n'] += reward
-
-        if (item["_a"][0] == min(item["_a"])):
-            d[ts_bin]['baseline1']['Ne'] += len(data["_outcomes"])
-            d[ts_bin]['baseline1']['d'] += 1/item['_p'][0]
-            d[ts_bin]['baseline1']['n'] += reward/item["_p"][0]
-            d[ts_bin]['baseline1']['c'] = max(
-                d[ts_bin]['baseline1']['c'],
-                abs_reward / item["_p"][0]
-            )
-            d[ts_bin]['baseline1']['SoS'] += (reward/item["_p"][0])**2
-
-        d[ts_bin]['baselineRand']['d'] += 1/item['_p'][0]/len(item['_a'])
-        d[ts_bin]['baselineRand']['n'] += reward/item['_p'][0]/len(item['_a'])
-        d[ts_bin]['baselineRand']['c'] = max(
-            d[ts_bin]['baselineRand']['c'],
-            abs_reward/item['_p'][0]/len(item['_a'])
-        )
-        d[ts_bin]['baselineRand']['SoS'] += (reward/item['_p'][0]/len(item['_a']))**2
-
-        for name in pred:
-            pred_prob = get_prediction_prob(item['_a'][0], pred[name][evts][index])
-            if pred_prob > 0:
-                p_over_p = pred_prob/item['_p'][0]
-                d[ts_bin][name]['d'] += p_over_p
-                d[ts_bin][name]['Ne'] += 1
-                if reward != 0:
-                    d[ts_bin][name]['n'] += reward*p_over_p
-                    d[ts_bin][name]['c'] = max(
-                        d[ts_bin][name]['c'],
-                        abs_reward*p_over_p
-                    )
-                    d[ts_bin][name]['SoS'] += (reward*p_over_p)**2
+    outcomes = data['_outcomes']
+    policies = tuple(base_policies) + tuple(pred)
+
+    # binning timestamp every 5 min (the slots are buffered in d, see BinAggregates.add_event)
+    ts_bin = get_ts_5min_bin(data['ts'])[:16]
+
+    for index, item in enumerate(outcomes):
+        r = -float(item['_label_cost'])
+        p = item['_p'][0]
+
+        # importance weights of the slot for baseline and additional policies from predictions
+        w = [1, (item['_a'][0] == min(item['_a']))/p, 1/p/len(item['_a'])] + [get_prediction_prob(item['_a'][0], pred[name][evts][index])/p for name in pred]
+
+        # 'Ne' of baseline1 counts all the slots of the event for each slot where the logged action is the baseline action
+        d.add_event(ts_bin, policies, r, w, len(outcomes))
     return d
 
 
 def add_parser_args(parser):
     parser.add_argument('-l','--log_fp', help="data file path (.json or .json.gz format - each line is a dsjson)", required=True)
     parser.add_argument('-o','--output_fp', help="output file (default: log_fp+'.dash'")
+    parser.add_argument('--incremental', help="process only the lines appended to log_fp since the previous run (state saved in output_fp+'.state')", action='store_true')
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -345,5 +562,8 @@ if __name__ == '__main__':
     if not output_fp:
         output_fp = log_fp+'.dash'
 
-    d = create_stats(log_fp)
-    output_dashboard_data(d, output_fp)
+    if incremental:
+        update_dashboard(log_fp, output_fp)
+    else:
+        d = create_stats(log_fp)
+        output_dashboard_data(d, output_fp)
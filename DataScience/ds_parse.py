@@ -1,4 +1,21 @@
-import time, collections, os, types, gzip, sys, json
+import time, collections, os, types, gzip, sys, json, mmap, tempfile, multiprocessing, itertools, gzip_utils
+import numpy as np
+
+# Optional C backend of json_cooked and json_dangling (build it with: python setup_ds_parse_ext.py build_ext --inplace).
+# The Python implementation is used when the extension is not available or when DS_PARSE_BACKEND=python
+try:
+    import ds_parse_ext
+except ImportError:
+    ds_parse_ext = None
+parser_backend = 'c' if ds_parse_ext is not None and os.environ.get('DS_PARSE_BACKEND') != 'python' else 'python'
+
+def set_parser_backend(backend):
+    global parser_backend
+    if backend not in {'c', 'python'}:
+        raise ValueError('Unknown parser backend: {}'.format(backend))
+    if backend == 'c' and ds_parse_ext is None:
+        raise ImportError('ds_parse_ext is not available - build it with: python setup_ds_parse_ext.py build_ext --inplace')
+    parser_backend = backend
 
 def update_progress(current, total=None, prefix=''):
     if total:
@@ -16,24 +33,78 @@ def update_progress(current, total=None, prefix=''):
 
 header_str = 'version,date,# obs,# rews,sum rews,# obs multi,# rews multi a,sum rews multi a,# obs1,# rews1,sum rews1,rews1 ips,tot ips slot1,tot slot1,rews rand ips,tot rand ips,tot unique,tot,not joined unique,not joined,not activated,corrupted,1,2,>2,max(a),time'
 
-def process_files(files, output_file=None, d=None, e=None):
+def process_files(files, output_file=None, d=None, e=None, n_proc=1, chunk_size=256*1024**2, event_index=None):
+    # event_index: if set, an event_index.EventIndexWriter filled with the events of files
     t0 = time.time()
     fp_list = input_files_to_fp_list(files)
+    if n_proc > 1 and (d is not None or e is not None or event_index is not None):
+        print('Collecting events in d, e, or event_index is not supported with n_proc > 1. Using n_proc = 1...')
+        n_proc = 1
     if output_file:
         f = open(output_file, 'a', 1)
     print(header_str)
-    for fp in fp_list:
-        t1 = time.time()
-        stats, d_s, e_s, d_c, e_c, slot_len_c, rew_multi_a, baselineRandom, not_activated, corrupted = process_dsjson_file(fp, d, e)
-        res_list = os.path.basename(fp).replace('_0.json','').split('_data_',1)+[sum(stats[x][i] for x in stats) for i in ['o','Nr','r']]+rew_multi_a+([stats[1][i] for i in ['o','Nr','r','n','d','N']] if 1 in stats else [0,0,0,0,0,0])+baselineRandom+[len(d_s),d_c,len(e_s),e_c,not_activated,corrupted,slot_len_c[1],slot_len_c[2],sum(slot_len_c[i] for i in slot_len_c if i > 2),max(i for i in slot_len_c if slot_len_c[i] > 0),'{:.1f}'.format(time.time()-t1)]
-        print(','.join(map(str,res_list)))
-        if output_file:
-            f.write('\t'.join(map(str,res_list))+'\n')
+    if n_proc > 1:
+        # Split each file in ranges of chunk_size bytes (gz files can't be split) and process them in a pool of workers
+        tasks = [(fp, start_byte, end_byte) for fp in fp_list for start_byte, end_byte in get_file_ranges(fp, chunk_size)]
+        tasks_left = collections.Counter(x[0] for x in tasks)
+        results = {}
+        p = multiprocessing.Pool(n_proc)
+        for fp, elapsed, res in p.imap(process_dsjson_range, tasks):
+            results.setdefault(fp, []).append((elapsed, res))
+            tasks_left[fp] -= 1
+            if tasks_left[fp] == 0:
+                # all ranges of fp are done: merge them and print a single row per file (time is the sum of workers time)
+                res_list = dsjson_stats_to_list(fp, merge_dsjson_stats([x[1] for x in results[fp]]), sum(x[0] for x in results.pop(fp)))
+                print(','.join(map(str,res_list)))
+                if output_file:
+                    f.write('\t'.join(map(str,res_list))+'\n')
+        p.close()
+        p.join()
+    else:
+        for fp in fp_list:
+            t1 = time.time()
+            if d is None and e is None and event_index is None:
+                res = process_dsjson_stats(fp)
+            else:
+                res = process_dsjson_file(fp, d, e, event_index=event_index)
+            res_list = dsjson_stats_to_list(fp, res, time.time()-t1)
+            print(','.join(map(str,res_list)))
+            if output_file:
+                f.write('\t'.join(map(str,res_list))+'\n')
     if output_file:
         f.close()
     print('Total time: {:.1f} sec'.format(time.time()-t0))
 
-def process_dsjson_file(fp, d=None, e=None):
+def dsjson_stats_to_list(fp, res, elapsed):
+    stats, d_s, e_s, d_c, e_c, slot_len_c, rew_multi_a, baselineRandom, not_activated, corrupted = res
+    return os.path.basename(fp).replace('_0.json','').split('_data_',1)+[sum(stats[x][i] for x in stats) for i in ['o','Nr','r']]+rew_multi_a+([stats[1][i] for i in ['o','Nr','r','n','d','N']] if 1 in stats else [0,0,0,0,0,0])+baselineRandom+[len(d_s),d_c,len(e_s),e_c,not_activated,corrupted,slot_len_c[1],slot_len_c[2],sum(slot_len_c[i] for i in slot_len_c if i > 2),max(i for i in slot_len_c if slot_len_c[i] > 0),'{:.1f}'.format(elapsed)]
+
+def get_file_ranges(fp, chunk_size):
+    # Returns (start_byte, end_byte) ranges covering fp - files with a fresh columnar cache are returned as a single range.
+    # gz files are split at the gzip members boundaries of their random-access index (see gzip_utils), when available
+    tot_bytes = get_log_size(fp)
+    if tot_bytes is None or tot_bytes <= chunk_size or load_columnar_cache(fp, fields=[]) is not None:
+        return [(0, None)]
+    if fp.endswith('.gz'):
+        return gzip_utils.split_ranges(fp, chunk_size)
+    return split_log_ranges(fp, (tot_bytes+chunk_size-1)//chunk_size)
+
+def process_dsjson_range(task):
+    # Worker function for process_files(n_proc > 1)
+    fp, start_byte, end_byte = task
+    t1 = time.time()
+    res = process_dsjson_stats(fp, start_byte=start_byte, end_byte=end_byte, report_progress=False)
+    return fp, time.time()-t1, res
+
+def process_dsjson_stats(fp, start_byte=0, end_byte=None, report_progress=True):
+    # Output of process_dsjson_file(fp) with the faster path: the columnar cache of fp when it is fresh, otherwise the C
+    # parser line by line (about 2x the numpy batches of the pure-Python backend), otherwise the numpy batches
+    if parser_backend == 'c' and load_columnar_cache(fp, fields=[]) is None:
+        return process_dsjson_file(fp, start_byte=start_byte, end_byte=end_byte, report_progress=report_progress)
+    return process_dsjson_file_batch(fp, start_byte=start_byte, end_byte=end_byte, report_progress=report_progress)
+
+def merge_dsjson_stats(results):
+    # Merge the outputs of process_dsjson_file computed over different byte ranges of the same file
     stats = {}
     slot_len_c = collections.Counter()
     e_s = set()
@@ -44,79 +115,111 @@ def process_dsjson_file(fp, d=None, e=None):
     corrupted = 0
     rew_multi_a = [0,0,0]
     baselineRandom = [0,0]
-    bytes_count = 0
-    tot_bytes = os.path.getsize(fp)
-    with (gzip.open(fp, 'rb') if fp.endswith('.gz') else open(fp, 'rb')) as file_input:
-        for i,x in enumerate(file_input):
-            bytes_count += len(x)
-            if (i+1) % 1000 == 0:
-                if fp.endswith('.gz'):
-                    update_progress(i+1,prefix=fp+' - ')
-                else:
-                    update_progress(bytes_count,tot_bytes,fp+' - ')
+    for res in results:
+        for a in res[0]:
+            if a not in stats:
+                stats[a] = {'o':0,'Nr':0,'r':0.,'n':0.,'d':0.,'N':0}
+            for field in res[0][a]:
+                stats[a][field] += res[0][a][field]
+        d_s.update(res[1])
+        e_s.update(res[2])
+        d_c += res[3]
+        e_c += res[4]
+        slot_len_c.update(res[5])
+        rew_multi_a = [x+y for x,y in zip(rew_multi_a, res[6])]
+        baselineRandom = [x+y for x,y in zip(baselineRandom, res[7])]
+        not_activated += res[8]
+        corrupted += res[9]
+    return stats, d_s, e_s, d_c, e_c, slot_len_c, rew_multi_a, baselineRandom, not_activated, corrupted
 
-            if x.startswith(b'['):   # Ignore checkpoint info line
-                continue
+def process_dsjson_file(fp, d=None, e=None, start_byte=0, end_byte=None, report_progress=True, event_index=None):
+    # When start_byte/end_byte are set, only the lines starting in [start_byte, end_byte) are processed
+    # event_index: if set, an event_index.EventIndexWriter where activated interactions and dangling rewards are added
+    stats = {}
+    slot_len_c = collections.Counter()
+    e_s = set()
+    d_s = set()
+    e_c = 0
+    d_c = 0
+    not_activated = 0
+    corrupted = 0
+    rew_multi_a = [0,0,0]
+    baselineRandom = [0,0]
+    bytes_count = start_byte
+    tot_bytes = get_log_size(fp)
+    i = -1
+    for i,(offset,size,kind,data) in enumerate(iter_log_events(fp, start_byte, end_byte)):
+        bytes_count = offset+size
+        if report_progress and (i+1) % 1000 == 0:
+            if tot_bytes is None:
+                update_progress(i+1,prefix=fp+' - ')
+            else:
+                update_progress(bytes_count,tot_bytes,fp+' - ')
+
+        if kind == LINE_CHECKPOINT:   # Ignore checkpoint info line
+            continue
 
-            if not (x.startswith(b'{"') and x.strip().endswith(b'}')):
+        if kind == LINE_CORRUPTED:
+            corrupted += 1
+            continue
+
+        if kind == LINE_COOKED:
+            if data is None:
                 corrupted += 1
                 continue
 
-            if x.startswith(b'{"_label_cost":'):
-                data = json_cooked(x)
-                if data is None:
-                    corrupted += 1
-                    continue
-
-                if data['skipLearn']:    # Ignore not activated lines
-                    not_activated += 1
-                    continue
-
-                slot_len_c.update([data['num_a']])
-                if d is not None:
-                    d.setdefault(data['ei'], []).append((data, fp, i))
-                d_c += 1
-                d_s.add(data['ei'])
-
-                ############################### Aggregates for each file ########################################
-                #
-                # 'o':   number of events with a joined observation
-                # 'Nr':  number of events with a non-zero reward
-                # 'r':   sum of rewards
-                # 'n':   IPS of numerator
-                # 'd':   IPS of denominator (SNIPS = n/d)
-                # 'N':   total number of events (IPS = n/N)
-                #
-                #################################################################################################
-
-                if data['a'] not in stats:
-                    stats[data['a']] = {'o':0,'Nr':0,'r':0.,'n':0.,'d':0.,'N':0}
-
-                stats[data['a']]['N'] += 1
-                stats[data['a']]['d'] += 1/data['p']
-                baselineRandom[1] += 1/data['p']/data['num_a']
-                if data['o'] == 1:
-                    stats[data['a']]['o'] += 1
-                    if data['num_a'] > 1:
-                        rew_multi_a[0] += 1
-                if data['cost'] != b'0':
-                    r = -float(data['cost'])
-                    stats[data['a']]['Nr'] += 1
-                    stats[data['a']]['r'] += r
-                    stats[data['a']]['n'] += r/data['p']
-                    baselineRandom[0] += r/data['p']/data['num_a']
-                    if data['num_a'] > 1:
-                        rew_multi_a[1] += 1
-                        rew_multi_a[2] += r
-            else:
-                data = json_dangling(x)
+            if data['skipLearn']:    # Ignore not activated lines
+                not_activated += 1
+                continue
 
-                if e is not None:
-                    e.setdefault(data['ei'], []).append((data,fp,i))
-                e_c += 1
-                e_s.add(data['ei'])
+            slot_len_c.update([data['num_a']])
+            if d is not None:
+                d.setdefault(data['ei'], []).append((data, fp, i))
+            if event_index is not None:
+                event_index.add_interaction(fp, data, offset)
+            d_c += 1
+            d_s.add(data['ei'])
+
+            ############################### Aggregates for each file ########################################
+            #
+            # 'o':   number of events with a joined observation
+            # 'Nr':  number of events with a non-zero reward
+            # 'r':   sum of rewards
+            # 'n':   IPS of numerator
+            # 'd':   IPS of denominator (SNIPS = n/d)
+            # 'N':   total number of events (IPS = n/N)
+            #
+            #################################################################################################
+
+            if data['a'] not in stats:
+                stats[data['a']] = {'o':0,'Nr':0,'r':0.,'n':0.,'d':0.,'N':0}
+
+            stats[data['a']]['N'] += 1
+            stats[data['a']]['d'] += 1/data['p']
+            baselineRandom[1] += 1/data['p']/data['num_a']
+            if data['o'] == 1:
+                stats[data['a']]['o'] += 1
+                if data['num_a'] > 1:
+                    rew_multi_a[0] += 1
+            if data['cost'] != b'0':
+                r = -float(data['cost'])
+                stats[data['a']]['Nr'] += 1
+                stats[data['a']]['r'] += r
+                stats[data['a']]['n'] += r/data['p']
+                baselineRandom[0] += r/data['p']/data['num_a']
+                if data['num_a'] > 1:
+                    rew_multi_a[1] += 1
+                    rew_multi_a[2] += r
+        else:
+            if e is not None:
+                e.setdefault(data['ei'], []).append((data,fp,i))
+            if event_index is not None:
+                event_index.add_reward(fp, data, offset)
+            e_c += 1
+            e_s.add(data['ei'])
 
-        if fp.endswith('.gz'):
+    if report_progress:
+        if tot_bytes is None:
             len_text = update_progress(i+1,prefix=fp+' - ')
         else:
             len_text = update_progress(bytes_count,tot_bytes, fp+' - ')
@@ -124,6 +227,355 @@ def process_dsjson_file(fp, d=None, e=None):
         sys.stdout.flush()
     return stats, d_s, e_s, d_c, e_c, slot_len_c, rew_multi_a, baselineRandom, not_activated, corrupted
 
+def process_dsjson_file_batch(fp, start_byte=0, end_byte=None, report_progress=True, batch_size=100000):
+    # Same output of process_dsjson_file(fp), aggregated with numpy over the columns of each batch of lines
+    # (or over the columnar cache of fp, when it is fresh)
+    tot_bytes = get_log_size(fp)
+    len_text = 0
+    i = 0
+    results = []
+    for cols in iter_columns(fp, batch_size, start_byte, end_byte):
+        i += cols['n_lines']
+        if report_progress:
+            if tot_bytes is None:
+                len_text = update_progress(i,prefix=fp+' - ')
+            else:
+                len_text = update_progress(cols['bytes_count'],tot_bytes,fp+' - ')
+        results.append(aggregate_dsjson_columns(cols))
+
+    if report_progress:
+        sys.stdout.write("\r" + " "*len_text + "\r")
+        sys.stdout.flush()
+    return merge_dsjson_stats(results)
+
+def aggregate_dsjson_columns(cols):
+    # Vectorized aggregates of process_dsjson_file for the columns returned by iter_columns
+    stats = {}
+    slot_len_c = collections.Counter()
+    rew_multi_a = [0,0,0]
+    baselineRandom = [0,0]
+
+    # Ignore not activated lines
+    not_activated = int(cols['skipLearn'].sum())
+    activated = ~cols['skipLearn']
+    ei = cols['ei'][activated]
+    a = cols['a'][activated]
+    p = cols['p'][activated]
+    num_a = cols['num_a'][activated]
+    o = cols['o'][activated]
+    r = -cols['cost'][activated]
+
+    slot_len_c.update({int(k): int(v) for k,v in zip(*np.unique(num_a, return_counts=True))})
+
+    # Aggregates for each file (see process_dsjson_file for fields description)
+    is_rew = r != 0
+    is_multi = num_a > 1
+    actions, inv = np.unique(a, return_inverse=True)
+    agg = {'o': np.bincount(inv, o),
+           'Nr': np.bincount(inv, is_rew),
+           'r': np.bincount(inv, r),
+           'n': np.bincount(inv, r/p),
+           'd': np.bincount(inv, 1/p),
+           'N': np.bincount(inv)}
+    for k,x in enumerate(actions):
+        stats[int(x)] = {field: int(agg[field][k]) if field in {'o','Nr','N'} else float(agg[field][k]) for field in ['o','Nr','r','n','d','N']}
+
+    baselineRandom[0] += float((r/p/num_a).sum())
+    baselineRandom[1] += float((1/p/num_a).sum())
+    rew_multi_a[0] += int((o & is_multi).sum())
+    rew_multi_a[1] += int((is_rew & is_multi).sum())
+    rew_multi_a[2] += float(r[is_rew & is_multi].sum())
+
+    return stats, set(ei), set(cols['dangling_ei']), len(ei), len(cols['dangling_ei']), slot_len_c, rew_multi_a, baselineRandom, not_activated, cols['corrupted']
+
+def read_batches(fp, batch_size=100000, start_byte=0, end_byte=None):
+    # Yields lists of up to batch_size lines of fp and the number of bytes read so far.
+    # When start_byte/end_byte are set, only the lines starting in [start_byte, end_byte) are read
+    bytes_count = 0
+    with open_log(fp, max(start_byte-1, 0)) as file_input:
+        if start_byte > 0:
+            # skip the partial line: it belongs to the previous range
+            bytes_count = start_byte-1+len(file_input.readline())
+        while True:
+            if end_byte is None:
+                lines = list(itertools.islice(file_input, batch_size))
+                bytes_count += sum(len(x) for x in lines)
+            else:
+                lines = []
+                for x in file_input:
+                    if bytes_count >= end_byte:
+                        break
+                    lines.append(x)
+                    bytes_count += len(x)
+                    if len(lines) == batch_size:
+                        break
+            if not lines:
+                break
+            yield lines, bytes_count
+
+def iter_columns(fp, batch_size=100000, start_byte=0, end_byte=None, use_cache=True):
+    # Yields the columns of the events in fp (see batch_columns): from the columnar cache of fp in a single chunk
+    # when it is fresh, otherwise parsing batches of batch_size lines
+    if use_cache and start_byte == 0 and end_byte is None:
+        cols = load_columnar_cache(fp)
+        if cols is not None:
+            yield cols
+            return
+    n_lines = 0
+    for lines, bytes_count in read_batches(fp, batch_size, start_byte, end_byte):
+        cols = batch_columns(lines, n_lines)
+        cols['bytes_count'] = bytes_count
+        n_lines += len(lines)
+        yield cols
+
+def read_lines(fp, line_numbers):
+    # Yields the lines of fp with the given (sorted) line numbers
+    line_numbers = iter(line_numbers)
+    next_line = next(line_numbers, None)
+    first_line = 0
+    if next_line and fp.endswith('.gz') and gzip_utils.load_index(fp) is not None:
+        # start decompressing from the gzip member of the first line
+        first_line = next_line
+        file_input = gzip_utils.open_at_line(fp, first_line)
+    else:
+        file_input = open_log(fp)
+    with file_input:
+        for i,x in enumerate(file_input, first_line):
+            if next_line is None:
+                break
+            if i == next_line:
+                yield x
+                next_line = next(line_numbers, None)
+
+def open_log(fp, start_byte=0):
+    # Open fp (plain or gz file) at the (uncompressed) offset start_byte - gz files are decompressed from the gzip
+    # member containing start_byte when they have a random-access index (see gzip_utils)
+    if fp.endswith('.gz'):
+        return gzip_utils.GzipRangeFile(fp, start_byte)
+    file_input = open(fp, 'rb')
+    file_input.seek(start_byte)
+    return file_input
+
+def get_log_size(fp):
+    # Returns the (uncompressed) size of fp: None for gz files without random-access index
+    if fp.endswith('.gz'):
+        index = gzip_utils.load_index(fp)
+        return None if index is None else int(index['uncomp'][-1])
+    return os.path.getsize(fp)
+
+def get_complete_lines_size(fp, block_size=64*1024):
+    # Returns the number of bytes of fp up to its last newline (the last line of a log can still be being written)
+    with open(fp, 'rb') as f:
+        end = f.seek(0, os.SEEK_END)
+        while end > 0:
+            start = max(0, end-block_size)
+            f.seek(start)
+            k = f.read(end-start).rfind(b'\n')
+            if k >= 0:
+                return start+k+1
+            end = start
+    return 0
+
+#########################################################################  MEMORY-MAPPED READER OF UNCOMPRESSED LOGS #########################################################################
+#
+# The lines of uncompressed logs are yielded as memoryview spans of a read-only mmap of the file, so no bytes object is
+# created (and copied) per line: json_cooked and json_dangling parse the spans in place with the C backend (see
+# ds_parse_ext.c), while the Python backend copies them first. Spans must not be modified, and the mapping is released
+# when the last span referencing it is freed.
+#
+##############################################################################################################################################################################################
+
+def iter_log_spans(fp, start_byte=0, end_byte=None):
+    # Yields (offset, span) for the lines of fp starting in [start_byte, end_byte) - the partial line at start_byte
+    # belongs to the previous range
+    size = os.path.getsize(fp)
+    end = size if end_byte is None else min(end_byte, size)
+    if start_byte >= end:
+        return
+    with open(fp, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    buf = memoryview(mm)
+    pos = start_byte
+    if pos > 0 and mm[pos-1] != 10:     # 10: b'\n'
+        pos = mm.find(b'\n', pos)
+        pos = size if pos < 0 else pos+1
+    while pos < end:
+        k = mm.find(b'\n', pos)
+        k = size if k < 0 else k+1
+        yield pos, buf[pos:k]
+        pos = k
+
+def iter_log_lines(fp, start_byte=0, end_byte=None, spans=True):
+    # Yields (offset, line) for the lines of fp starting in [start_byte, end_byte): memoryview spans for uncompressed
+    # files (see iter_log_spans) if spans is True, bytes otherwise
+    if spans and not fp.endswith('.gz'):
+        yield from iter_log_spans(fp, start_byte, end_byte)
+        return
+    with open_log(fp, max(start_byte-1, 0)) as file_input:
+        offset = 0
+        if start_byte > 0:
+            # skip the partial line: it belongs to the previous range
+            offset = start_byte-1+len(file_input.readline())
+        for x in file_input:
+            if end_byte is not None and offset >= end_byte:
+                break
+            yield offset, x
+            offset += len(x)
+
+LINE_CHECKPOINT, LINE_CORRUPTED, LINE_COOKED, LINE_DANGLING = range(4)
+
+def iter_log_events(fp, start_byte=0, end_byte=None, batch_size=256):
+    # Yields (offset, size, kind, data) for the lines of fp starting in [start_byte, end_byte), where kind is:
+    #   LINE_CHECKPOINT: checkpoint info line
+    #   LINE_CORRUPTED:  malformed line
+    #   LINE_COOKED:     data = json_cooked(line) (None if the event is not valid)
+    #   LINE_DANGLING:   data = json_dangling(line)
+    # With the C backend, uncompressed files are memory-mapped and parsed in place in batches of batch_size lines
+    # (ds_parse_ext.scan_lines): no object is created per line besides the parsed fields. Small batches keep few parsed
+    # events alive at a time, so they don't trigger garbage collection passes
+    if parser_backend == 'c' and not fp.endswith('.gz'):
+        file_size = os.path.getsize(fp)
+        end = file_size if end_byte is None else min(end_byte, file_size)
+        if start_byte >= end:
+            return
+        with open(fp, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with mm:
+            pos = start_byte
+            if pos > 0 and mm[pos-1] != 10:     # skip the partial line: it belongs to the previous range
+                pos = mm.find(b'\n', pos)
+                pos = file_size if pos < 0 else pos+1
+            while pos < end:
+                events, pos = ds_parse_ext.scan_lines(mm, pos, end, batch_size)
+                for offset, size, kind, data in events:
+                    if data is NotImplemented:  # unexpected line structure: Python implementation
+                        x = mm[offset:offset+size]
+                        data = json_cooked_py(x) if kind == LINE_COOKED else json_dangling_py(x)
+                    yield offset, size, kind, data
+        return
+
+    for offset, x in iter_log_lines(fp, start_byte, end_byte, spans=False):
+        if x[:1] == b'[':
+            yield offset, len(x), LINE_CHECKPOINT, None
+        elif not is_json_line(x):
+            yield offset, len(x), LINE_CORRUPTED, None
+        elif x[:15] == b'{"_label_cost":':
+            yield offset, len(x), LINE_COOKED, json_cooked(x)
+        else:
+            yield offset, len(x), LINE_DANGLING, json_dangling(x)
+
+def is_json_line(x):
+    # Same as x.startswith(b'{"') and x.strip().endswith(b'}'), for bytes lines and memoryview spans
+    if x[:2] != b'{"':
+        return False
+    if isinstance(x, bytes):
+        return x.strip().endswith(b'}')
+    tail = x[-64:].tobytes().rstrip()
+    return tail.endswith(b'}') if tail else x.tobytes().strip().endswith(b'}')
+
+def split_log_ranges(fp, n_ranges):
+    # Split uncompressed fp in (up to) n_ranges byte ranges of similar size starting at line boundaries
+    size = os.path.getsize(fp)
+    if size == 0:
+        return [(0, None)]
+    bounds = [0]
+    with open(fp, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        for k in range(1, n_ranges):
+            pos = mm.find(b'\n', max(k*size//n_ranges-1, bounds[-1]))
+            if pos < 0 or pos+1 >= size:
+                break
+            bounds.append(pos+1)
+        mm.close()
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def batch_columns(lines, line_offset=0):
+    # Columns of json_cooked_batch(lines) with EventIds as arrays of bytes and the dangling rewards EventIds:
+    # 'line' and 'dangling_line' are line numbers in the file (line_offset is the line number of lines[0])
+    batch = json_cooked_batch(lines)
+    cols = {k: batch[k] for k in ['cost','p','a','num_a','ts','skipLearn','o']}
+    cols['line'] = batch['idx'] + line_offset
+    cols['ei'] = np.array([lines[j][s:e] for j,s,e in zip(batch['idx'], batch['ei_start'], batch['ei_end'])], dtype=bytes)
+    cols['dangling_line'] = np.array(batch['dangling'], dtype=np.int64) + line_offset
+    cols['dangling_ei'] = np.array([json_dangling(lines[j])['ei'] for j in batch['dangling']], dtype=bytes)
+    cols['corrupted'] = batch['corrupted']
+    cols['n_lines'] = len(lines)
+    return cols
+
+#########################################################################  COLUMNAR CACHE OF DSJSON FILES #########################################################################
+#
+# The columns of batch_columns for a whole dsjson file are saved next to it in the folder fp+'.cols' (one .npy file per column)
+# together with meta.json, which stores the size and modification time of fp: the cache is used only if they did not change.
+#
+####################################################################################################################################################################################
+
+columnar_cache_version = 2
+columnar_cache_fields = ['line','cost','p','a','num_a','ts','skipLearn','o','ei','dangling_line','dangling_ei']
+
+def get_columnar_cache_path(fp):
+    return fp + '.cols'
+
+def create_columnar_cache(fp, batch_size=100000, report_progress=True):
+    t0 = time.time()
+    tot_bytes = get_log_size(fp)
+    src_stat = os.stat(fp)
+    chunks = []
+    n_lines = 0
+    bytes_count = 0
+    corrupted = 0
+    len_text = 0
+    for cols in iter_columns(fp, batch_size, use_cache=False):
+        n_lines += cols['n_lines']
+        bytes_count = cols['bytes_count']
+        corrupted += cols['corrupted']
+        chunks.append({k: cols[k] for k in columnar_cache_fields})
+        if report_progress:
+            if tot_bytes is None:
+                len_text = update_progress(n_lines,prefix=fp+' - ')
+            else:
+                len_text = update_progress(cols['bytes_count'],tot_bytes,fp+' - ')
+    if report_progress:
+        sys.stdout.write("\r" + " "*len_text + "\r")
+        sys.stdout.flush()
+
+    cache_dir = get_columnar_cache_path(fp)
+    os.makedirs(cache_dir, exist_ok=True)
+    meta_fp = os.path.join(cache_dir, 'meta.json')
+    if os.path.isfile(meta_fp):
+        os.remove(meta_fp)
+    for k in columnar_cache_fields:
+        if chunks:
+            col = np.concatenate([x[k] for x in chunks])
+        else:
+            col = batch_columns([])[k]
+        np.save(os.path.join(cache_dir, k+'.npy'), col)
+
+    # meta.json is written last: a cache without it is not valid
+    with open(meta_fp, 'w') as f:
+        json.dump({'version': columnar_cache_version, 'size': src_stat.st_size, 'mtime_ns': src_stat.st_mtime_ns, 'n_lines': n_lines, 'corrupted': corrupted, 'bytes_count': bytes_count}, f)
+    if report_progress:
+        print()
+    print('Created columnar cache: {} ({} lines in {:.1f} sec)'.format(cache_dir, n_lines, time.time()-t0))
+    return cache_dir
+
+def load_columnar_cache(fp, fields=None):
+    # Returns the cached columns of fp (memory-mapped), or None if the cache doesn't exist or fp was modified after its creation
+    cache_dir = get_columnar_cache_path(fp)
+    try:
+        with open(os.path.join(cache_dir, 'meta.json')) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    src_stat = os.stat(fp)
+    if meta.get('version') != columnar_cache_version or meta['size'] != src_stat.st_size or meta['mtime_ns'] != src_stat.st_mtime_ns:
+        return None
+    cols = {k: np.load(os.path.join(cache_dir, k+'.npy'), mmap_mode='r') for k in (columnar_cache_fields if fields is None else fields)}
+    cols['n_lines'] = meta['n_lines']
+    cols['corrupted'] = meta['corrupted']
+    cols['bytes_count'] = meta['bytes_count']
+    return cols
+
 def input_files_to_fp_list(files):
     if not (isinstance(files, types.GeneratorType) or isinstance(files, list)):
         print('Input is not list or generator. Wrapping it into a list...')
@@ -139,6 +591,25 @@ def input_files_to_fp_list(files):
 ###############################################################################################################################################################################
 
 def json_cooked(x, do_devType=False, do_VWState=False, do_p_vec=False, do_decode=False):
+    # x: bytes line or memoryview span (see iter_log_spans) - spans are parsed without copying by the C backend
+    if parser_backend == 'c' and not (do_devType or do_VWState or do_p_vec):
+        data = ds_parse_ext.json_cooked(x)
+        if data is not NotImplemented:     # NotImplemented: unexpected line structure
+            return decode_cooked(data) if do_decode and data is not None else data
+    if isinstance(x, memoryview):
+        x = x.tobytes()
+    return json_cooked_py(x, do_devType, do_VWState, do_p_vec, do_decode)
+
+def decode_cooked(data):
+    for key, value in data.items():
+        if key == 'a_vec':
+            data[key] = [z.decode() for z in value]
+        else:
+            if type(value) is bytes:
+                data[key] = value.decode()
+    return data
+
+def json_cooked_py(x, do_devType=False, do_VWState=False, do_p_vec=False, do_decode=False):
     #################################
     # Optimized version based on expected structure:
     # {"_label_cost":0,"_label_probability":0.01818182,"_label_Action":9,"_labelIndex":8,"Timestamp":"2017-10-24T00:00:15.5160000Z","Version":"1","EventId":"fa68cd9a71764118a635fd3d7a908634","a":[9,11,3,1,6,4,10,5,7,8,2],"c":{"_synthetic":false,"User":{"_age":0},"Geo":{"country":"United States","_countrycf":"8","state":"New York","city":"Springfield Gardens","_citycf":"8","dma":"501"},"MRefer":{"referer":"http://www.complex.com/"},"OUserAgent":{"_ua":"Mozilla/5.0 (iPad; CPU OS 10_3_2 like Mac OS X) AppleWebKit/603.2.4 (KHTML, like Gecko) Version/10.0 Mobile/14F89 Safari/602.1","_DeviceBrand":"Apple","_DeviceFamily":"iPad","_DeviceIsSpider":false,"_DeviceModel":"iPad","_OSFamily":"iOS","_OSMajor":"10","_OSPatch":"2","DeviceType":"Tablet"},"_multi":[{"
@@ -187,21 +658,125 @@ def json_cooked(x, do_devType=False, do_VWState=False, do_p_vec=False, do_decode
         data['devType'] = extract_field(x[ind8:],b'"DeviceType":"',b'"')
 
     if do_decode:
-        for key, value in data.items():
-            if key == 'a_vec':
-                data[key] = [z.decode() for z in value]
-            else:
-                if type(value) is bytes:
-                    data[key] = value.decode()
+        decode_cooked(data)
     return data
 
 
+def json_cooked_batch(lines):
+    #################################
+    # Columnar version of json_cooked for a list of dsjson lines, using the same offsets logic.
+    # Instead of one dict per event, it returns a dict of numpy arrays with one row for each valid cooked event:
+    # 'idx':        index of the event line in lines
+    # 'cost':       _label_cost
+    # 'p':          _label_probability
+    # 'a':          chosen action (1-index)
+    # 'num_a':      number of actions
+    # 'ts':         Timestamp truncated to the microsecond (datetime64[us])
+    # 'skipLearn':  event not activated
+    # 'o':          event has a joined observation
+    # 'ei_start', 'ei_end': EventId offsets in the line (EventId = lines[idx][ei_start:ei_end])
+    #
+    # Other lines are not parsed: 'dangling' is the list of indexes of dangling reward lines, and 'corrupted' is the
+    # number of malformed lines (checkpoint info lines are ignored)
+    #################################
+    idx, cost, p, a, num_a, ts, skipLearn, o, ei_start, ei_end = [], [], [], [], [], [], [], [], [], []
+    dangling = []
+    corrupted = 0
+    for i,x in enumerate(lines):
+        if x.startswith(b'['):   # Ignore checkpoint info line
+            continue
+
+        if not (x.startswith(b'{"') and x.strip().endswith(b'}')):
+            corrupted += 1
+            continue
+
+        if not x.startswith(b'{"_label_cost":'):
+            dangling.append(i)
+            continue
+
+        ind1 = x.find(b',',16)
+        ind2 = x.find(b',',ind1+23)
+        ind3 = x.find(b',"T',ind2+34)
+        ind4 = x.find(b'"',ind3+33)
+        if x[ind4+3:ind4+10] == b'Version':
+            ind5 = ind4+27
+        else:
+            ind5 = ind4+13
+        ind6 = x.find(b'"',ind5)
+        ind7 = x.find(b',"a"',ind5)
+        ind8 = x.find(b'],"c"',ind7+7)
+        if ind8 == -1:
+            corrupted += 1
+            continue
+        ind9 = x.find(b',',ind7+6,ind8)
+
+        idx.append(i)
+        cost.append(float(x[15:ind1]))
+        p.append(float(x[ind1+22:ind2]))
+        ts.append(x[ind3+14:ind4].rstrip(b'Z')[:26])
+        ei_start.append(ind5)
+        ei_end.append(ind6)
+        a.append(int(x[ind7+6:ind9 if ind9 > -1 else ind8]))
+        num_a.append(x.count(b',',ind7+6,ind8)+1)
+        o.append(b',"o":' in x[ind2+30:ind2+50])
+        skipLearn.append(b'"_skipLearn":true' in x[ind2+34:ind3])
+
+    batch = {'idx': np.array(idx, dtype=np.int64),
+             'cost': np.array(cost, dtype=np.float64),
+             'p': np.array(p, dtype=np.float64),
+             'a': np.array(a, dtype=np.int64),
+             'num_a': np.array(num_a, dtype=np.int64),
+             'ts': parse_timestamps(ts),
+             'skipLearn': np.array(skipLearn, dtype=bool),
+             'o': np.array(o, dtype=bool),
+             'ei_start': np.array(ei_start, dtype=np.int64),
+             'ei_end': np.array(ei_end, dtype=np.int64)}
+
+    # lines with a malformed Timestamp (NaT) are corrupted
+    valid = (batch['p'] >= 1e-10) & (batch['a'] >= 1) & ~np.isnat(batch['ts'])
+    batch = batch_filter(batch, valid)
+    batch['dangling'] = dangling
+    batch['corrupted'] = corrupted + int((~valid).sum())
+    return batch
+
+def parse_timestamps(ts):
+    # datetime64[us] array of the Timestamps in ts (list of bytes, without 'Z'), NaT for the malformed ones. The bytes
+    # are decoded to str first: casting malformed bytes to datetime64 can crash numpy
+    try:
+        return np.array(ts, dtype='S26').astype('U26').astype('datetime64[us]')
+    except (ValueError, UnicodeDecodeError):
+        res = np.empty(len(ts), dtype='datetime64[us]')
+        for i,x in enumerate(ts):
+            try:
+                res[i] = np.datetime64(x.decode('ascii'), 'us')
+            except (ValueError, UnicodeDecodeError):
+                res[i] = np.datetime64('NaT')
+        return res
+
+def batch_filter(batch, mask):
+    # Returns a copy of the json_cooked_batch (or batch_columns) columns keeping only the rows where mask is True
+    # (the dangling rewards columns have one row per dangling line and are kept as they are)
+    return {k: v[mask] if isinstance(v, np.ndarray) and not k.startswith('dangling') else v for k,v in batch.items()}
+
+def get_5min_bins(ts):
+    # Vectorized version of dashboard_utils.get_ts_5min_bin for the 'ts' column of json_cooked_batch
+    return (ts.astype('datetime64[m]').astype(np.int64)//5*5).astype('datetime64[m]')
+
 def ccb_json_cooked(x):
     data = json.loads(x.decode("utf-8"))
     data['ts'] = data.pop('Timestamp')
     return data
 
 def json_dangling(x):
+    if parser_backend == 'c':
+        data = ds_parse_ext.json_dangling(x)
+        if data is not NotImplemented:
+            return data
+    if isinstance(x, memoryview):
+        x = x.tobytes()
+    return json_dangling_py(x)
+
+def json_dangling_py(x):
     #################################
     # Optimized version based on expected structure:
     # {"Timestamp":"2017-11-27T01:19:13.4610000Z","RewardValue":1.0,"EnqueuedTimeUtc":"2017-08-23T03:31:06.85Z","EventId":"d8a0391be9244d6cb124115ba33251f6"}
@@ -227,12 +802,84 @@ def json_dangling(x):
         ind5 = x.find(b'"',ind4+40)
 
         data['r'] = x[15:ind2]                # len('{"RewardValue":') = 15
-        data['et'] = x[ind3+19:ind4]                    # len(',"EnqueuedTimeUtc":"') = 20
+        data['et'] = x[ind3+20:ind4]                    # len(',"EnqueuedTimeUtc":"') = 20
         data['ei'] = x[ind4+13:ind5]                    # len('","EventId":"') = 13
 
     data['ActionTaken'] = b'"DeferredAction":false' in x[:70]
     return data
 
+parser_conformance_lines = [
+    b'{"_label_cost":0,"_label_probability":0.01818182,"_label_Action":9,"_labelIndex":8,"Timestamp":"2017-10-24T00:00:15.5160000Z","Version":"1","EventId":"fa68cd9a71764118a635fd3d7a908634","a":[9,11,3,1,6,4,10,5,7,8,2],"c":{"_synthetic":false,"User":{"_age":0}},"p":[0.01818182]}\n',
+    b'{"_label_cost":0,"_label_probability":1,"_label_Action":1,"_labelIndex":0,"_deferred":true,"Timestamp":"2018-10-25T00:01:31.1780000Z","Version":"1","EventId":"28EF7EE0B9CF4E319696CB812973F0B3","DeferredAction":true,"a":[1],"c":{"Global":{"SLOT":"1"},"_multi":[{"Action":{"constant":1,"PayloadID":"425039838"}}]},"p":[1.000000],"VWState":{"m":"DF30E6A3648947E69EE6B0816BF42640/1A5CD300DFE546B7B29A11EB70980809"}}\n',
+    b'{"_label_cost":-1,"_label_probability":0.833333015,"_label_Action":6,"_labelIndex":5,"o":[{"EventId":"A3E5ADF82D3A4BD5A5161FFC19C95DBB","DeferredAction":false}],"Timestamp":"2018-10-25T00:00:00.3960000Z","Version":"1","EventId":"A3E5ADF82D3A4BD5A5161FFC19C95DBB","DeferredAction":true,"a":[6,2,4,5,1,3],"c":{"Global":{"SLOT":"2"}},"p":[0.833333015]}\n',
+    b'{"_label_cost":0,"_label_probability":0.5,"_label_Action":2,"_labelIndex":1,"_skipLearn":true,"Timestamp":"2019-01-01T00:00:20.0000000Z","EventId":"7d60f671ee05415bb8606d7c945606d8","a":[2,1],"c":{"_multi":[{"Action":{"id":"1"}},{"Action":{"id":"2"}}]},"p":[0.5,0.5]}\n',
+    b'{"_label_cost":0,"_label_probability":0,"_label_Action":1,"_labelIndex":0,"Timestamp":"2019-01-01T00:00:20.0000000Z","Version":"1","EventId":"p0","a":[1,2],"c":{}}\n',
+    b'{"_label_cost":0,"_label_probability":0.5,"_label_Action":0,"_labelIndex":0,"Timestamp":"2019-01-01T00:00:20.0000000Z","Version":"1","EventId":"a0","a":[0,2],"c":{}}\n',
+    b'{"Timestamp":"2017-11-27T01:19:13.4610000Z","RewardValue":1.0,"EnqueuedTimeUtc":"2017-08-23T03:31:06.85Z","EventId":"d8a0391be9244d6cb124115ba33251f6"}\n',
+    b'{"RewardValue":1.0,"EnqueuedTimeUtc":"2018-01-03T20:12:20.028Z","EventId":"tr-tr_8580.Hero.HyxjxHF8/0WMGsuP","Observations":[{"v":1.0,"EventId":"tr-tr_8580.Hero.HyxjxHF8/0WMGsuP","ActionId":null}]}\n',
+    b'{"RewardValue":null,"DeferredAction":false,"EnqueuedTimeUtc":"2018-10-26T01:23:00.825Z","EventId":"6F61036134274192BE3537D3E4E84ECF","Observations":[{"v":null,"EventId":"6F61036134274192BE3537D3E4E84ECF","ActionId":null,"DeferredAction":false}]}\n',
+]
+
+def check_parser_conformance(files=None):
+    #################################
+    # Conformance suite of the parser backends: json_cooked and json_dangling must return the same output (or raise the
+    # same exception type) with the C and the Python implementations for:
+    #   - parser_conformance_lines and all their prefixes (truncated lines exercise the fallback paths)
+    #   - every line of the files (optional)
+    # and iter_log_events must return the same events with both backends for these lines (the C backend scans them with
+    # ds_parse_ext.scan_lines). Returns the number of mismatches
+    #################################
+    if ds_parse_ext is None:
+        print('ds_parse_ext is not available - build it with: python setup_ds_parse_ext.py build_ext --inplace')
+        return 0
+
+    def run(f, x):
+        try:
+            return f(x)
+        except Exception as e:
+            return type(e)
+
+    def check(x):
+        x = bytes(x)
+        if x.startswith(b'{"_label_cost'):
+            expected = run(json_cooked_py, x)
+            return (run(json_cooked, x) == expected and run(json_cooked, memoryview(x)) == expected and
+                    run(lambda z : json_cooked(z, do_decode=True), x) == run(lambda z : json_cooked_py(z, do_decode=True), x))
+        expected = run(json_dangling_py, x)
+        return run(json_dangling, x) == expected and run(json_dangling, memoryview(x)) == expected
+
+    backend = parser_backend
+    set_parser_backend('c')
+    try:
+        lines = [x[:i] for x in parser_conformance_lines for i in range(len(x)+1)]
+        n_lines, n_mismatch = 0, 0
+        for x in itertools.chain(lines, *((x for _,x in iter_log_lines(fp)) for fp in input_files_to_fp_list(files or []))):
+            n_lines += 1
+            if not check(x):
+                n_mismatch += 1
+                if n_mismatch <= 10:
+                    print('Parser mismatch: {}'.format(x[:200]))
+
+        # reference lines that are parsed without errors, checkpoint info lines and corrupted lines in a temp file
+        lines = [x.rstrip(b'\n')+b'\n' for x in lines if not isinstance(run(json_cooked_py if x.startswith(b'{"_label_cost') else json_dangling_py, x), type)]
+        fd, temp_fp = tempfile.mkstemp(suffix='.json')
+        with os.fdopen(fd, 'wb') as f:
+            f.writelines(lines + [b'[1,2]\n', b'corrupted\n', b'{"_label_cost":0}  \n', parser_conformance_lines[0].rstrip()])
+        try:
+            for fp in [temp_fp] + input_files_to_fp_list(files or []):
+                events = list(iter_log_events(fp))
+                set_parser_backend('python')
+                if events != list(iter_log_events(fp)):
+                    n_mismatch += 1
+                    print('iter_log_events mismatch: {}'.format(fp))
+                set_parser_backend('c')
+        finally:
+            os.remove(temp_fp)
+    finally:
+        set_parser_backend(backend)
+    print('Parser conformance: {} lines - {} mismatches'.format(n_lines, n_mismatch))
+    return n_mismatch
+
 def extract_field(x,sep1,sep2,space=1):
     ind1 = x.find(sep1)
     if ind1 < 0:
@@ -314,6 +961,7 @@ def get_e_from_eh_obs(fp):
     return e
 
 def create_time_hist(d,e, normed=True, cumulative=True, scale_sec=1, n_bins=100, td_day_start=None, ei=None, xlabel=None, ylabel=None):
+    # d and e hold all the events in memory: for large data use event_index.EventIndex(index_dir).join_latency()
     import matplotlib.pyplot as plt
     import datetime
     t_vec = []
@@ -381,3 +1029,26 @@ def parse_cooked(x):
     return r[7],r[1],r[5],r[2],r[3],len(r.fixed)-8
 
 '''
+
+if __name__ == '__main__':
+
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('files', nargs='*', help="dsjson files (.json or .json.gz) to convert into columnar caches")
+    parser.add_argument('--batch_size', type=int, help="lines parsed per batch (default: 100000)", default=100000)
+    parser.add_argument('--force', help="rebuild the cache even if it is up to date", action='store_true')
+    parser.add_argument('--check_parser', help="check that the C and Python parser backends return the same output on the files (no cache is created)", action='store_true')
+
+    args_dict = vars(parser.parse_args())   # this creates a dictionary with all input CLI
+    for x in args_dict:
+        locals()[x] = args_dict[x]  # this is equivalent to foo = args.foo
+
+    if check_parser:
+        sys.exit(1 if check_parser_conformance(files) else 0)
+
+    for fp in files:
+        if not force and load_columnar_cache(fp, fields=[]) is not None:
+            print('Cache up to date: {}'.format(get_columnar_cache_path(fp)))
+            continue
+        print('Creating cache: {}'.format(get_columnar_cache_path(fp)))
+        create_columnar_cache(fp, batch_size=batch_size)
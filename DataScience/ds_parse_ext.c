@@ -0,0 +1,318 @@
+/*
+ * Optional C backend of ds_parse.json_cooked and ds_parse.json_dangling.
+ *
+ * The functions scan the line buffer with the same offsets logic of the Python parsers and return the same dicts.
+ * Lines can be bytes or any object exporting a contiguous buffer (e.g., the memoryview spans of ds_parse.iter_log_spans),
+ * which are parsed in place: only the returned fields are copied.
+ * When a line doesn't have the expected structure (any of the offsets is not found) they return NotImplemented, and
+ * ds_parse falls back to the Python implementation, so both backends always return the same output.
+ *
+ * Build (in the DataScience folder): python setup_ds_parse_ext.py build_ext --inplace
+ */
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <string.h>
+
+/* Same as bytes.find(sub, start): index of the first occurrence of sub in s[start:], -1 if not found */
+static Py_ssize_t find(const char *s, Py_ssize_t n, const char *sub, Py_ssize_t m, Py_ssize_t start)
+{
+    const char *p, *end;
+    if (start < 0 || start > n - m)
+        return -1;
+    end = s + n - m + 1;
+    for (p = s + start; p < end; p++) {
+        p = (const char *)memchr(p, sub[0], end - p);
+        if (p == NULL)
+            return -1;
+        if (memcmp(p, sub, m) == 0)
+            return p - s;
+    }
+    return -1;
+}
+
+/* Same as (sub in s[start:end]), with Python slice clamping */
+static int contains(const char *s, Py_ssize_t n, const char *sub, Py_ssize_t m, Py_ssize_t start, Py_ssize_t end)
+{
+    if (end > n)
+        end = n;
+    if (start > end)
+        return 0;
+    return find(s + start, end - start, sub, m, 0) >= 0;
+}
+
+#define FIND(sub, start) find(s, n, sub, sizeof(sub) - 1, start)
+#define CONTAINS(sub, start, end) contains(s, n, sub, sizeof(sub) - 1, start, end)
+#define SLICE(start, end) PyBytes_FromStringAndSize(s + (start), (end) - (start))
+
+/* dict keys, interned at module init */
+enum {K_O, K_COST, K_P, K_TS, K_EI, K_A_VEC, K_A, K_NUM_A, K_SKIPLEARN, K_R, K_ET, K_ACTIONTAKEN, N_KEYS};
+static const char *key_names[N_KEYS] = {"o", "cost", "p", "ts", "ei", "a_vec", "a", "num_a", "skipLearn", "r", "et", "ActionTaken"};
+static PyObject *keys[N_KEYS];
+
+static int set_item(PyObject *data, int key, PyObject *value)
+{
+    int res;
+    if (value == NULL)
+        return -1;
+    res = PyDict_SetItem(data, keys[key], value);
+    Py_DECREF(value);
+    return res;
+}
+
+static PyObject *json_cooked_buffer(const char *s, Py_ssize_t n)
+{
+    Py_ssize_t ind1, ind2, ind3, ind4, ind5, ind6, ind7, ind8, i, start, num_a;
+    PyObject *data = NULL, *a_vec = NULL, *item, *a;
+    double p;
+    long long a_value;
+    int overflow;
+
+    ind1 = FIND(",", 16);
+    if (ind1 < 0) Py_RETURN_NOTIMPLEMENTED;
+    ind2 = FIND(",", ind1 + 23);
+    if (ind2 < 0) Py_RETURN_NOTIMPLEMENTED;
+    ind3 = FIND(",\"T", ind2 + 34);
+    if (ind3 < 0) Py_RETURN_NOTIMPLEMENTED;
+    ind4 = FIND("\"", ind3 + 33);
+    if (ind4 < 0) Py_RETURN_NOTIMPLEMENTED;
+    if (ind4 + 10 <= n && memcmp(s + ind4 + 3, "Version", 7) == 0)
+        ind5 = ind4 + 27;
+    else
+        ind5 = ind4 + 13;
+    ind6 = FIND("\"", ind5);
+    if (ind6 < 0) Py_RETURN_NOTIMPLEMENTED;
+    ind7 = FIND(",\"a\"", ind5);
+    if (ind7 < 0) Py_RETURN_NOTIMPLEMENTED;
+    ind8 = FIND("],\"c\"", ind7 + 7);
+    if (ind8 < 0)
+        Py_RETURN_NONE;
+
+    data = PyDict_New();
+    if (data == NULL)
+        return NULL;
+    if (set_item(data, K_O, PyLong_FromLong(CONTAINS(",\"o\":", ind2 + 30, ind2 + 50))) < 0) goto error;
+    if (set_item(data, K_COST, SLICE(15, ind1)) < 0) goto error;
+
+    item = SLICE(ind1 + 22, ind2);
+    if (item == NULL) goto error;
+    if (set_item(data, K_P, PyFloat_FromString(item)) < 0) {
+        Py_DECREF(item);
+        goto error;
+    }
+    Py_DECREF(item);
+    p = PyFloat_AS_DOUBLE(PyDict_GetItem(data, keys[K_P]));
+
+    if (set_item(data, K_TS, SLICE(ind3 + 14, ind4)) < 0) goto error;
+    if (set_item(data, K_EI, SLICE(ind5, ind6)) < 0) goto error;
+
+    a_vec = PyList_New(0);
+    if (a_vec == NULL) goto error;
+    start = ind7 + 6;
+    for (i = start; i <= ind8; i++) {
+        if (i == ind8 || s[i] == ',') {
+            item = SLICE(start, i);
+            if (item == NULL || PyList_Append(a_vec, item) < 0) {
+                Py_XDECREF(item);
+                goto error;
+            }
+            Py_DECREF(item);
+            start = i + 1;
+        }
+    }
+    num_a = PyList_GET_SIZE(a_vec);
+    if (PyDict_SetItem(data, keys[K_A_VEC], a_vec) < 0) goto error;
+
+    a = PyNumber_Long(PyList_GET_ITEM(a_vec, 0));
+    if (a == NULL) goto error;
+    a_value = PyLong_AsLongLongAndOverflow(a, &overflow);
+    if (overflow < 0)
+        a_value = 0;
+    else if (overflow > 0)
+        a_value = 1;
+    if (set_item(data, K_A, a) < 0) goto error;
+    if (set_item(data, K_NUM_A, PyLong_FromSsize_t(num_a)) < 0) goto error;
+    if (set_item(data, K_SKIPLEARN, PyBool_FromLong(CONTAINS("\"_skipLearn\":true", ind2 + 34, ind3))) < 0) goto error;
+    Py_DECREF(a_vec);
+
+    if (p < 1e-10 || a_value < 1 || num_a < 1) {
+        Py_DECREF(data);
+        Py_RETURN_NONE;
+    }
+    return data;
+
+error:
+    Py_XDECREF(a_vec);
+    Py_DECREF(data);
+    return NULL;
+}
+
+static PyObject *json_dangling_buffer(const char *s, Py_ssize_t n)
+{
+    Py_ssize_t ind1, ind2, ind3, ind4, ind5, r_start, r_end, et_start, et_end, ei_start, ei_end;
+    PyObject *data;
+
+    if (n >= 12 && memcmp(s, "{\"Timestamp\"", 12) == 0) {
+        ind1 = FIND("\"", 36);
+        if (ind1 < 0) Py_RETURN_NOTIMPLEMENTED;
+        ind2 = FIND(",", ind1 + 16);
+        if (ind2 < 0) Py_RETURN_NOTIMPLEMENTED;
+        ind3 = FIND("\"", ind2 + 39);
+        if (ind3 < 0) Py_RETURN_NOTIMPLEMENTED;
+        ind4 = FIND("\"", ind3 + 40);
+        if (ind4 < 0) Py_RETURN_NOTIMPLEMENTED;
+        r_start = ind1 + 16; r_end = ind2;
+        et_start = ind2 + 20; et_end = ind3;
+        ei_start = ind3 + 13; ei_end = ind4;
+    }
+    else {
+        ind2 = FIND(",", 15);
+        if (ind2 < 0) Py_RETURN_NOTIMPLEMENTED;
+        ind3 = FIND(",\"Enq", ind2);
+        if (ind3 < 0) Py_RETURN_NOTIMPLEMENTED;
+        ind4 = FIND("\"", ind3 + 39);
+        if (ind4 < 0) Py_RETURN_NOTIMPLEMENTED;
+        ind5 = FIND("\"", ind4 + 40);
+        if (ind5 < 0) Py_RETURN_NOTIMPLEMENTED;
+        r_start = 15; r_end = ind2;
+        et_start = ind3 + 20; et_end = ind4;
+        ei_start = ind4 + 13; ei_end = ind5;
+    }
+
+    data = PyDict_New();
+    if (data == NULL)
+        return NULL;
+    if (set_item(data, K_R, SLICE(r_start, r_end)) < 0 ||
+        set_item(data, K_ET, SLICE(et_start, et_end)) < 0 ||
+        set_item(data, K_EI, SLICE(ei_start, ei_end)) < 0 ||
+        set_item(data, K_ACTIONTAKEN, PyBool_FromLong(CONTAINS("\"DeferredAction\":false", 0, 70))) < 0) {
+        Py_DECREF(data);
+        return NULL;
+    }
+    return data;
+}
+
+/* Call parse on the content of x (bytes or contiguous buffer): NotImplemented if x has no contiguous buffer */
+static PyObject *parse_object(PyObject *x, PyObject *(*parse)(const char *, Py_ssize_t))
+{
+    Py_buffer view;
+    PyObject *res;
+
+    if (PyBytes_CheckExact(x))
+        return parse(PyBytes_AS_STRING(x), PyBytes_GET_SIZE(x));
+    if (PyObject_GetBuffer(x, &view, PyBUF_SIMPLE) < 0) {
+        PyErr_Clear();
+        Py_RETURN_NOTIMPLEMENTED;
+    }
+    res = parse((const char *)view.buf, view.len);
+    PyBuffer_Release(&view);
+    return res;
+}
+
+static PyObject *json_cooked(PyObject *self, PyObject *x)
+{
+    return parse_object(x, json_cooked_buffer);
+}
+
+static PyObject *json_dangling(PyObject *self, PyObject *x)
+{
+    return parse_object(x, json_dangling_buffer);
+}
+
+/* Line kinds of scan_lines (same values of ds_parse.LINE_*) */
+enum {LINE_CHECKPOINT, LINE_CORRUPTED, LINE_COOKED, LINE_DANGLING};
+
+static int is_space(char c)
+{
+    return c == ' ' || c == '\t' || c == '\n' || c == '\r' || c == '\x0b' || c == '\x0c';
+}
+
+/*
+ * scan_lines(buffer, start, end, max_lines) -> (events, next_start)
+ * Parse the lines of buffer starting in [start, end) (start must be at the beginning of a line), up to max_lines lines.
+ * events is a list of (offset, size, kind, data) tuples, where data is the output of json_cooked (LINE_COOKED) or
+ * json_dangling (LINE_DANGLING) for the line - NotImplemented if it must be parsed by the Python implementation - and
+ * None for the other kinds. Lines are classified as in ds_parse.process_dsjson_file.
+ */
+static PyObject *scan_lines(PyObject *self, PyObject *args)
+{
+    PyObject *obj, *events = NULL, *data, *event, *res = NULL;
+    Py_buffer view;
+    Py_ssize_t start, end, max_lines, pos, next, last, count = 0;
+    const char *s, *nl;
+    int kind;
+
+    if (!PyArg_ParseTuple(args, "Onnn", &obj, &start, &end, &max_lines))
+        return NULL;
+    if (PyObject_GetBuffer(obj, &view, PyBUF_SIMPLE) < 0)
+        return NULL;
+    s = (const char *)view.buf;
+    if (end > view.len)
+        end = view.len;
+    events = PyList_New(0);
+    if (events == NULL)
+        goto done;
+
+    for (pos = start < 0 ? 0 : start; pos < end && count < max_lines; pos = next, count++) {
+        nl = (const char *)memchr(s + pos, '\n', view.len - pos);
+        next = nl == NULL ? view.len : nl - s + 1;
+
+        /* same as x.strip().endswith(b'}') for lines starting with '{"' */
+        for (last = next - 1; last >= pos && is_space(s[last]); last--)
+            ;
+        data = NULL;
+        if (s[pos] == '[')
+            kind = LINE_CHECKPOINT;
+        else if (next - pos < 2 || s[pos] != '{' || s[pos+1] != '"' || last < pos || s[last] != '}')
+            kind = LINE_CORRUPTED;
+        else if (next - pos >= 15 && memcmp(s + pos, "{\"_label_cost\":", 15) == 0) {
+            kind = LINE_COOKED;
+            data = json_cooked_buffer(s + pos, next - pos);
+        }
+        else {
+            kind = LINE_DANGLING;
+            data = json_dangling_buffer(s + pos, next - pos);
+        }
+        if (kind == LINE_COOKED || kind == LINE_DANGLING) {
+            if (data == NULL) {
+                Py_CLEAR(events);
+                goto done;
+            }
+        }
+        else {
+            data = Py_None;
+            Py_INCREF(data);
+        }
+        event = Py_BuildValue("nniN", pos, next - pos, kind, data);
+        if (event == NULL || PyList_Append(events, event) < 0) {
+            Py_XDECREF(event);
+            Py_CLEAR(events);
+            goto done;
+        }
+        Py_DECREF(event);
+    }
+    res = Py_BuildValue("Nn", events, pos);
+
+done:
+    PyBuffer_Release(&view);
+    return res;
+}
+
+static PyMethodDef methods[] = {
+    {"json_cooked", json_cooked, METH_O, "Fast path of ds_parse.json_cooked (NotImplemented if the line has an unexpected structure)"},
+    {"json_dangling", json_dangling, METH_O, "Fast path of ds_parse.json_dangling (NotImplemented if the line has an unexpected structure)"},
+    {"scan_lines", scan_lines, METH_VARARGS, "Classify and parse the lines of a buffer (see ds_parse.iter_log_events)"},
+    {NULL, NULL, 0, NULL}
+};
+
+static struct PyModuleDef module = {PyModuleDef_HEAD_INIT, "ds_parse_ext", NULL, -1, methods};
+
+PyMODINIT_FUNC PyInit_ds_parse_ext(void)
+{
+    int i;
+    for (i = 0; i < N_KEYS; i++) {
+        keys[i] = PyUnicode_InternFromString(key_names[i]);
+        if (keys[i] == NULL)
+            return NULL;
+    }
+    return PyModule_Create(&module);
+}
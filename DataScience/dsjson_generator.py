@@ -0,0 +1,226 @@
+import os, sys, time, gzip, argparse
+import numpy as np
+
+#########################################################################  SYNTHETIC DSJSON LOGS #########################################################################
+#
+# Seeded generator of cooked cb and ccb dsjson logs with the structure of the Decision Service logs (see the examples in
+# ds_parse.json_cooked and ds_parse.json_dangling), to test, benchmark and load-test the log processing tools offline
+# (no live service or Azure storage is needed):
+#   python dsjson_generator.py -o cb_data.json.gz -n 10000000 --num_actions 10 --shared_ns 4 --marginal_ns 1 --skip_learn_rate 0.05 --checkpoint_every 100000 --corrupt_rate 0.0001
+#   python dsjson_generator.py -o ccb_data.json --log_type ccb --size_gb 2 --num_slots 3
+#
+# All the random values of a batch of events are drawn at once with numpy. Namespaces are rendered ahead of time: each
+# shared namespace has pool_size renderings (events draw one of them) and each action has fixed features, so that
+# formatting an event only joins pre-rendered fragments.
+#
+#########################################################################################################################################################################
+
+# VW identifies a namespace by its first letter: shared, action and marginal namespaces have distinct first letters
+shared_ns_names = ['User', 'Geo', 'Request', 'Profile', 'Session', 'Time', 'Weather', 'Location']
+action_ns_names = ['Action', 'Item', 'Format', 'Category', 'Brand', 'Kind']
+marginal_ns_names = ['Mid', 'Nid', 'Oid', 'Qid']
+
+def get_timestamps(rng, n, start_ts, events_per_sec):
+    # n increasing timestamps (ISO format with 7 decimals as in the logs) starting at start_ts
+    ts = np.datetime64(start_ts, 'us') + np.cumsum(rng.exponential(1e6/events_per_sec, n)).astype('timedelta64[us]')
+    return [x + '0Z' for x in np.datetime_as_string(ts, unit='us')]
+
+def get_event_ids(rng, n):
+    return ['{:016x}{:016x}'.format(x, y) for x,y in rng.randint(0, 2**63, (n, 2), dtype=np.int64)]
+
+def get_p_vec(ranking, greedy_action, num_actions, epsilon=0.2):
+    # epsilon-greedy probabilities of the actions of ranking
+    return [1-epsilon+epsilon/num_actions if x == greedy_action else epsilon/num_actions for x in ranking]
+
+def render_features(rng, n, num_features, vocab_size, numeric_rate=0.25):
+    # n renderings of num_features features: string features take one of vocab_size values, numeric features are in [0, 1)
+    is_numeric = rng.rand(num_features) < numeric_rate
+    values = rng.randint(vocab_size, size=(n, num_features))
+    numeric = rng.rand(n, num_features)
+    return [','.join('"f{}":{:.4g}'.format(j, numeric[i,j]) if is_numeric[j] else '"f{}":"v{}"'.format(j, values[i,j]) for j in range(num_features)) for i in range(n)]
+
+def get_shared_pools(rng, shared_ns, features_per_ns, vocab_size, pool_size):
+    # pool_size renderings of each shared namespace: '"User":{"f0":"v12","f1":0.5317,...}'
+    return [['"{}":{{{}}}'.format(name, x) for x in render_features(rng, pool_size, features_per_ns, vocab_size)] for name in shared_ns_names[:shared_ns]]
+
+def get_actions(rng, ids, action_ns, marginal_ns, features_per_ns, vocab_size, action_key='Action'):
+    # json of each action of the _multi list: the action_key namespace has the action id, the other action namespaces have
+    # fixed features and the marginal namespaces have a constant feature and the action id ('"Mid":{"constant":1,"id":"3"}')
+    features = [render_features(rng, len(ids), features_per_ns, vocab_size) for _ in action_ns_names[1:action_ns]]
+    actions = []
+    for i, id in enumerate(ids):
+        ns = ['"{}":{{"id":"{}"}}'.format(action_key, id)]
+        ns += ['"{}":{{{}}}'.format(name, f[i]) for name, f in zip(action_ns_names[1:action_ns], features)]
+        ns += ['"{}":{{"constant":1,"id":"{}"}}'.format(name, id) for name in marginal_ns_names[:marginal_ns]]
+        actions.append('{' + ','.join(ns) + '}')
+    return ','.join(actions)
+
+def get_context_strings(rng, shared_pools, m):
+    # shared namespaces of m events, drawn from the pools
+    if not shared_pools:
+        return ['']*m
+    idx = rng.randint(len(shared_pools[0]), size=(m, len(shared_pools)))
+    return [','.join(pool[k] for pool, k in zip(shared_pools, row)) + ',' for row in idx]
+
+def corrupt_line(rng, line):
+    # truncated line, as written by an interrupted upload
+    return line[:rng.randint(1, len(line)-2)] + b'\n'
+
+def get_checkpoint_line(ts, n_events):
+    # checkpoint info line: ignored by the parsers (lines starting with '[')
+    return '[{{"Checkpoint":{{"Timestamp":"{}","Events":{}}}}}]\n'.format(ts, n_events).encode()
+
+def generate_cb_batches(n, num_actions=4, reward_rate=0.1, seed=0, start_ts='2019-01-01T00:00:00', events_per_sec=10, batch_size=10000,
+                        shared_ns=2, action_ns=1, marginal_ns=0, features_per_ns=4, vocab_size=100, pool_size=1000,
+                        skip_learn_rate=0.0, dangling_rate=1.0, checkpoint_every=0, corrupt_rate=0.0):
+    # Yields the lines of n cooked cb events in lists of batch_size events:
+    #   - the reward is 1 (cost -1 and "o" field) with probability reward_rate, and dangling_rate of the rewarded events
+    #     are followed by their dangling reward line
+    #   - skip_learn_rate of the events are not activated ("_skipLearn":true)
+    #   - a checkpoint info line is written every checkpoint_every events (0: never)
+    #   - corrupt_rate of the events are truncated
+    rng = np.random.RandomState(seed)
+    shared_pools = get_shared_pools(rng, shared_ns, features_per_ns, vocab_size, pool_size)
+    actions = get_actions(rng, range(1, num_actions+1), action_ns, marginal_ns, features_per_ns, vocab_size)
+    # epsilon-greedy policy: the greedy action is 1 (the first action)
+    rankings = [[a] + [x for x in range(1, num_actions+1) if x != a] for a in range(num_actions+1)]
+    ranking_str = [','.join(map(str, x)) for x in rankings]
+    p_str = [','.join('{:g}'.format(x) for x in get_p_vec(r, 1, num_actions)) for r in rankings]
+    for start in range(0, n, batch_size):
+        m = min(batch_size, n-start)
+        ts = get_timestamps(rng, m, start_ts, events_per_sec)
+        start_ts = ts[-1][:26]
+        ei = get_event_ids(rng, m)
+        context = get_context_strings(rng, shared_pools, m)
+        rewarded = rng.rand(m) < reward_rate
+        dangling = rewarded & (rng.rand(m) < dangling_rate)
+        skip_learn = rng.rand(m) < skip_learn_rate
+        corrupted = rng.rand(m) < corrupt_rate
+        a = np.where(rng.rand(m) >= 0.2, 1, rng.randint(1, num_actions+1, m))
+        lines = []
+        for i in range(m):
+            o = ',"o":[{{"v":1.0,"EventId":"{}","ActionTaken":false}}]'.format(ei[i]) if rewarded[i] else ''
+            line = ('{{"_label_cost":{},"_label_probability":{},"_label_Action":{},"_labelIndex":{}{}{},"Timestamp":"{}",'
+                    '"Version":"1","EventId":"{}","a":[{}],"c":{{{}"_multi":[{}]}},"p":[{}],"VWState":{{"m":"model/1"}}}}\n').format(
+                    -1 if rewarded[i] else 0, p_str[a[i]].split(',', 1)[0], a[i], a[i]-1, o, ',"_skipLearn":true' if skip_learn[i] else '', ts[i], ei[i],
+                    ranking_str[a[i]], context[i], actions, p_str[a[i]]).encode()
+            lines.append(corrupt_line(rng, line) if corrupted[i] else line)
+            if dangling[i]:
+                lines.append('{{"RewardValue":1.0,"EnqueuedTimeUtc":"{}","EventId":"{}","Observations":[{{"v":1.0,"EventId":"{}","ActionId":null}}]}}\n'.format(ts[i][:23]+'Z', ei[i], ei[i]).encode())
+            if checkpoint_every > 0 and (start+i+1) % checkpoint_every == 0:
+                lines.append(get_checkpoint_line(ts[i], start+i+1))
+        yield lines
+
+def generate_ccb_batches(n, num_actions=4, num_slots=2, reward_rate=0.1, seed=0, start_ts='2019-01-01T00:00:00', events_per_sec=10, batch_size=10000,
+                         shared_ns=2, action_ns=1, marginal_ns=0, features_per_ns=4, vocab_size=100, pool_size=1000,
+                         skip_learn_rate=0.0, checkpoint_every=0, corrupt_rate=0.0):
+    # Yields the lines of n cooked ccb events with num_slots slots in lists of batch_size events: each slot chooses an
+    # action among the ones that were not chosen by the previous slots, and has reward 1 with probability reward_rate.
+    # skip_learn_rate, checkpoint_every and corrupt_rate as in generate_cb_batches
+    rng = np.random.RandomState(seed)
+    num_slots = min(num_slots, num_actions)
+    shared_pools = get_shared_pools(rng, shared_ns, features_per_ns, vocab_size, pool_size)
+    actions = get_actions(rng, ['a{}'.format(i) for i in range(num_actions)], action_ns, marginal_ns, features_per_ns, vocab_size, action_key='TAction')
+    slots = ','.join('{{"_id":"slot{}"}}'.format(j) for j in range(num_slots))
+    for start in range(0, n, batch_size):
+        m = min(batch_size, n-start)
+        ts = get_timestamps(rng, m, start_ts, events_per_sec)
+        start_ts = ts[-1][:26]
+        ei = get_event_ids(rng, m)
+        context = get_context_strings(rng, shared_pools, m)
+        rewarded = rng.rand(m, num_slots) < reward_rate
+        chosen_greedy = rng.rand(m, num_slots) >= 0.2
+        explore = rng.rand(m, num_slots)
+        skip_learn = rng.rand(m) < skip_learn_rate
+        corrupted = rng.rand(m) < corrupt_rate
+        lines = []
+        for i in range(m):
+            outcomes = []
+            available = list(range(num_actions))
+            for j in range(num_slots):
+                # epsilon-greedy over the available actions (the greedy action is the first one)
+                k = 0 if chosen_greedy[i,j] else int(explore[i,j]*len(available))
+                ranking = [available[k]] + available[:k] + available[k+1:]
+                p = get_p_vec(ranking, available[0], len(available))
+                outcomes.append('{{"_id":"slot{}","_label_cost":{},"_o":[],"_a":[{}],"_p":[{}]}}'.format(
+                    j, -1 if rewarded[i,j] else 0, ','.join(map(str, ranking)), ','.join('{:g}'.format(x) for x in p)))
+                available.remove(ranking[0])
+            line = ('{{"Timestamp":"{}","Version":"1","EventId":"{}","DeferredAction":false,{}"RewardValue":null,"_outcomes":[{}],'
+                    '"c":{{{}"_multi":[{}],"_slots":[{}]}},"VWState":{{"m":"model/1"}}}}\n').format(
+                    ts[i], ei[i], '"_skipLearn":true,' if skip_learn[i] else '', ','.join(outcomes), context[i], actions, slots).encode()
+            lines.append(corrupt_line(rng, line) if corrupted[i] else line)
+            if checkpoint_every > 0 and (start+i+1) % checkpoint_every == 0:
+                lines.append(get_checkpoint_line(ts[i], start+i+1))
+        yield lines
+
+def generate_cb_lines(n, num_actions=4, reward_rate=0.1, seed=0, **kwargs):
+    # Yields the lines (bytes) of n cooked cb events (see generate_cb_batches for the options)
+    for lines in generate_cb_batches(n, num_actions, reward_rate, seed, **kwargs):
+        yield from lines
+
+def generate_ccb_lines(n, num_actions=4, num_slots=2, reward_rate=0.1, seed=0, **kwargs):
+    # Yields the lines (bytes) of n cooked ccb events (see generate_ccb_batches for the options)
+    for lines in generate_ccb_batches(n, num_actions, num_slots, reward_rate, seed, **kwargs):
+        yield from lines
+
+def write_log(output_fp, batches, max_bytes=None, compresslevel=6, report_progress=True):
+    # Writes the batches of lines to output_fp (gzip stream if output_fp ends with .gz) until max_bytes of uncompressed
+    # data are written (None: all the batches). Returns the number of lines and uncompressed bytes written
+    t0 = time.time()
+    n_lines = n_bytes = 0
+    with (gzip.open(output_fp, 'wb', compresslevel=compresslevel) if output_fp.endswith('.gz') else open(output_fp, 'wb')) as f:
+        for lines in batches:
+            data = b''.join(lines)
+            f.write(data)
+            n_lines += len(lines)
+            n_bytes += len(data)
+            if report_progress:
+                sys.stdout.write('\rLines: {:,} - {:.1f} MB - {:.1f} MB/s'.format(n_lines, n_bytes/1024**2, n_bytes/1024**2/max(time.time()-t0, 1e-6)))
+                sys.stdout.flush()
+            if max_bytes is not None and n_bytes >= max_bytes:
+                break
+    if report_progress:
+        print()
+    return n_lines, n_bytes
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-o','--output_fp', help="output file (.json or .json.gz)", required=True)
+    parser.add_argument('--log_type', help="cb or ccb (default: cb)", choices=['cb', 'ccb'], default='cb')
+    parser.add_argument('-n','--n_events', type=int, help="number of events (default: 1000000, or unbounded if --size_gb is set)")
+    parser.add_argument('--size_gb', type=float, help="stop after this amount of uncompressed data (GB)")
+    parser.add_argument('--num_actions', type=int, help="number of actions of each event (default: 4)", default=4)
+    parser.add_argument('--num_slots', type=int, help="number of slots of ccb events (default: 2)", default=2)
+    parser.add_argument('--reward_rate', type=float, help="fraction of rewarded events (ccb: slots) (default: 0.1)", default=0.1)
+    parser.add_argument('--dangling_rate', type=float, help="cb: fraction of rewarded events followed by a dangling reward line (default: 1)", default=1.0)
+    parser.add_argument('--skip_learn_rate', type=float, help="fraction of not activated events - _skipLearn (default: 0)", default=0.0)
+    parser.add_argument('--corrupt_rate', type=float, help="fraction of truncated events (default: 0)", default=0.0)
+    parser.add_argument('--checkpoint_every', type=int, help="write a checkpoint info line every this many events (default: 0 - never)", default=0)
+    parser.add_argument('--shared_ns', type=int, help="number of shared namespaces (max: {}, default: 2)".format(len(shared_ns_names)), default=2)
+    parser.add_argument('--action_ns', type=int, help="number of action namespaces (max: {}, default: 1)".format(len(action_ns_names)), default=1)
+    parser.add_argument('--marginal_ns', type=int, help="number of marginal namespaces (max: {}, default: 0)".format(len(marginal_ns_names)), default=0)
+    parser.add_argument('--features_per_ns', type=int, help="number of features of each namespace (default: 4)", default=4)
+    parser.add_argument('--vocab_size', type=int, help="number of values of each string feature (default: 100)", default=100)
+    parser.add_argument('--start_ts', help="timestamp of the first event (default: 2019-01-01T00:00:00)", default='2019-01-01T00:00:00')
+    parser.add_argument('--events_per_sec', type=float, help="average rate of the events (default: 10)", default=10)
+    parser.add_argument('--seed', type=int, help="random seed (default: 0)", default=0)
+    parser.add_argument('--batch_size', type=int, help="events generated at once (default: 10000)", default=10000)
+    parser.add_argument('--compresslevel', type=int, help="gzip compression level of .gz outputs (default: 6)", default=6)
+    args = parser.parse_args()
+
+    if args.shared_ns > len(shared_ns_names) or not 1 <= args.action_ns <= len(action_ns_names) or args.marginal_ns > len(marginal_ns_names):
+        print('Error: too many namespaces (max {} shared, {} action, {} marginal)'.format(len(shared_ns_names), len(action_ns_names), len(marginal_ns_names)))
+        sys.exit(1)
+    n_events = args.n_events if args.n_events is not None else (2**62 if args.size_gb is not None else 1000000)
+
+    kwargs = {'start_ts': args.start_ts, 'events_per_sec': args.events_per_sec, 'batch_size': args.batch_size, 'shared_ns': args.shared_ns, 'action_ns': args.action_ns,
+              'marginal_ns': args.marginal_ns, 'features_per_ns': args.features_per_ns, 'vocab_size': args.vocab_size, 'skip_learn_rate': args.skip_learn_rate,
+              'checkpoint_every': args.checkpoint_every, 'corrupt_rate': args.corrupt_rate}
+    if args.log_type == 'cb':
+        batches = generate_cb_batches(n_events, args.num_actions, args.reward_rate, args.seed, dangling_rate=args.dangling_rate, **kwargs)
+    else:
+        batches = generate_ccb_batches(n_events, args.num_actions, args.num_slots, args.reward_rate, args.seed, **kwargs)
+
+    t0 = time.time()
+    n_lines, n_bytes = write_log(args.output_fp, batches, None if args.size_gb is None else int(args.size_gb*1024**3), args.compresslevel)
+    print('Output: {} - {:,} lines - {:.1f} MB uncompressed - {:.1f} MB on disk - {:.1f} sec'.format(args.output_fp, n_lines, n_bytes/1024**2, os.path.getsize(args.output_fp)/1024**2, time.time()-t0))
@@ -0,0 +1,196 @@
+import os, re, sys, json, hashlib, datetime, argparse, ds_parse
+import numpy as np
+
+#########################################################################  EVENTID INDEX #########################################################################
+#
+# On-disk index of the events of dsjson files, with one record per interaction (cooked line) and per dangling reward:
+#   'h':      64-bit hash of the EventId
+#   'file':   index of the file in meta.json 'files'
+#   'offset': (uncompressed) byte offset of the line in the file
+#   'ts':     Timestamp of the interaction or EnqueuedTimeUtc of the reward
+#   'reward': reward of the event (-cost for interactions, RewardValue for dangling rewards, nan if null)
+#   'kind':   INTERACTION or REWARD
+# Records are partitioned by hash into n_partitions binary files (index_dir/p<k>.bin), so that the join engine only
+# needs one partition in memory at a time (grace hash join): the memory used is about 1/n_partitions of the records.
+#
+# The index is built while parsing, passing an EventIndexWriter to ds_parse.process_files(files, event_index=...):
+#   python event_index.py files -o index_dir --join
+
+record_dtype = np.dtype([('h', '<u8'), ('file', '<u2'), ('offset', '<i8'), ('ts', '<M8[ms]'), ('reward', '<f4'), ('kind', 'u1')])
+INTERACTION, REWARD = 0, 1
+
+def hash_event_id(ei):
+    return int.from_bytes(hashlib.blake2b(ei, digest_size=8).digest(), 'little')
+
+def parse_timestamp(ts):
+    # ISO format (e.g., 2019-01-01T00:00:20.0000000Z) or '%m/%d/%Y %I:%M:%S %p'
+    ts = ts.decode() if isinstance(ts, bytes) else ts
+    if ' ' in ts:
+        return np.datetime64(datetime.datetime.strptime(ts, '%m/%d/%Y %I:%M:%S %p'), 'ms')
+    return np.datetime64(ts.rstrip('Z')[:23], 'ms')
+
+def get_partition_fp(index_dir, k):
+    return os.path.join(index_dir, 'p{}.bin'.format(k))
+
+class EventIndexWriter:
+    def __init__(self, index_dir, n_partitions=64, buffer_size=1000000):
+        # only the files of a previous index (meta.json and partitions) are removed: index_dir may be any folder
+        os.makedirs(index_dir, exist_ok=True)
+        for fn in os.listdir(index_dir):
+            if fn == 'meta.json' or re.fullmatch(r'p\d+\.bin', fn):
+                os.remove(os.path.join(index_dir, fn))
+        self.index_dir = index_dir
+        self.n_partitions = n_partitions
+        self.buffer_size = buffer_size
+        self.files = []
+        self.file_ids = {}
+        self.buffer = []
+        self.n = 0
+
+    def get_file_id(self, fp):
+        if fp not in self.file_ids:
+            self.file_ids[fp] = len(self.files)
+            self.files.append(os.path.abspath(fp))
+        return self.file_ids[fp]
+
+    def add(self, fp, ei, offset, ts, reward, kind):
+        self.buffer.append((hash_event_id(ei), self.get_file_id(fp), offset, parse_timestamp(ts), reward, kind))
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def add_interaction(self, fp, data, offset):
+        # data: output of ds_parse.json_cooked
+        self.add(fp, data['ei'], offset, data['ts'], -float(data['cost']), INTERACTION)
+
+    def add_reward(self, fp, data, offset):
+        # data: output of ds_parse.json_dangling
+        self.add(fp, data['ei'], offset, data['et'], float(data['r']) if data['r'] != b'null' else np.nan, REWARD)
+
+    def flush(self):
+        if self.buffer:
+            records = np.array(self.buffer, dtype=record_dtype)
+            partitions = records['h'] % self.n_partitions
+            for k in np.unique(partitions):
+                with open(get_partition_fp(self.index_dir, k), 'ab') as f:
+                    records[partitions == k].tofile(f)
+            self.n += len(records)
+            self.buffer = []
+
+    def close(self):
+        self.flush()
+        with open(os.path.join(self.index_dir, 'meta.json'), 'w') as f:
+            json.dump({'files': self.files, 'n_partitions': self.n_partitions, 'n_records': self.n}, f)
+
+class EventIndex:
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        with open(os.path.join(index_dir, 'meta.json')) as f:
+            meta = json.load(f)
+        self.files = meta['files']
+        self.n_partitions = meta['n_partitions']
+
+    def load_partition(self, k):
+        fp = get_partition_fp(self.index_dir, k)
+        return np.fromfile(fp, dtype=record_dtype) if os.path.isfile(fp) else np.zeros(0, dtype=record_dtype)
+
+    def lookup(self, ei):
+        # Returns the (kind, file, line) of the events with EventId ei (lines are read to discard hash collisions)
+        h = hash_event_id(ei)
+        records = self.load_partition(h % self.n_partitions)
+        res = []
+        for r in records[records['h'] == h]:
+            with ds_parse.open_log(self.files[r['file']], int(r['offset'])) as f:
+                line = f.readline()
+            if b'"EventId":"' + ei + b'"' in line:
+                res.append((int(r['kind']), self.files[r['file']], line))
+        return res
+
+    def iter_joins(self):
+        # Yields, for each partition, the interactions and the rewards joined to them (the first interaction of each
+        # EventId by Timestamp), as (interactions, rewards, joined) where joined[i] is the index in interactions of the
+        # interaction of rewards[i] (-1 if the reward has no interaction)
+        for k in range(self.n_partitions):
+            records = self.load_partition(k)
+            interactions = records[records['kind'] == INTERACTION]
+            interactions = interactions[np.lexsort((interactions['ts'], interactions['h']))]
+            rewards = records[records['kind'] == REWARD]
+            idx = np.searchsorted(interactions['h'], rewards['h'])
+            joined = np.full(len(rewards), -1, dtype=np.int64)
+            found = idx < len(interactions)
+            found[found] = interactions['h'][idx[found]] == rewards['h'][found]
+            joined[found] = idx[found]
+            yield interactions, rewards, joined
+
+    def join_latency(self, bins=None, scale_sec=1, td_day_start=None):
+        # Histogram of the join latency (reward time - interaction time, in units of scale_sec seconds) between
+        # interactions and their dangling rewards, computed partition by partition
+        if bins is None:
+            bins = np.concatenate(([-np.inf, 0], np.logspace(-1, 7, 161)/scale_sec, [np.inf]))
+        hist = np.zeros(len(bins)-1, dtype=np.int64)
+        stats = {'interactions': 0, 'rewards': 0, 'joined rewards': 0, 'not joined rewards': 0, 'interactions with reward': 0}
+        if td_day_start:
+            td_day_start = np.datetime64(td_day_start, 'ms')
+        for interactions, rewards, joined in self.iter_joins():
+            stats['interactions'] += len(np.unique(interactions['h']))
+            stats['rewards'] += len(rewards)
+            is_joined = joined >= 0
+            inter_ts = interactions['ts'][joined[is_joined]]
+            latency = (rewards['ts'][is_joined]-inter_ts)/np.timedelta64(1, 'ms')/1000/scale_sec
+            if td_day_start is not None:
+                latency = latency[inter_ts >= td_day_start]
+            hist += np.histogram(latency, bins)[0]
+            stats['joined rewards'] += int(is_joined.sum())
+            stats['not joined rewards'] += int((~is_joined).sum())
+            stats['interactions with reward'] += len(np.unique(joined[is_joined]))
+        return hist, bins, stats
+
+def get_hist_quantiles(hist, bins, quantiles=(0.5, 0.9, 0.99)):
+    # Quantiles of the values of a histogram (upper edge of the bin where the quantile is reached)
+    cdf = np.cumsum(hist)
+    if cdf[-1] == 0:
+        return {q: np.nan for q in quantiles}
+    return {q: bins[np.searchsorted(cdf, q*cdf[-1])+1] for q in quantiles}
+
+def plot_join_latency(hist, bins, normed=True, cumulative=True, xlabel=None, ylabel=None):
+    # Same plot of ds_parse.create_time_hist, from the output of EventIndex.join_latency
+    import matplotlib.pyplot as plt
+    x = np.clip(bins[1:], bins[1], bins[-2])
+    y = np.cumsum(hist) if cumulative else hist
+    if normed and hist.sum() > 0:
+        y = y/hist.sum()
+    plt.step(x, y, where='post')
+    plt.xscale('symlog')
+    if xlabel:
+        plt.xlabel(xlabel)
+    if ylabel:
+        plt.ylabel(ylabel)
+    plt.show()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('files', nargs='*', help="dsjson files (.json or .json.gz) to index")
+    parser.add_argument('-o','--index_dir', help="EventId index directory", required=True)
+    parser.add_argument('--n_partitions', type=int, help="number of hash partitions: the join loads one partition at a time (default: 64)", default=64)
+    parser.add_argument('--join', help="print the join latency distribution between interactions and dangling rewards", action='store_true')
+    parser.add_argument('--scale_sec', type=float, help="time unit of join latency in seconds (default: 1)", default=1)
+    parser.add_argument('--td_day_start', help="only join interactions after this day - format YYYY-MM-DD")
+    parser.add_argument('--plot', help="plot the join latency distribution", action='store_true')
+    args = parser.parse_args()
+
+    if args.files:
+        writer = EventIndexWriter(args.index_dir, args.n_partitions)
+        ds_parse.process_files(args.files, event_index=writer)
+        writer.close()
+        print('Indexed {} events in: {}'.format(writer.n, args.index_dir))
+    elif not os.path.isfile(os.path.join(args.index_dir, 'meta.json')):
+        print('Error: EventId index not found: {}'.format(args.index_dir))
+        sys.exit()
+
+    if args.join:
+        hist, bins, stats = EventIndex(args.index_dir).join_latency(scale_sec=args.scale_sec, td_day_start=args.td_day_start)
+        for x in stats:
+            print('{}: {}'.format(x, stats[x]))
+        for q,v in get_hist_quantiles(hist, bins).items():
+            print('Join latency quantile {}: <= {:.3f}'.format(q, v))
+        if args.plot:
+            plot_join_latency(hist, bins)
@@ -0,0 +1,302 @@
+import os, zlib, gzip, argparse, collections, itertools, concurrent.futures
+import numpy as np
+
+#########################################################################  GZIP RANDOM ACCESS INDEX #########################################################################
+#
+# A gzip file made of several concatenated members (as written by ParallelGzipWriter) can be decompressed starting at
+# any member. The index of a .gz file (fp + '.idx.npz') has one row per member:
+#   'comp':    offset of the member in the .gz file
+#   'uncomp':  offset of the member in the uncompressed data
+#   'lines':   number of lines before the member
+#   'aligned': the member starts at the beginning of a line
+#   'ts':      first Timestamp of the dsjson lines of the member (NaT if none)
+# The last row holds the totals (file size, uncompressed size and number of lines), so member i spans
+# [comp[i], comp[i+1]) in the .gz file.
+#
+# The index is saved by ParallelGzipWriter, or built by scanning an existing file (build_index). Restart points inside
+# a single deflate stream (as in zlib's zran.c) would need inflatePrime, which is not exposed by Python's zlib: single
+# member files (e.g., created by gzip.open) have a single row and can't be split, but can be rewritten as indexed
+# multi-member files with recompress (python gzip_utils.py --recompress files).
+
+index_fields = ['comp', 'uncomp', 'lines', 'aligned', 'ts']
+
+def get_index_fp(fp):
+    return fp + '.idx.npz'
+
+def save_index(fp, index):
+    with open(get_index_fp(fp), 'wb') as f:
+        np.savez(f, **index)
+
+def load_index(fp):
+    # returns None if the index is missing or stale (the .gz file was modified after the index)
+    index_fp = get_index_fp(fp)
+    if not os.path.isfile(index_fp) or os.path.getmtime(index_fp) < os.path.getmtime(fp):
+        return None
+    with np.load(index_fp) as f:
+        index = {k: f[k] for k in f.files}
+    if any(k not in index for k in index_fields) or index['comp'][-1] != os.path.getsize(fp):
+        return None
+    return index
+
+def get_index(fp, report_progress=True):
+    # Load the index of fp, building it if missing or stale
+    index = load_index(fp)
+    if index is None:
+        index = build_index(fp, report_progress)
+        save_index(fp, index)
+    return index
+
+def get_first_timestamp(data, max_lines=10):
+    # First Timestamp of the first max_lines complete lines of data (data can start in the middle of a line)
+    for x in itertools.islice(data.split(b'\n'), max_lines):
+        i = x.find(b'"Timestamp":"')
+        if i > -1:
+            try:
+                return np.datetime64(x[i+13:i+32].decode(), 's')
+            except ValueError:
+                pass
+    return np.datetime64('NaT', 's')
+
+def build_index(fp, report_progress=True, block_size=16*1024**2):
+    # Scan the members of fp (decompressing it once)
+    index = {k: [] for k in index_fields}
+    tot_bytes = os.path.getsize(fp)
+    comp = uncomp = lines = 0
+    last_byte = b'\n'
+    with open(fp, 'rb') as f:
+        d = None
+        while True:
+            b = f.read(block_size)
+            if not b:
+                break
+            while b:
+                if d is None:
+                    # start of a member
+                    d = zlib.decompressobj(31)
+                    index['comp'].append(comp)
+                    index['uncomp'].append(uncomp)
+                    index['lines'].append(lines)
+                    index['aligned'].append(last_byte == b'\n')
+                    index['ts'].append(None)
+                    head = b''
+                n = len(b)
+                x = d.decompress(b)
+                if x:
+                    if index['ts'][-1] is None:
+                        head += x[:1024**2]
+                        if head.count(b'\n') > 1 or len(head) >= 1024**2:
+                            index['ts'][-1] = get_first_timestamp(head if index['aligned'][-1] else head.split(b'\n', 1)[-1])
+                    uncomp += len(x)
+                    lines += x.count(b'\n')
+                    last_byte = x[-1:]
+                if d.eof:
+                    b = d.unused_data
+                    comp += n-len(b)
+                    if index['ts'][-1] is None:
+                        index['ts'][-1] = get_first_timestamp(head if index['aligned'][-1] else head.split(b'\n', 1)[-1])
+                    d = None
+                else:
+                    comp += n
+                    b = b''
+            if report_progress:
+                print('\rIndexing: {} - {:.1f}%'.format(fp, 100*comp/tot_bytes), end='', flush=True)
+    if report_progress:
+        print()
+    index['comp'].append(comp)
+    index['uncomp'].append(uncomp)
+    index['lines'].append(lines)
+    index['aligned'].append(last_byte == b'\n')
+    index['ts'].append(np.datetime64('NaT', 's'))
+    return make_index(index)
+
+def make_index(index):
+    return {'comp': np.array(index['comp'], dtype=np.int64),
+            'uncomp': np.array(index['uncomp'], dtype=np.int64),
+            'lines': np.array(index['lines'], dtype=np.int64),
+            'aligned': np.array(index['aligned'], dtype=bool),
+            'ts': np.array(index['ts'], dtype='datetime64[s]')}
+
+class GzipRangeFile(gzip.GzipFile):
+    # Read-only GzipFile starting at the uncompressed offset start_byte of fp, decompressing from the member that
+    # contains it (or from the beginning of fp, if it has no index)
+    def __init__(self, fp, start_byte=0, index=None):
+        self.raw_file = open(fp, 'rb')
+        skip = start_byte
+        if start_byte > 0:
+            index = index if index is not None else load_index(fp)
+            if index is not None:
+                i = min(np.searchsorted(index['uncomp'], start_byte, side='right')-1, len(index['comp'])-2)
+                self.raw_file.seek(index['comp'][i])
+                skip = int(start_byte-index['uncomp'][i])
+        super().__init__(fileobj=self.raw_file, mode='rb')
+        if skip > 0:
+            self.seek(skip)
+
+    def close(self):
+        super().close()
+        self.raw_file.close()
+
+def open_at_line(fp, line_number, index=None):
+    # Open fp positioned at the beginning of line line_number (0-index)
+    index = index if index is not None else get_index(fp)
+    lines, aligned = index['lines'][:-1], index['aligned'][:-1]
+    # last member starting at (or inside) a line before line_number
+    i = np.flatnonzero((lines < line_number) | ((lines == line_number) & aligned))[-1]
+    f = GzipRangeFile(fp, int(index['uncomp'][i]), index)
+    # when the member starts inside a line, its first (partial) line ends line lines[i]
+    for _ in range(line_number-lines[i]):
+        f.readline()
+    return f
+
+def read_lines_from_timestamp(fp, ts, index=None):
+    # Yields the lines of fp, starting from the first member that can contain events with Timestamp >= ts (ts is a
+    # datetime64 or an ISO string). Members are assumed to be sorted by Timestamp (e.g., LogDownloader
+    # --create_gzip_mode 2 output), so only the lines of that member before ts are skipped
+    index = index if index is not None else get_index(fp)
+    ts = np.datetime64(ts, 's')
+    members_ts = index['ts'][:-1]
+    before = np.flatnonzero((members_ts < ts) & index['aligned'][:-1])
+    with GzipRangeFile(fp, int(index['uncomp'][before[-1]]) if len(before) > 0 else 0, index) as f:
+        ts_str = str(ts).encode()
+        skipping = True
+        for x in f:
+            if skipping:
+                i = x.find(b'"Timestamp":"')
+                if i == -1 or x[i+13:i+32] < ts_str:
+                    continue
+                skipping = False
+            yield x
+
+def split_ranges(fp, chunk_size=None, n_ranges=None, index=None):
+    # Split fp in (start_byte, end_byte) ranges of uncompressed bytes, at member boundaries, of about chunk_size bytes
+    # (or in n_ranges ranges). They can be processed independently, e.g. by ds_parse.read_batches(fp, start_byte=...,
+    # end_byte=...), which only processes the lines starting in [start_byte, end_byte)
+    index = index if index is not None else load_index(fp)
+    if index is None or len(index['comp']) <= 2:
+        return [(0, None)]
+    uncomp = index['uncomp']
+    if chunk_size is None:
+        chunk_size = uncomp[-1]/n_ranges
+    # members closest to multiples of chunk_size
+    bounds = np.unique(np.searchsorted(uncomp, np.arange(1, int(np.ceil(uncomp[-1]/chunk_size)))*chunk_size))
+    starts = [0] + [int(uncomp[i]) for i in bounds if 0 < i < len(uncomp)-1]
+    return [(start, end) for start, end in zip(starts, starts[1:]+[None])]
+
+def recompress(fp, n_threads=None, block_size=32*1024**2):
+    # Rewrite fp as an indexed multi-member gzip file
+    temp_fp = fp + '.temp.gz'
+    with gzip.open(fp, 'rb') as f_in, ParallelGzipWriter(temp_fp, n_threads, block_size) as f_out:
+        while True:
+            b = f_in.read(block_size)
+            if not b:
+                break
+            f_out.write(b)
+    os.replace(temp_fp, fp)
+    os.replace(get_index_fp(temp_fp), get_index_fp(fp))
+
+#########################################################################  PARALLEL GZIP WRITER #########################################################################
+#
+# ParallelGzipWriter compresses blocks of block_size bytes (cut at line boundaries) as independent gzip members on a
+# pool of threads (zlib releases the GIL) and writes them in order. Concatenated gzip members are a valid gzip file
+# (readable by gzip.open, zcat and vw --compressed). Since each member starts at a line, the writer also saves the
+# index of the file.
+
+def compress_member(data, compresslevel):
+    c = zlib.compressobj(compresslevel, zlib.DEFLATED, 31)   # wbits=31: gzip header and trailer
+    return c.compress(data) + c.flush(), data.count(b'\n'), get_first_timestamp(data[:1024**2])
+
+def read_member_range(fp, comp_start, comp_end, block_size=16*1024**2):
+    # Decompress the gzip members in [comp_start, comp_end) of fp, yielding blocks of uncompressed data
+    with open(fp, 'rb') as f:
+        f.seek(comp_start)
+        d = zlib.decompressobj(31)
+        pos = comp_start
+        while pos < comp_end:
+            b = f.read(min(block_size, comp_end-pos))
+            if not b:
+                break
+            pos += len(b)
+            while b:
+                yield d.decompress(b)
+                if not d.eof:
+                    break
+                b = d.unused_data
+                d = zlib.decompressobj(31)
+
+class ParallelGzipWriter:
+    def __init__(self, fp, n_threads=None, block_size=32*1024**2, compresslevel=9, write_index=True):
+        self.fp = fp
+        self.f = open(fp, 'wb')
+        self.n_threads = n_threads or os.cpu_count() or 1
+        self.block_size = block_size
+        self.compresslevel = compresslevel
+        self.write_index = write_index
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.n_threads)
+        self.futures = collections.deque()
+        self.buffer = bytearray()
+        self.index = {'comp': [0], 'uncomp': [0], 'lines': [0], 'aligned': [True], 'ts': []}
+
+    def write(self, b):
+        self.buffer += b
+        while len(self.buffer) >= self.block_size:
+            # cut the block at the last line end (blocks are larger than block_size only for lines longer than that)
+            i = self.buffer.rfind(b'\n', 0, self.block_size) + 1 or self.buffer.find(b'\n', self.block_size) + 1
+            if i == 0:
+                break
+            self.submit(bytes(self.buffer[:i]))
+            del self.buffer[:i]
+        return len(b)
+
+    def submit(self, block):
+        self.futures.append((self.executor.submit(compress_member, block, self.compresslevel), len(block)))
+        # bound the memory used by blocks in flight
+        while len(self.futures) > 2*self.n_threads:
+            self.write_member()
+
+    def write_member(self):
+        future, size = self.futures.popleft()
+        member, n_lines, ts = future.result()
+        self.f.write(member)
+        self.index['comp'].append(self.index['comp'][-1] + len(member))
+        self.index['uncomp'].append(self.index['uncomp'][-1] + size)
+        self.index['lines'].append(self.index['lines'][-1] + n_lines)
+        self.index['aligned'].append(True)
+        self.index['ts'].append(ts)
+
+    def close(self):
+        if self.f.closed:
+            return
+        if self.buffer or len(self.index['comp']) == 1:
+            self.submit(bytes(self.buffer))     # an empty file is still written as one (empty) gzip member
+            self.buffer = bytearray()
+        while self.futures:
+            self.write_member()
+        self.executor.shutdown()
+        self.f.close()
+        if self.write_index:
+            self.index['ts'].append(np.datetime64('NaT', 's'))
+            save_index(self.fp, make_index(self.index))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Create the random-access index of gzip files (python gzip_utils.py files)')
+    parser.add_argument('files', nargs='+', help="gzip files")
+    parser.add_argument('--recompress', help="rewrite the files as indexed multi-member gzip files (needed to split single member files)", action='store_true')
+    parser.add_argument('--block_size', type=int, default=32, help="size in MB of the gzip members written by --recompress (default=32)")
+    parser.add_argument('--n_threads', type=int, default=None, help="number of compression threads (default: number of cpus)")
+    parser.add_argument('--force', help="rebuild the index even if it is fresh", action='store_true')
+    args = parser.parse_args()
+
+    for fp in args.files:
+        if args.recompress:
+            print('Recompressing: {}'.format(fp))
+            recompress(fp, args.n_threads, args.block_size*1024**2)
+        elif args.force or load_index(fp) is None:
+            save_index(fp, build_index(fp))
+        index = load_index(fp)
+        print('{}: {} members - {} lines - {:.3f} MB uncompressed'.format(fp, len(index['comp'])-1, index['lines'][-1], index['uncomp'][-1]/(1024**2)))
@@ -0,0 +1,132 @@
+import os, heapq, itertools, tempfile, shutil, ds_parse, gzip_utils
+
+#########################################################################  EXTERNAL MERGE OF COOKED LOGS #########################################################################
+#
+# Merge cooked dsjson files into a unique gzip file, uniquing over EventId (keeping the line with best reward, i.e.
+# lowest cost) and sorting by Timestamp, using bounded memory:
+#   1. input files are streamed and their cooked lines are buffered; when the buffer reaches max_memory bytes it is
+#      sorted by (EventId, cost), uniqued and spilled to a temporary run file
+#   2. the runs are merged (k-way) by EventId, the duplicates of each EventId are dropped and the unique events are
+#      spilled again to runs sorted by Timestamp
+#   3. the Timestamp runs are merged (k-way) to the output file
+# Ties are broken by the position of the first occurrence of the EventId, so the output is the same as sorting an
+# in-memory dict {EventId: (Timestamp, cost, line)} by Timestamp.
+#
+# Run files store one event per line: EventId \t cost \t line seq \t first seq \t Timestamp \t dsjson line
+
+record_overhead = 300       # approximate memory (bytes) used by a buffered event besides its dsjson line
+
+def write_run(records, temp_dir):
+    fd, fp = tempfile.mkstemp(suffix='.run', dir=temp_dir)
+    with os.fdopen(fd, 'wb') as f:
+        for ei, cost, seq, first_seq, ts, x in records:
+            if not x.endswith(b'\n'):
+                x += b'\n'
+            f.write(b'\t'.join((ei, repr(cost).encode(), str(seq).encode(), str(first_seq).encode(), ts, x)))
+    return fp
+
+def read_run(fp):
+    with open(fp, 'rb') as f:
+        for x in f:
+            ei, cost, seq, first_seq, ts, line = x.split(b'\t', 5)
+            yield ei, float(cost), int(seq), int(first_seq), ts, line
+
+def unique_events(records):
+    # records are sorted by (EventId, cost, seq): keep the first record of each EventId, with the first occurrence
+    # of the EventId over all its records
+    for ei, group in itertools.groupby(records, key=lambda r : r[0]):
+        best = next(group)
+        first_seq = min(itertools.chain((best[3],), (r[3] for r in group)))
+        yield best[:3] + (first_seq,) + best[4:]
+
+def merge_runs(runs, key, temp_dir, max_open_files):
+    # k-way merge of sorted runs, merging groups of max_open_files runs first if there are too many of them
+    while len(runs) > max_open_files:
+        merged = write_run(heapq.merge(*[read_run(fp) for fp in runs[:max_open_files]], key=key), temp_dir)
+        for fp in runs[:max_open_files]:
+            os.remove(fp)
+        runs = runs[max_open_files:] + [merged]
+    return runs, heapq.merge(*[read_run(fp) for fp in runs], key=key)
+
+class RunWriter:
+    # Buffer records and spill them as sorted runs when their memory reaches max_memory bytes
+    def __init__(self, key, temp_dir, max_memory, unique=False):
+        self.key = key
+        self.temp_dir = temp_dir
+        self.max_memory = max_memory
+        self.unique = unique
+        self.runs = []
+        self.buffer = []
+        self.buffer_size = 0
+        self.n = 0
+
+    def add(self, record):
+        self.buffer.append(record)
+        self.buffer_size += len(record[5]) + record_overhead
+        self.n += 1
+        if self.buffer_size >= self.max_memory:
+            self.spill()
+
+    def spill(self):
+        if self.buffer:
+            self.buffer.sort(key=self.key)
+            self.runs.append(write_run(unique_events(self.buffer) if self.unique else self.buffer, self.temp_dir))
+            self.buffer = []
+            self.buffer_size = 0
+
+def deep_merge(input_fps, output_fp, max_memory=4*1024**3, temp_dir=None, max_open_files=64, dry_run=False):
+    ei_key = lambda r : (r[0], r[1], r[2])
+    ts_key = lambda r : (r[4], r[3])
+    temp_dir = tempfile.mkdtemp(prefix='deepmerge_', dir=temp_dir or os.path.dirname(os.path.abspath(output_fp)))
+    try:
+        # 1. parse input files to runs sorted by EventId
+        runs_ei = RunWriter(ei_key, temp_dir, max_memory, unique=True)
+        for fn in input_fps:
+            print('Parsing: {}'.format(fn), end='', flush=True)
+            if not dry_run:
+                for x in open(fn, 'rb'):
+                    if x.startswith(b'{"_label_cost') and x.strip().endswith(b'}'):     # reading only cooked lined
+                        data = ds_parse.json_cooked(x)
+                        if data is not None:
+                            runs_ei.add((data['ei'], float(data['cost']), runs_ei.n, runs_ei.n, data['ts'], x))
+            print(' - events: {} - runs: {}'.format(runs_ei.n, len(runs_ei.runs)+(len(runs_ei.buffer) > 0)))
+
+        if dry_run:
+            print('--dry_run - Not downloading!')
+            return
+
+        # 2. unique over EventId to runs sorted by Timestamp
+        print('Uniquing over EventId...')
+        if runs_ei.runs:
+            runs_ei.spill()
+            runs_ts = RunWriter(ts_key, temp_dir, max_memory)
+            runs, records = merge_runs(runs_ei.runs, ei_key, temp_dir, max_open_files)
+            for r in unique_events(records):
+                runs_ts.add(r)
+            for fp in runs:
+                os.remove(fp)
+            runs_ts.spill()
+            n = runs_ts.n
+            records = merge_runs(runs_ts.runs, ts_key, temp_dir, max_open_files)[1]
+        else:
+            # everything fits in memory: no need to spill
+            runs_ei.buffer.sort(key=ei_key)
+            records = list(unique_events(runs_ei.buffer))
+            runs_ei.buffer = None
+            records.sort(key=ts_key)
+            n = len(records)
+
+        # 3. merge by Timestamp to the output file
+        print('Writing {} unique events to output .gz file...'.format(n))
+        with gzip_utils.ParallelGzipWriter(output_fp) as f:
+            i = 0
+            for r in records:
+                f.write(r[5])
+                i += 1
+                if i % 5000 == 0:
+                    ds_parse.update_progress(i, n)
+            if n > 0:
+                ds_parse.update_progress(i, n)
+            print()
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
@@ -0,0 +1,8 @@
+# Build the optional C backend of ds_parse (json_cooked and json_dangling fast paths) in the DataScience folder:
+#   python setup_ds_parse_ext.py build_ext --inplace
+# ds_parse uses the Python implementation when the extension is not built (or DS_PARSE_BACKEND=python).
+# Check that both backends return the same output with: python ds_parse.py --check_parser [files]
+
+from setuptools import setup, Extension
+
+setup(name='ds_parse_ext', ext_modules=[Extension('ds_parse_ext', ['ds_parse_ext.c'])])
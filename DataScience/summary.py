@@ -2,6 +2,7 @@ import sys
 import json
 import pandas as pd
 import gzip
+import ds_parse
 # import cPickle 
 
 if __name__ == '__main__':
@@ -11,32 +12,39 @@ if __name__ == '__main__':
 
     file_name = sys.argv[1]
 
-with gzip.open(file_name, 'rt', encoding='utf8') if file_name.endswith('.gz') else open(file_name, 'r', encoding="utf8") as data:
+# use the columnar cache of the log file (see ds_parse.create_columnar_cache) when it is fresh
+cols = ds_parse.load_columnar_cache(file_name, fields=['ei', 'ts', 'num_a', 'cost', 'p', 'a'])
+if cols is not None:
+    df = pd.DataFrame({'id': cols['ei'].astype(str), 'timestamp': cols['ts'], 'num_of_actions': cols['num_a'], 'cost': cols['cost'], 'prob': cols['p'], 'action_observed': cols['a']},
+                      columns=('id', 'timestamp', 'num_of_actions', 'cost', 'prob', 'action_observed'))
+    print (df.iloc[0].tolist())
+else:
+    with gzip.open(file_name, 'rt', encoding='utf8') if file_name.endswith('.gz') else open(file_name, 'r', encoding="utf8") as data:
     
-    m = []
-    ii = 0
-    for line in data:
-        ii += 1
-        if ii % 100000 == 0:
-            print(ii)
-        js = json.loads(line)
-        if 'EventId' in js:
-            m.append([
-                js['EventId'], 
-                js['Timestamp'],
-                len(js['c']['_multi']), 
-                float(js['_label_cost']),
-                float(js['_label_probability']),
-                int(js['_label_Action']),
-                ])
+        m = []
+        ii = 0
+        for line in data:
+            ii += 1
+            if ii % 100000 == 0:
+                print(ii)
+            js = json.loads(line)
+            if 'EventId' in js:
+                m.append([
+                    js['EventId'], 
+                    js['Timestamp'],
+                    len(js['c']['_multi']), 
+                    float(js['_label_cost']),
+                    float(js['_label_probability']),
+                    int(js['_label_Action']),
+                    ])
 
-    print (m[0])
-    df = pd.DataFrame(m, columns=('id', 'timestamp', 'num_of_actions', 'cost', 'prob', 'action_observed'))
+        print (m[0])
+        df = pd.DataFrame(m, columns=('id', 'timestamp', 'num_of_actions', 'cost', 'prob', 'action_observed'))
 
-    #              
-    print(df['num_of_actions'].describe())
-    numNonZeroCost = (df['cost'] != 0).sum()
-    print("# num non-zero cost: {0}/{1} = {2:.4f}".format(numNonZeroCost, len(df), numNonZeroCost/len(df)))
+#              
+print(df['num_of_actions'].describe())
+numNonZeroCost = (df['cost'] != 0).sum()
+print("# num non-zero cost: {0}/{1} = {2:.4f}".format(numNonZeroCost, len(df), numNonZeroCost/len(df)))
    
 def ips(d, action_of_policy):
     return d.cost / d.prob if action_of_policy == d.action_observed else 0
@@ -0,0 +1,190 @@
+import os, json, hashlib
+from subprocess import check_call, DEVNULL
+
+#########################################################################  VW CACHE REGISTRY #########################################################################
+#
+# VW cache files shared by all the tools. A cache is keyed on the fingerprint of its data file (size and hash of its first
+# and last MB) and on the VW options that change the parsed examples (input format, label type, hash bits, ignored
+# namespaces), so that commands that differ only in the learning options (learning rate, interactions, marginals, ...)
+# read the same cache, wherever they run from.
+#
+# Each cache is built exactly once: the build runs under an exclusive lock of the cache (an OS file lock, released even if
+# the process dies), writes to a temporary file, and renames it only if VW completed. Processes and threads waiting
+# for the lock read the cache when it is released.
+#
+# The caches are stored in the folder of the registry (default: DS_VW_CACHE_DIR environment variable, or the folder of
+# the data file) as <data file name>.<key hash>.cache, with the key in <cache>.json. Lock files (<cache>.lock) are not
+# removed, since removing them could let two processes lock different files for the same cache.
+#
+####################################################################################################################################################################
+
+# label types: commands with the same label and example format share their caches
+label_options = {'--cb_adf': '--cb_adf', '--cb_explore_adf': '--cb_adf', '--ccb_explore_adf': '--ccb_explore_adf', '--cb': '--cb', '--cb_explore': '--cb'}
+format_options = {'--dsjson', '--json', '--compressed', '--chain_hash'}
+hash_options = {'-b': '-b', '--bit_precision': '-b', '--hash': '--hash'}
+namespace_options = {'--ignore', '--ignore_linear', '--keep'}
+cache_options = {'-c', '--cache', '-k', '--kill_cache'}
+
+def get_data_fingerprint(data_fp):
+    h = hashlib.sha1()
+    size = os.path.getsize(data_fp)
+    with open(data_fp, 'rb') as f:
+        h.update(f.read(1024**2))
+        if size > 1024**2:
+            f.seek(max(1024**2, size-1024**2))
+            h.update(f.read())
+    return '{}-{}'.format(size, h.hexdigest())
+
+def is_option(x):
+    if not x.startswith('-'):
+        return False
+    try:
+        float(x)
+        return False
+    except ValueError:
+        return True
+
+def split_vw_args(vw_args):
+    # option groups of a command line: an option followed by its values ('vw' is a group without option)
+    groups = []
+    for x in vw_args.split():
+        if is_option(x) or not groups:
+            groups.append([x])
+        else:
+            groups[-1].append(x)
+    return groups
+
+def get_data_file(vw_args):
+    for g in split_vw_args(vw_args):
+        if g[0] in {'-d', '--data'} and len(g) > 1:
+            return g[1]
+    return None
+
+def get_parse_args(vw_args):
+    # Normalized options of vw_args that change the content of a cache
+    args = set()
+    namespaces = {}
+    for g in split_vw_args(vw_args):
+        if g[0] in label_options:
+            args.add(label_options[g[0]])
+        elif g[0] in format_options:
+            args.add(g[0])
+        elif g[0] in hash_options and len(g) > 1:
+            args.add(hash_options[g[0]] + ' ' + g[1])
+        elif g[0] in namespace_options:
+            # each character of the values is a namespace: '--ignore ab --ignore c' is the same as '--ignore abc'
+            namespaces.setdefault(g[0], set()).update(''.join(g[1:]))
+    args.update(k + ' ' + ''.join(sorted(v)) for k,v in namespaces.items())
+    return sorted(args)
+
+def uses_cache(vw_args):
+    return any(g[0] in cache_options or g[0] == '--cache_file' for g in split_vw_args(vw_args))
+
+def set_cache_file(vw_args, cache_fp):
+    # vw_args reading (or writing) the cache cache_fp instead of its own cache options
+    groups = [g for g in split_vw_args(vw_args) if g[0] not in cache_options and g[0] != '--cache_file']
+    return ' '.join(x for g in groups for x in g) + ' --cache_file ' + cache_fp
+
+def run_vw(vw_args):
+    check_call(vw_args.split(), stdout=DEVNULL, stderr=DEVNULL)
+
+class FileLock:
+    # Exclusive lock of the file fp (created if missing) between processes and threads, released by the OS if the
+    # process dies. Note: locks may not be enforced on network file systems
+    def __init__(self, fp):
+        self.fp = fp
+        self.f = None
+
+    def __enter__(self):
+        self.f = open(self.fp, 'a+b')
+        if os.name == 'nt':
+            import msvcrt
+            while True:
+                try:
+                    self.f.seek(0)
+                    msvcrt.locking(self.f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:     # LK_LOCK gives up after 10 sec
+                    pass
+        else:
+            import fcntl
+            fcntl.flock(self.f.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if os.name == 'nt':
+            import msvcrt
+            self.f.seek(0)
+            msvcrt.locking(self.f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(self.f.fileno(), fcntl.LOCK_UN)
+        self.f.close()
+        self.f = None
+
+class CacheRegistry:
+    def __init__(self, folder=None):
+        self.folder = folder
+        self.fingerprints = {}
+
+    def get_fingerprint(self, data_fp):
+        st = os.stat(data_fp)
+        key = (os.path.abspath(data_fp), st.st_size, st.st_mtime_ns)
+        if key not in self.fingerprints:
+            self.fingerprints[key] = get_data_fingerprint(data_fp)
+        return self.fingerprints[key]
+
+    def get_path(self, vw_args):
+        # Returns the cache file of vw_args (-d data file) and its key
+        data_fp = get_data_file(vw_args)
+        if data_fp is None:
+            raise ValueError('No data file (-d) in VW command: {}'.format(vw_args))
+        key = ' '.join([self.get_fingerprint(data_fp)] + get_parse_args(vw_args))
+        folder = self.folder or os.environ.get('DS_VW_CACHE_DIR') or os.path.dirname(os.path.abspath(data_fp))
+        return os.path.join(folder, '{}.{}.cache'.format(os.path.basename(data_fp), hashlib.sha1(key.encode()).hexdigest()[:16])), key
+
+    def lookup(self, vw_args):
+        # Returns the cache file of vw_args if it was built, otherwise None
+        cache_fp, _ = self.get_path(vw_args)
+        return cache_fp if os.path.isfile(cache_fp) else None
+
+    def get(self, vw_args, build=run_vw):
+        # Returns the cache file of vw_args, built by build(vw_args writing the cache) if it doesn't exist yet
+        cache_fp, key = self.get_path(vw_args)
+        if not os.path.isfile(cache_fp):
+            os.makedirs(os.path.dirname(cache_fp), exist_ok=True)
+            with FileLock(cache_fp + '.lock'):
+                if not os.path.isfile(cache_fp):
+                    self.build(cache_fp, key, vw_args, build)
+            if not os.path.isfile(cache_fp):
+                raise RuntimeError('VW cache was not created by: {}'.format(vw_args))
+        return cache_fp
+
+    def run(self, vw_args, run=run_vw):
+        # Returns run(vw_args using the registry cache) if vw_args uses a cache (-c or --cache_file), otherwise run(vw_args).
+        # If the cache doesn't exist yet, this run builds it
+        if not uses_cache(vw_args):
+            return run(vw_args)
+        cache_fp, key = self.get_path(vw_args)
+        if not os.path.isfile(cache_fp):
+            os.makedirs(os.path.dirname(cache_fp), exist_ok=True)
+            with FileLock(cache_fp + '.lock'):
+                if not os.path.isfile(cache_fp):
+                    return self.build(cache_fp, key, vw_args, run)
+        return run(set_cache_file(vw_args, cache_fp))
+
+    def build(self, cache_fp, key, vw_args, run):
+        # Runs run(vw_args) writing the cache to a temporary file, which becomes cache_fp only if VW completed (VW writes
+        # the cache to tmp_fp+'.writing' and renames it at the end)
+        tmp_fp = '{}.{}.tmp'.format(cache_fp, os.getpid())
+        try:
+            res = run(set_cache_file(vw_args, tmp_fp))
+            if os.path.isfile(tmp_fp):
+                with open(cache_fp + '.json', 'w') as f:
+                    json.dump({'key': key, 'data': os.path.abspath(get_data_file(vw_args)), 'command': vw_args}, f)
+                os.replace(tmp_fp, cache_fp)
+        finally:
+            for fp in [tmp_fp, tmp_fp + '.writing']:
+                if os.path.isfile(fp):
+                    os.remove(fp)
+        return res